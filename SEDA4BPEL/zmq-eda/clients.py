@@ -3,7 +3,6 @@
 # python client.py -cf ./config/zmq-eda.yaml -pf ./config/loan_approval.yaml -fn nico -n estrada -a 2000 1000 15000 3000 6000 500 300 -ci 50001
 # Celery -A clients worker -l info --concurrency=25 -n clientsServer -Q clients_tasks
 
-import sys
 import json
 import time
 import random
@@ -119,23 +118,22 @@ def run(config, message_patterns, port,
 
 
                                 message['profiler']['client_id'] = client_id
-                                client_request.send_multipart([rkey, json.dumps(message)])
+                                body = json.dumps(message)
+                                client_request.send_multipart([rkey, body])
                                 # print("Sent message [%s] RKEY: [%s]" % (message, rkey))
 
-                                size_str = sys.getsizeof(rkey + str(message))
-                                mp.msg_sent(size_str)
+                                mp.msg_sent(len(rkey) + len(body))
 
                                 # Waiting loanService response to proceed
                                 rkey, message = client_receive.recv_multipart()
+                                mp.msg_received(len(rkey) + len(message))
+
                                 message = json.loads(message)
                                 message['profiler']['client_received_ts'] = time.time()
                                 # print("Received message [%s] RKEY: [%s], Elapsed time: [%s] seconds" % (
                                 #     message, rkey,
                                 #     message['profiler']['client_received_ts'] - message['profiler']['client_send_ts']))
 
-                                size_str = sys.getsizeof(rkey + str(message))
-                                mp.msg_received(size_str)
-
                                 mp.update_response_time(message['level'], message['profiler']['client_received_ts'] - message['profiler']['client_send_ts'])
                         except Timeout.Timeout:
                             if not (limit_time == 0 or time.time() - mp.start <= limit_time):
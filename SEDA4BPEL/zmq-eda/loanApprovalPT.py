@@ -3,7 +3,6 @@
 # python loanApprovalPT.py -cf ./config/zmq-eda.yaml -pf ./config/loan_approval.yaml -at 10
 # Celery -A loanApprovalPT worker -l info --concurrency=25 -n loanApprovalServer -Q loanApprovalPT_tasks
 
-import sys
 import json
 import time
 
@@ -98,8 +97,7 @@ def run(config, message_patterns, port,
                             print("[WARNING] Wrong rkey for message [%s] RKEY: [%s]" % (message, rkey))
                             continue
 
-                        size_str = sys.getsizeof(rkey + str(message))
-                        mp.msg_received(size_str)
+                        mp.msg_received(len(rkey) + len(message))
 
                         message = json.loads(message)
                         message['profiler']['loanApprovalPT_ts'] = time.time()
@@ -107,21 +105,20 @@ def run(config, message_patterns, port,
                         rkey = str(config['outgoing']['routing_key'])
                         time.sleep(app_time)
 
-                        pub.send_multipart([rkey, json.dumps(message)])
+                        body = json.dumps(message)
+                        pub.send_multipart([rkey, body])
                         print("NORMAL - Sent message [%s] RKEY: [%s]" % (message, rkey))
 
-                        size_str = sys.getsizeof(rkey + str(message))
-                        mp.msg_sent(size_str)
+                        mp.msg_sent(len(rkey) + len(body))
                     except Timeout.Timeout:
                         message['accept'] = 'no'
-                        size_str = sys.getsizeof(rkey + str(message))
-                        mp.msg_received(size_str)
+                        body = json.dumps(message)
+                        mp.msg_received(len(rkey) + len(body))
 
-                        pub.send_multipart([rkey, json.dumps(message)])
+                        pub.send_multipart([rkey, body])
                         print("TIMEOUT - Sent message [%s] RKEY: [%s]" % (message, rkey))
 
-                        size_str = sys.getsizeof(rkey + str(message))
-                        mp.msg_sent(size_str)
+                        mp.msg_sent(len(rkey) + len(body))
                         return mp.stats
 
                     except AttributeError:
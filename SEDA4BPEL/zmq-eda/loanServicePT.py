@@ -2,7 +2,6 @@
 
 # python loanServicePT.py -cf ./config/zmq-eda.yaml -pf ./config/loan_approval.yaml -t 10000
 
-import sys
 import json
 import time
 
@@ -79,8 +78,7 @@ if __name__ == "__main__":
                     print("[WARNING] Wrong rkey for message [%s] RKEY: [%s]" % (message, rkey))
                     continue
 
-                size_str = sys.getsizeof(rkey + str(message))
-                mp.msg_received(size_str)
+                mp.msg_received(len(rkey) + len(message))
                 
                 message = json.loads(message)
 
@@ -93,11 +91,11 @@ if __name__ == "__main__":
                     rkey = str(config['outgoing']['routing_key']['high_amount'])
 
                 message['profiler']['loanServicePT_ts'] = time.time()
-                pub.send_multipart([rkey, json.dumps(message)])
+                body = json.dumps(message)
+                pub.send_multipart([rkey, body])
                 print("Sent message [%s] RKEY: [%s]" % (message, rkey))
 
-                size_str = sys.getsizeof(rkey + str(message))
-                mp.msg_sent(size_str)
+                mp.msg_sent(len(rkey) + len(body))
 
     except:
         rcv.close()
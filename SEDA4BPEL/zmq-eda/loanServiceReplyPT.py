@@ -2,7 +2,6 @@
 
 # python loanServiceReplyPT.py -cf ./config/zmq-eda.yaml -pf ./config/loan_approval.yaml
 
-import sys
 import json
 import time
 
@@ -74,19 +73,18 @@ if __name__ == "__main__":
                     print("[WARNING] Wrong rkey for message [%s] RKEY: [%s]" % (message, rkey))
                     continue
                 
-                message = json.loads(message)
+                mp.msg_received(len(rkey) + len(message))
 
-                size_str = sys.getsizeof(rkey + str(message))
-                mp.msg_received(size_str)
+                message = json.loads(message)
 
                 message['profiler']['loanServiceReplyPT_ts'] = time.time()
+                body = json.dumps(message)
                 pub.send_multipart([
                     str(message['profiler']['client_id']),
-                    json.dumps(message)])
+                    body])
                 print("Message sent: [%s] RKEY: [%s]" % (message, rkey))
 
-                size_str = sys.getsizeof(rkey + str(message))
-                mp.msg_sent(size_str)
+                mp.msg_sent(len(rkey) + len(body))
 
     except:
         rcv.close()
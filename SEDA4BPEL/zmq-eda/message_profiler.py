@@ -1,45 +1,182 @@
-import time
+"""Message profiler.
+
+Counts messages and bytes going in and out of a process, plus latencies
+recorded in an HDR histogram (see histogram.py).
+
+Besides the totals printed when the profiler exits, it can report the
+stats of each interval every N seconds (one JSON object per line) to a
+file or to a ZeroMQ endpoint (a PUB socket connects to it). The interval
+and the output default to the PROFILER_INTERVAL and PROFILER_OUTPUT
+environment variables, so any process can enable them without changes.
+
+Live metrics (interval stats plus gauges such as queue depths, and the
+process RSS, CPU and GC stats) can also be published on a PUB socket
+bound by the process, see metrics.py and METRICS_ENDPOINT.
+
+SIGTERM is turned into SystemExit while the profiler is active (unless
+the process already handles it), so the final report is flushed when a
+process running an infinite loop is terminated.
+
+"""
+
+from __future__ import division
+
+import os
+import sys
 import json
+import time
+import signal
+import threading
+
+import metrics
+
+from histogram import Histogram, DEFAULT_PERCENTILES
 
 LOG_STR = ("Elapsed time: {secs} s | Messages received: {count_in} | "
            "Messages sent: {count_out} | MB in: {mb_in} | MB out: {mb_out} | "
            "Messages-in ratio: {ratio_in} msg/s | Messages-out ratio: {ratio_out} msg/s | "
            "MB-in ratio: {mb_ratio_in} MB/s | MB-out ratio: {mb_ratio_out} MB/s")
 
+ZMQ_SCHEMES = ('tcp://', 'ipc://', 'inproc://', 'pgm://', 'epgm://')
+
+
+def latency_stats(histogram):
+    stats = dict(
+        ("p{0}".format(percentile), value)
+        for percentile, value
+        in histogram.percentiles(DEFAULT_PERCENTILES).iteritems())
+    stats["count"] = histogram.total_count
+    stats["max"] = histogram.max
+    return stats
+
+
+def _sigterm_handler(signum, frame):
+    # Further SIGTERMs (i.e. sent to the whole process group) must not
+    # interrupt the final flush
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(128 + signum)
+
+
+class ReportOutput(object):
+    """Destination of the interval reports: a file path (lines are
+    appended), a ZeroMQ endpoint, or stdout when no output is given.
+    """
+
+    def __init__(self, output=None):
+        self.output = output
+        self.socket = None
+        self.file = None
+
+        if output is None:
+            return
+
+        if output.startswith(ZMQ_SCHEMES):
+            import zmq
+
+            self.socket = zmq.Context.instance().socket(zmq.PUB)
+            self.socket.setsockopt(zmq.LINGER, 1000)
+            self.socket.connect(output)
+        else:
+            self.file = open(output, 'a')
+
+    def write(self, line):
+        if self.socket is not None:
+            self.socket.send(line)
+        elif self.file is not None:
+            self.file.write(line + '\n')
+            self.file.flush()
+        else:
+            print line
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+        elif self.file is not None:
+            self.file.close()
+
+
 class MessageProfiler(object):
-    def __init__(self, name="default", verbose=False):
+    def __init__(self, name="default", verbose=False, interval=None,
+                 output=None, metrics=None):
         self.verbose = verbose
         self.name = name
 
+        if interval is None:
+            interval = float(os.environ.get('PROFILER_INTERVAL', 0))
+        if output is None:
+            output = os.environ.get('PROFILER_OUTPUT')
+        if metrics is None:
+            metrics = os.environ.get('METRICS_ENDPOINT')
+
+        self.interval = interval
+        self.output = output
+        self.metrics = metrics
+        self.gauges = {}
+
     def __enter__(self):
-        self.start = time.time()
+        self.start = self.interval_start = time.time()
+        self.end = None
         self.count_in = 0
         self.count_out = 0
         self.bytes_in = 0
         self.bytes_out = 0
+
+        # Values at the start of the current interval
+        self.last = (0, 0, 0, 0)
+
+        self.latency = Histogram()
+        self.interval_latency = Histogram()
+
+        self.outputs = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.reporter = None
+        self.previous_sigterm = None
+
+        report_interval = self.interval
+
+        if self.interval > 0:
+            self.outputs.append(ReportOutput(self.output))
+
+        if self.metrics:
+            self.outputs.append(
+                metrics.MetricsPublisher(self.metrics, self.name))
+
+            if not report_interval:
+                report_interval = float(os.environ.get(
+                    'METRICS_INTERVAL', metrics.DEFAULT_INTERVAL))
+
+        # Signal handlers can only be set from the main thread
+        if (isinstance(threading.current_thread(), threading._MainThread)
+                and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL):
+            self.previous_sigterm = signal.signal(
+                signal.SIGTERM, _sigterm_handler)
+
+        if self.outputs:
+            self.reporter = threading.Thread(
+                target=self._report_loop, args=(report_interval, ))
+            self.reporter.daemon = True
+            self.reporter.start()
+
         return self
 
     def __exit__(self, *args):
+        if self.reporter is not None:
+            self.stopped.set()
+            self.reporter.join()
+
         self.end = time.time()
-        self.secs = self.end - self.start
-        self.ratio_in = float(self.count_in / self.secs)
-        self.mb_ratio_in = float(self.bytes_in / (self.secs * 1024 * 1024))
-        self.ratio_out = float(self.count_out / self.secs)
-        self.mb_ratio_out = float(self.bytes_out / (self.secs * 1024 * 1024))
-        self.mb_in = self.bytes_in / (1024 * 1024)
-        self.mb_out = self.bytes_out / (1024 * 1024)
-
-        self.stats = {
-            "secs": self.secs,
-            "count_in": self.count_in,
-            "count_out": self.count_out,
-            "ratio_in": self.ratio_in,
-            "ratio_out": self.ratio_out,
-            "mb_in": self.mb_in,
-            "mb_out": self.mb_out,
-            "mb_ratio_in": self.mb_ratio_in,
-            "mb_ratio_out": self.mb_ratio_out
-        }
+
+        # Final flush of the last (partial) interval, plus the latency
+        # percentiles of the whole run
+        if self.outputs:
+            self.report(final=True)
+
+        for output in self.outputs:
+            output.close()
+
+        if self.previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, self.previous_sigterm)
 
         # TODO: Handle log folder creation
         # with open("log/{0}.log".format(self.name), "a") as f:
@@ -49,6 +186,25 @@ class MessageProfiler(object):
             msg = LOG_STR.format(**self.stats)
             print msg
 
+    @property
+    def stats(self):
+        """Totals since the start, available while the profiler runs"""
+
+        end = self.end if self.end is not None else time.time()
+        secs = (end - self.start) or 1e-9
+
+        return {
+            "secs": secs,
+            "count_in": self.count_in,
+            "count_out": self.count_out,
+            "ratio_in": self.count_in / secs,
+            "ratio_out": self.count_out / secs,
+            "mb_in": self.bytes_in / (1024 * 1024),
+            "mb_out": self.bytes_out / (1024 * 1024),
+            "mb_ratio_in": self.bytes_in / (secs * 1024 * 1024),
+            "mb_ratio_out": self.bytes_out / (secs * 1024 * 1024)
+        }
+
     def msg_received(self, bytes):
         self.count_in += 1
         self.bytes_in += bytes
@@ -57,6 +213,76 @@ class MessageProfiler(object):
         self.count_out += 1
         self.bytes_out += bytes
 
+    def record_latency(self, seconds):
+        micros = seconds * 1000000
+        self.latency.record(micros)
+        self.interval_latency.record(micros)
+
+    def gauge(self, name, value):
+        """Sets an instantaneous value (i.e. a queue depth) to be reported"""
+        self.gauges[name] = value
+
+    def _report_loop(self, interval):
+        while not self.stopped.wait(interval):
+            self.report()
+
+    def interval_stats(self):
+        """Returns the stats of the interval since the last call, starting
+        a new one.
+        """
+
+        with self.lock:
+            now = time.time()
+            current = (self.count_in, self.count_out,
+                       self.bytes_in, self.bytes_out)
+            latency, self.interval_latency = self.interval_latency, Histogram()
+
+            count_in, count_out, bytes_in, bytes_out = [
+                value - last for value, last in zip(current, self.last)]
+            secs = (now - self.interval_start) or 1e-9
+
+            self.last = current
+            self.interval_start = now
+
+        stats = {
+            "name": self.name,
+            "pid": os.getpid(),
+            "ts": now,
+            "secs": secs,
+            "count_in": count_in,
+            "count_out": count_out,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "ratio_in": count_in / secs,
+            "ratio_out": count_out / secs,
+            "bratio_in": bytes_in / secs,
+            "bratio_out": bytes_out / secs,
+            "total_in": current[0],
+            "total_out": current[1],
+        }
+
+        if latency.total_count:
+            stats["latency"] = latency_stats(latency)
+
+        return stats
+
+    def report(self, final=False):
+        stats = self.interval_stats()
+
+        if final and self.latency.total_count:
+            stats["total_latency"] = latency_stats(self.latency)
+
+        if self.gauges:
+            stats["gauges"] = dict(self.gauges)
+
+        if self.metrics:
+            stats.update(metrics.process_stats())
+
+        line = json.dumps(stats)
+
+        for output in self.outputs:
+            output.write(line)
+
 
 class ClientMessageProfiler(MessageProfiler):
     def __init__(self, name="default", verbose=False):
@@ -79,6 +305,8 @@ class ClientMessageProfiler(MessageProfiler):
         super(ClientMessageProfiler, self).__init__(name, verbose)
 
     def update_response_time(self, key, elapsed_time):
+        self.record_latency(elapsed_time)
+
         try:
             self.response_time[key]["requests_received"] += 1
             self.response_time[key]["response_time"] += elapsed_time
@@ -2,7 +2,6 @@
 
 # python riskAssessmentPT.py -cf ./config/zmq-eda.yaml -pf ./config/loan_approval.yaml
 
-import sys
 import json
 import time
 import random
@@ -82,17 +81,17 @@ if __name__ == "__main__":
                     print("[WARNING] Wrong rkey for message [%s] RKEY: [%s]" % (message, rkey))
                     continue
 
+                mp.msg_received(len(rkey) + len(message))
+
                 message = json.loads(message)
                 message['profiler']['riskAssessmentPT_ts'] = time.time()
 
-                size_str = sys.getsizeof(rkey + str(message))
-                mp.msg_received(size_str)
-
                 # RiskAssessment <assign> activity (risk="low")
                 rkey = config['outgoing']['low_risk']['routing_key']
                 message['level'] = 'low'
                 message['accept'] = 'yes'
-                pub_low.send_multipart([rkey, json.dumps(message)])
+                body = json.dumps(message)
+                pub_low.send_multipart([rkey, body])
                 
                 # Non-low risk assessment (not included in the scenario)
                 # rkey = config['outgoing']['approval']['routing_key']
@@ -104,8 +103,7 @@ if __name__ == "__main__":
 
                 print("Sent message [%s] RKEY: [%s]" % (message, rkey))
 
-                size_str = sys.getsizeof(rkey + str(message))
-                mp.msg_sent(size_str)
+                mp.msg_sent(len(rkey) + len(body))
 
     except:
         queue.close()
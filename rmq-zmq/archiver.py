@@ -24,6 +24,10 @@ Arguments:
   -so, --storage_output format of raw data
   -oo, --omit_output    value to omit validated data archiving (
                             0 = no output, 1 = only valid ,2 = only invalid)
+  -cr, --credits        credits (unacknowledged messages) given to the queue
+  -ab, --ack_batch      amount of stored messages acknowledged at once
+  -tr, --trace_report   seconds between latency reports of traced messages
+  -qe, --queue_endpoint endpoint of the queue to take messages from
 
   -tm, --test_mode      flag for testing mode
 
@@ -51,6 +55,9 @@ import msgpack
 PARENT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, PARENT_DIRECTORY)
 
+import flow_control
+import tracing
+
 from message_profiler import MessageProfiler
 from python_utils import config_loader, logging_manager
 from validation.process import MessageValidator, MessageProcessor
@@ -131,6 +138,29 @@ if __name__ == "__main__":
         type=int,
         default=3,
         help='omit output rule')
+    parser.add_argument(
+        '-cr',
+        '--credits',
+        type=int,
+        default=flow_control.DEFAULT_CREDITS,
+        help='credits (unacknowledged messages) advertised to the queue')
+    parser.add_argument(
+        '-ab',
+        '--ack_batch',
+        type=int,
+        default=flow_control.DEFAULT_ACK_BATCH,
+        help='amount of stored messages acknowledged at once')
+    parser.add_argument(
+        '-tr',
+        '--trace_report',
+        type=int,
+        default=10,
+        help='seconds between latency reports of traced messages')
+    parser.add_argument(
+        '-qe',
+        '--queue_endpoint',
+        default='tcp://localhost:12001',
+        help='endpoint of the queue to take messages from')
     # parser.add_argument(
     #     '-tm',
     #     '--test_mode',
@@ -325,26 +355,90 @@ def handle_message(body, rkey):
 
 
 def main():
-    """Main function, in charge of make the connection to the server
+    """Main function, in charge of make the connection to the server.
+
+    The archiver uses the credit based protocol defined in flow_control.py:
+    it starts advertising args.credits credits, and acknowledges the
+    messages in batches once they are stored, granting the same amount
+    of credits back to the queue.
     """
 
     context = zmq.Context()
-    archiver = context.socket(zmq.PULL)
-    archiver.connect("tcp://localhost:12001")
+    archiver = context.socket(zmq.DEALER)
+    archiver.connect(args.queue_endpoint)
+
+    poller = zmq.Poller()
+    poller.register(archiver, zmq.POLLIN)
+
+    timeout = int(flow_control.HEARTBEAT_INTERVAL * 1000)
+    acks = []
+
+    # Latency of the messages carrying a trace frame
+    traces = tracing.TraceCollector()
+    next_report = time.time() + args.trace_report
+
+    def send_acks():
+        archiver.send_multipart(
+            [flow_control.CREDIT, str(len(acks))] + acks)
+        del acks[:]
+
+    archiver.send_multipart([flow_control.READY, str(args.credits)])
 
     try:
         with MessageProfiler(True) as mp:
             while True:
-                rkey, message = archiver.recv_multipart()
-                mp.msg_received(sys.getsizeof(rkey + message))
+                if traces.sequences.expected and time.time() >= next_report:
+                    logger.info('Trace report\n{0}'.format(traces.report()))
+                    traces.reset()
+                    next_report = time.time() + args.trace_report
+
+                if not poller.poll(timeout):
+                    # Idle: acknowledges what is left, or just heartbeats
+                    send_acks()
+                    continue
+
+                frames = archiver.recv_multipart()
+
+                if frames[0] == flow_control.RESET:
+                    # The queue doesn't know us anymore (it was restarted),
+                    # our pending messages will be delivered again
+                    logger.warning('Queue reset, sending READY again')
+                    del acks[:]
+                    archiver.send_multipart(
+                        [flow_control.READY, str(args.credits)])
+                    continue
+
+                _, seq, rkey, message = frames[:4]
+                mp.msg_received(len(rkey) + len(message))
+
+                # Optional trace frame, stamped at arrival
+                if len(frames) > 4:
+                    trace = tracing.stamp(frames[4])
+                else:
+                    trace = None
+
                 # print("Received message: [%s] RKEY: [%s]" % (message, rkey))
                 handle_message(message, rkey)
 
+                if trace is not None:
+                    mp.record_latency(traces.record(trace))
+
+                acks.append(seq)
+
+                # Acknowledges full batches, or whatever we have when
+                # there's nothing else waiting, to not stall the queue
+                if len(acks) >= args.ack_batch or not archiver.poll(0):
+                    send_acks()
+
     except Exception, e:
         archiver.close()
         context.term()
         raise e
 
+    finally:
+        if traces.sequences.expected:
+            logger.info('Trace report\n{0}'.format(traces.report()))
+
 if __name__ == '__main__':
     logger.info('Starting the Archiver')
     main()
@@ -6,40 +6,68 @@ This scripts implements a broker using ZeroMQ to receive and route messages.
 
 Example:
     Broker usage example as follows:
-    usage: python broker.py
+    usage: python broker.py [-i INCOMING] [-o OUTGOING]
+
+Arguments:
+  -i,  --incoming       endpoint where the feeders push the messages
+  -o,  --outgoing       endpoint where the queues subscribe
 
 """
 
 __author__ = "Nicolas Estrada"
 __version__ = "0.0.1"
 
-import sys
+import argparse
 
 import zmq
 
+import tracing
+
 from message_profiler import MessageProfiler
 
+parser = argparse.ArgumentParser(
+    description="""Broker that receives the messages of the feeders and
+    routes them to the subscribed queues.""",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument(
+    '-i',
+    '--incoming',
+    default='tcp://*:10001',
+    help='endpoint where the feeders push the messages')
+parser.add_argument(
+    '-o',
+    '--outgoing',
+    default='tcp://*:11001',
+    help='endpoint where the queues subscribe')
+
+args = parser.parse_args()
+
 # Getting context and defining bindings
 context = zmq.Context()
 
 rcv = context.socket(zmq.PULL)
 pub = context.socket(zmq.XPUB)
 
-rcv.bind("tcp://*:10001")
-pub.bind("tcp://*:11001")
+rcv.bind(args.incoming)
+pub.bind(args.outgoing)
 
 try:
     with MessageProfiler(True) as mp:
         # Broker (receive and deliver)
         while True:
-            rkey, message = rcv.recv_multipart()
-            bytes = sys.getsizeof(rkey + message)
+            frames = rcv.recv_multipart()
+            bytes = len(frames[0]) + len(frames[1])
             mp.msg_received(bytes)
 
+            # Optional trace frame
+            if len(frames) > 2:
+                frames[2] = tracing.stamp(frames[2])
+
             # print("Received and sending message [%s] RKEY: [%s]" % (message, rkey))
             # processing, persistence?, ACK handling ?
 
-            pub.send_multipart([rkey, message])
+            pub.send_multipart(frames)
             mp.msg_sent(bytes)
 except:
     rcv.close()
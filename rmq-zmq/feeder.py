@@ -5,6 +5,23 @@
 This scripts implements the feeders using ZeroMQ,
 that gets the data from MySQL dbs/shards and publish them to ZeroMQ broker.
 
+Each poller reads the new rows of a table incrementally: the rows are
+sorted by their last updated column (and id, to break ties), and each
+poll starts after the last row sent, the watermark. Rows are fetched in
+batches with keyset pagination (see Database.big_query), encoded as JSON
+and pushed to the broker; once a batch is sent, the watermark is saved
+in the recovery folder, so a restarted feeder goes on from there.
+
+Pollers are defined in the config file (config/feeders.yaml), and a
+sharded poller reads one shard (or all of them with -1) of a
+ShardedDatabase. The database can be SQLite instead of MySQL (a "sqlite"
+path in the database section, with {0} for the shard), i.e. for testing.
+
+Messages are (routing key, JSON) as the rest of the pipeline expects:
+
+    {"datetime": <last updated, ms>, "poller": "login", "shard": 3,
+     "data": {<row>}}
+
 usage: feeder.py [-h] [-cf CONFIG_FILE] -pn
                  {auditlog,login,transaction,mapping,check,media,report,fbuser}
                  [-sn {0,1,2,3,4,5,6,7}] [-lu LAST_UPDATED] [-n]
@@ -16,7 +33,7 @@ optional arguments:
 
   -cf CONFIG_FILE, --config_file CONFIG_FILE
                         config file to be used (default:
-                        /var/bi/feeders/config/feeders.yaml)
+                        feeders.yaml)
 
   -pn {auditlog,login,transaction,mapping,check,media,report,fbuser},
   --poller_name {auditlog,login,transaction,mapping,check,media,report,fbuser}
@@ -33,41 +50,381 @@ optional arguments:
 
   -n, --now             Use the actual UTC date. (default: False)
 
+  -e ENDPOINT, --endpoint ENDPOINT
+                        broker PULL endpoint
+
+  -b BATCH, --batch BATCH
+                        rows fetched (and sent) per batch
+
+  -o, --once            send what is new and exit
+
+  -t, --trace           add a trace frame (see tracing.py) to each message
+
 """
 
 __author__ = "Nicolas Estrada"
 __version__ = "0.0.1"
 
-import sys
+import os
+import json
 import time
+import argparse
+import calendar
+import datetime
+import decimal
 
 import zmq
 
+import tracing
+
 from message_profiler import MessageProfiler
+from python_utils import config_loader, logging_manager
+from python_utils.database import Database, ShardedDatabase, SQLiteDatabase
+from python_utils.jsonhandler import better_dumps
+
+POLLERS = ('auditlog', 'login', 'transaction', 'mapping', 'check', 'media',
+           'report', 'fbuser')
+SHARDS = range(8)
+NO_SHARD = -1
+
+DEFAULT_ENDPOINT = "tcp://localhost:10001"
+DEFAULT_INTERVAL = 5  # Seconds between polls once up to date
+DEFAULT_BATCH = 1000
+
+DATE_FORMAT = '%Y-%m-%d'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATETIME_FORMAT_MS = '%Y-%m-%d %H:%M:%S.%f'
+
+SCRIPT_DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="""Feeder that polls the new rows of a table (or of a
+        shard of it) and publishes them to the broker.""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        '-cf',
+        '--config_file',
+        default='feeders.yaml',
+        help='config file to be used')
+    parser.add_argument(
+        '-pn',
+        '--poller_name',
+        required=True,
+        choices=POLLERS,
+        help='poller name to be used')
+    parser.add_argument(
+        '-sn',
+        '--shard_number',
+        type=int,
+        default=NO_SHARD,
+        choices=[NO_SHARD] + SHARDS,
+        help="""shard number associated to the poller, required only if the
+        poller gets that from a sharded table (all of them if -1)""")
+    parser.add_argument(
+        '-lu',
+        '--last_updated',
+        help="""string datetime in UTC to be used as start point, not
+        required (default look in recovery)""")
+    parser.add_argument(
+        '-n',
+        '--now',
+        action='store_true',
+        help='Use the actual UTC date.')
+    parser.add_argument(
+        '-e',
+        '--endpoint',
+        default=DEFAULT_ENDPOINT,
+        help='broker endpoint')
+    parser.add_argument(
+        '-b',
+        '--batch',
+        type=int,
+        default=DEFAULT_BATCH,
+        help='rows fetched (and sent) per batch')
+    parser.add_argument(
+        '-o',
+        '--once',
+        action='store_true',
+        help='send what is new and exit')
+    parser.add_argument(
+        '-t',
+        '--trace',
+        action='store_true',
+        help='add a trace frame to each message')
+
+    args = parser.parse_args()
+
+    logger = logging_manager.start_logger(
+        'feeder-{0}'.format(args.poller_name),
+        use_root_logger=False)
+
+    config = config_loader.load(args.config_file, section='default')
+
+
+#
+# Watermarks
+#
+
+def encode_value(value):
+    """JSON friendly value of a column, keeping datetimes, dates and
+    decimals as such"""
+
+    if isinstance(value, datetime.datetime):
+        return {"datetime": value.strftime(DATETIME_FORMAT_MS)}
+    if isinstance(value, datetime.date):
+        return {"date": value.strftime(DATE_FORMAT)}
+    if isinstance(value, decimal.Decimal):
+        return {"decimal": str(value)}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        if 'datetime' in value:
+            return parse_datetime(value['datetime'])
+        if 'date' in value:
+            return datetime.datetime.strptime(value['date'], DATE_FORMAT).date()
+        if 'decimal' in value:
+            return decimal.Decimal(value['decimal'])
+    return value
+
+
+def parse_datetime(value):
+    for datetime_format in (DATETIME_FORMAT_MS, DATETIME_FORMAT):
+        try:
+            return datetime.datetime.strptime(value, datetime_format)
+        except ValueError:
+            continue
+
+    raise ValueError("Invalid datetime {0}, use YYYY-MM-DD HH:MM:SS".format(value))
+
+
+class Watermark(object):
+    """Last (updated, id) sent of a poller and shard, saved in a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.value = None
+
+    def load(self):
+        try:
+            with open(self.path) as recovery:
+                self.value = [decode_value(value) for value in json.load(recovery)]
+        except IOError:
+            self.value = None
+
+        return self.value
+
+    def save(self, value):
+        self.value = list(value)
+
+        # Written aside and renamed, a crash never leaves half a file
+        temporary = self.path + '.tmp'
+
+        with open(temporary, 'w') as recovery:
+            json.dump([encode_value(value) for value in self.value], recovery)
+
+        os.rename(temporary, self.path)
+
+
+#
+# Polling
+#
+
+def open_databases(poller, shards):
+    """{shard: Database} of the poller, NO_SHARD for non sharded ones"""
+
+    database = config['database']
+
+    if not poller.get('sharded'):
+        if 'sqlite' in database:
+            return {NO_SHARD: SQLiteDatabase(database['sqlite'].format(''))}
+
+        return {NO_SHARD: Database(
+            host=database['host'],
+            port=database.get('port', 3306),
+            dbname=database['dbname'],
+            username=database['username'],
+            password=database.get('password', ''))}
+
+    if 'sqlite' in database:
+        sharded = ShardedDatabase.from_databases(dict(
+            (shard, SQLiteDatabase(database['sqlite'].format(shard)))
+            for shard in shards))
+    else:
+        sharded = ShardedDatabase(
+            host_template=database['host_template'],
+            port=database.get('port', 3306),
+            db_template=database['db_template'],
+            shardids=shards,
+            username=database['username'],
+            password=database.get('password', ''))
+
+    return sharded.dbs
+
+
+def row_datetime(value):
+    """Milliseconds of the last updated value of a row, which is in UTC
+    (the archiver buckets the messages by it)"""
+
+    if isinstance(value, basestring):
+        value = parse_datetime(value)
+
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+    if isinstance(value, datetime.date):
+        return calendar.timegm(value.timetuple()) * 1000
+    return value
+
+
+class Poller(object):
+
+    def __init__(self, name, definition, shard, database, watermark):
+        self.name = name
+        self.shard = shard
+        self.database = database
+        self.watermark = watermark
+
+        self.table = definition.get('table', name)
+        self.updated = definition.get('updated_column', 'last_updated')
+        self.id = definition.get('id_column', 'id')
+        self.columns = definition.get('columns', '*')
+        self.where = definition.get('where')
+        self.routing_key = str(definition.get('routing_key', 'feeder.{0}'.format(name)))
+
+        # Names of the key columns in the rows, as in Database.keyset_query
+        self.fields = [column.split('.')[-1].strip('`') for column in (self.updated, self.id)]
+
+    def batches(self, batchsize, since=None):
+        """Batches of rows after the watermark (or updated since the given
+        datetime if there's no watermark yet)"""
+
+        query = "SELECT {0} FROM {1}".format(self.columns, self.table)
+        conditions = []
+        data = []
+
+        if self.where:
+            conditions.append("({0})".format(self.where))
+
+        if self.watermark.value is None and since is not None:
+            conditions.append("{0} >= %s".format(self.updated))
+            data.append(since)
+
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        return self.database.big_query(
+            query,
+            data or None,
+            batchsize,
+            key=(self.updated, self.id),
+            start=self.watermark.value)
+
+    def encode(self, row):
+        return better_dumps({
+            "datetime": row_datetime(row[self.fields[0]]),
+            "poller": self.name,
+            "shard": self.shard,
+            "data": row
+        })
+
+
+def send_batch(socket, poller, rows, mp, origin, sequence):
+    """Sends a batch of rows to the broker, returns the new sequence"""
+
+    for row in rows:
+        body = poller.encode(row)
+
+        if args.trace:
+            frames = [poller.routing_key, body, tracing.new_trace(origin, sequence)]
+        else:
+            frames = [poller.routing_key, body]
+
+        socket.send_multipart(frames)
+        mp.msg_sent(len(poller.routing_key) + len(body))
+        sequence += 1
+
+    return sequence
+
+
+def start_point():
+    if args.last_updated:
+        return parse_datetime(args.last_updated)
+    if args.now:
+        return datetime.datetime.utcnow()
+    return None
+
+
+def main():
+    definition = config['pollers'][args.poller_name]
+
+    if definition.get('sharded'):
+        shards = SHARDS if args.shard_number == NO_SHARD else [args.shard_number]
+    else:
+        shards = [NO_SHARD]
+
+    recovery_path = os.path.join(SCRIPT_DIRNAME, config.get('recovery_path', 'recovery'))
+    if not os.path.isdir(recovery_path):
+        os.makedirs(recovery_path)
+
+    databases = open_databases(definition, shards)
+    since = start_point()
+    pollers = []
+
+    for shard in shards:
+        watermark = Watermark(os.path.join(
+            recovery_path, '{0}-{1}.json'.format(args.poller_name, shard)))
+
+        # An explicit start point wins over the recovery
+        if since is None:
+            watermark.load()
+
+        pollers.append(Poller(args.poller_name, definition, shard, databases[shard], watermark))
+
+        logger.info("Polling {0} (shard {1}) after {2}".format(
+            args.poller_name, shard, watermark.value or since))
+
+    interval = definition.get('interval', DEFAULT_INTERVAL)
+
+    context = zmq.Context()
+    feeder = context.socket(zmq.PUSH)
+    # Pending messages are delivered before closing
+    feeder.setsockopt(zmq.LINGER, -1)
+    feeder.connect(args.endpoint)
+
+    origin = os.getpid()
+    sequence = 0
+
+    try:
+        with MessageProfiler(True) as mp:
+            while True:
+                # Each poll goes on until the shard is up to date
+                for poller in pollers:
+                    for rows in poller.batches(args.batch, since):
+                        sequence = send_batch(feeder, poller, rows, mp, origin, sequence)
+
+                        poller.watermark.save([rows[-1][field] for field in poller.fields])
+
+                        logger.debug("{0} rows of shard {1} sent, up to {2}".format(
+                            len(rows), poller.shard, poller.watermark.value))
+
+                if args.once:
+                    break
+
+                time.sleep(interval)
+
+    except KeyboardInterrupt:
+        logger.info("Keyboard Interrupt... finishing")
+
+    finally:
+        feeder.close()
+        context.term()
+
 
-# Connecting ...
-context = zmq.Context()
-feeder = context.socket(zmq.PUSH)
-feeder.connect("tcp://localhost:10001")
-
-
-# @profile
-def send_message(socket, rkey, message):
-  socket.send_multipart([rkey, message])
-  return
-
-
-try:
-    with MessageProfiler(True) as mp:
-        rkey = 'routing_key.example'
-        message = '{"datetime": 1234567890123, "data": "LOTS_OF_DATA_INSIDE_LARGE_STRING"}'
-        size_str = sys.getsizeof(rkey + message)
-        while True:
-            # feeder.send_multipart([rkey, message])
-            send_message(feeder, rkey, message)
-            mp.msg_sent(size_str)
-            # print("Sent message [%s] RKEY: [%s]" % (message, rkey))
-            time.sleep(0.00001)
-except:
-    feeder.close()
-    context.term()
+if __name__ == '__main__':
+    logger.info('Starting the Feeder')
+    main()
+    logger.info('Feeder finished')
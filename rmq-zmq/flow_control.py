@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Flow control documentation.
+
+This module defines the credit based protocol used between the queues
+(ROUTER socket) and the archivers (DEALER sockets).
+
+Protocol:
+    Archiver -> Queue:
+        [READY, credits]                archiver (re)joins with a window
+        [CREDIT, credits, seq, ...]     acknowledges the stored sequence
+                                        numbers, each one giving back its
+                                        credit (credits is the amount of
+                                        them). With no sequences it works
+                                        as a heartbeat.
+
+    Queue -> Archiver:
+        [MESSAGE, seq, rkey, message]   one delivery, consuming one credit
+        [RESET]                         the queue doesn't know the archiver
+                                        (i.e. the queue was restarted), the
+                                        archiver must send READY again
+
+A queue only delivers to archivers with available credits, and keeps every
+delivered message until it's acknowledged. If an archiver goes silent for
+more than HEARTBEAT_TIMEOUT seconds, its unacknowledged messages are
+delivered again to the remaining archivers (at-least-once delivery).
+
+"""
+
+__author__ = "Nicolas Estrada"
+__version__ = "0.0.1"
+
+import time
+
+from collections import deque
+
+READY = b'\x01'
+CREDIT = b'\x02'
+MESSAGE = b'\x03'
+RESET = b'\x04'
+
+DEFAULT_CREDITS = 100
+DEFAULT_ACK_BATCH = 10
+
+# Seconds
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 5.0
+
+
+class Peer(object):
+    """State of one archiver as seen by the queue"""
+
+    def __init__(self, identity, credits=0):
+        self.identity = identity
+        self.credits = credits
+        self.inflight = {}
+        self.last_seen = time.time()
+
+
+class CreditDispatcher(object):
+    """Keeps the credits and the unacknowledged messages of every archiver
+    connected to a queue, choosing the destination of each message.
+
+    Messages are given to the archivers in a round robin fashion, but only
+    to the ones with available credits, so a slow archiver stops receiving
+    messages as soon as it runs out of credits.
+    """
+
+    def __init__(self, heartbeat_timeout=HEARTBEAT_TIMEOUT):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.peers = {}
+        self.ready = deque()
+        self.pending = deque()
+        self.seq = 0
+
+    def has_credits(self):
+        return bool(self.ready)
+
+    def ready_peer(self, identity, credits):
+        """Registers a (possibly restarted) archiver"""
+
+        if identity in self.peers:
+            self.drop_peer(identity)
+
+        peer = self.peers[identity] = Peer(identity, credits)
+
+        if credits > 0:
+            self.ready.append(identity)
+
+        return peer
+
+    def credit_peer(self, identity, acks):
+        """Acknowledges messages of a known archiver, giving back a credit
+        for each one that was in flight: duplicated or stale acks (i.e. of
+        messages already delivered again) don't grow its window.
+
+        Returns False if the archiver is unknown.
+        """
+
+        peer = self.peers.get(identity)
+
+        if peer is None:
+            return False
+
+        peer.last_seen = time.time()
+        credits = 0
+
+        for seq in acks:
+            if peer.inflight.pop(seq, None) is not None:
+                credits += 1
+
+        if credits > 0:
+            if peer.credits <= 0:
+                self.ready.append(identity)
+
+            peer.credits += credits
+
+        return True
+
+    def drop_peer(self, identity):
+        """Forgets an archiver, delivering again its unacknowledged messages"""
+
+        peer = self.peers.pop(identity)
+
+        try:
+            self.ready.remove(identity)
+        except ValueError:
+            pass
+
+        # Older sequences first, before any new message
+        for seq in sorted(peer.inflight, key=int, reverse=True):
+            self.pending.appendleft(peer.inflight[seq])
+
+        return len(peer.inflight)
+
+    def expire_peers(self):
+        """Drops the archivers that were silent for too long"""
+
+        limit = time.time() - self.heartbeat_timeout
+        expired = [identity for identity, peer in self.peers.iteritems()
+                   if peer.last_seen < limit]
+
+        return [(identity, self.drop_peer(identity)) for identity in expired]
+
+    def next_delivery(self, frames):
+        """Assigns a message (list of frames) to an archiver with credits.
+
+        Returns the identity, the sequence number and the frames, or None
+        when no archiver has credits (the message is kept as pending).
+        """
+
+        if not self.ready:
+            self.pending.append(frames)
+            return None
+
+        identity = self.ready.popleft()
+        peer = self.peers[identity]
+
+        self.seq += 1
+        seq = str(self.seq)
+
+        peer.inflight[seq] = frames
+        peer.credits -= 1
+
+        if peer.credits > 0:
+            self.ready.append(identity)
+
+        return identity, seq, frames
+
+    def next_pending(self):
+        """Like next_delivery, but for the messages waiting for credits"""
+
+        if self.pending and self.ready:
+            return self.next_delivery(self.pending.popleft())
+
+        return None
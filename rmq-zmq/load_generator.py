@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load generator documentation.
+
+This scripts implements a configurable load generator using ZeroMQ, that
+publishes messages to the broker with a target rate, message sizes,
+routing keys and payloads resembling the production traffic.
+
+The pacing is open loop: each message has a scheduled send time derived
+from the rate profile, and the generator never waits for the previous
+message to "catch up", so a slow broker shows up as lag instead of
+silently lowering the offered load.
+
+Example:
+    Load generator usage example as follows:
+    usage: python load_generator.py -r 20000 -d 60 -s lognormal:6:0.5
+                                    -k routing_key.example:0.8,login:0.2
+
+Arguments:
+  -e,  --endpoint       broker PULL endpoint
+  -r,  --rate           target rate in msg/s for the whole generator, of
+                            the constant profile (0 = as fast as possible)
+  -pr, --profile        rate profile: constant, ramp:FROM:TO:SECONDS or
+                            step:RATE@SECONDS,RATE@SECONDS,... (a rate
+                            of 0 pauses the ramps and steps)
+  -d,  --duration       seconds to run (0 = forever)
+  -n,  --count          messages to send per worker (0 = no limit)
+  -s,  --size           message size distribution: fixed:BYTES,
+                            uniform:MIN:MAX, normal:MEAN:STD,
+                            lognormal:MU:SIGMA or empirical (the size of
+                            the sampled payloads)
+  -k,  --routing_keys   routing keys mix: KEY[:WEIGHT],KEY[:WEIGHT],...
+  -pf, --payload_files  archived files to sample payloads (and routing keys)
+  -ru, --rules          validation rules used to generate payloads
+  -p,  --processes      worker processes
+  -so, --sockets        sockets per worker process
+  -ps, --pool_size      amount of pre-generated messages per worker
+  -t,  --trace          add a trace frame (see tracing.py) to each message
+
+"""
+
+from __future__ import division
+
+__author__ = "Nicolas Estrada"
+__version__ = "0.0.1"
+
+import os
+import json
+import time
+import random
+import string
+import argparse
+import multiprocessing
+
+import zmq
+import msgpack
+
+import tracing
+
+from message_profiler import MessageProfiler
+from python_utils import config_loader, file_utils
+
+DEFAULT_ENDPOINT = "tcp://localhost:10001"
+DEFAULT_ROUTING_KEY = 'routing_key.example'
+DEFAULT_MESSAGE = {
+    "datetime": 1234567890123,
+    "data": "LOTS_OF_DATA_INSIDE_LARGE_STRING"
+}
+
+RULES_PATH = 'validation/rules/'
+
+# Closer than this to the next deadline we spin instead of sleeping,
+# time.sleep() granularity is too coarse for high rates
+SPIN_THRESHOLD = 0.002
+
+# How often (in seconds) the rate profile and the duration are checked
+PROFILE_CHECK = 0.05
+
+
+#
+# Rate profiles
+#
+
+def constant_profile(rate):
+    def profile(elapsed):
+        return rate
+    return profile
+
+
+def ramp_profile(start_rate, end_rate, seconds):
+    def profile(elapsed):
+        if elapsed >= seconds:
+            return end_rate
+        return start_rate + (end_rate - start_rate) * elapsed / seconds
+    return profile
+
+
+def step_profile(steps):
+    def profile(elapsed):
+        for rate, until in steps:
+            if elapsed < until:
+                return rate
+        return steps[-1][0]
+    return profile
+
+
+def parse_profile(definition, rate):
+    """Returns a function that gives the target rate (msg/s) for the
+    elapsed seconds since the start. Only the constant profile with a
+    rate of 0 is unpaced (the rate is None), a rate of 0 given by the
+    other profiles is a pause.
+    """
+
+    kind, _, params = definition.partition(':')
+
+    if kind == 'constant':
+        return constant_profile(rate or None)
+    elif kind == 'ramp':
+        start_rate, end_rate, seconds = params.split(':')
+        return ramp_profile(float(start_rate), float(end_rate), float(seconds))
+    elif kind == 'step':
+        steps = []
+        until = 0
+
+        for step in params.split(','):
+            step_rate, seconds = step.split('@')
+            until += float(seconds)
+            steps.append((float(step_rate), until))
+
+        return step_profile(steps)
+    else:
+        raise ValueError("Profile '{0}' is not valid".format(definition))
+
+
+#
+# Message sizes
+#
+
+def parse_size(definition):
+    """Returns a function that gives a message size (bytes) per call, or
+    None if the payloads should keep their own size.
+    """
+
+    kind, _, params = definition.partition(':')
+    values = [float(value) for value in params.split(':') if value]
+
+    if kind == 'empirical':
+        return None
+    elif kind == 'fixed':
+        return lambda: int(values[0])
+    elif kind == 'uniform':
+        return lambda: int(random.uniform(*values))
+    elif kind == 'normal':
+        return lambda: max(1, int(random.normalvariate(*values)))
+    elif kind == 'lognormal':
+        return lambda: max(1, int(random.lognormvariate(*values)))
+    else:
+        raise ValueError("Size distribution '{0}' is not valid".format(
+            definition))
+
+
+def parse_routing_keys(definition):
+    """Parses KEY[:WEIGHT],... returning (keys, cumulative weights)"""
+
+    keys = []
+    weights = []
+
+    for item in definition.split(','):
+        key, _, weight = item.partition(':')
+        keys.append(key)
+        weights.append(float(weight) if weight else 1.0)
+
+    total = sum(weights)
+    cumulative = []
+    accumulated = 0
+
+    for weight in weights:
+        accumulated += weight
+        cumulative.append(accumulated / total)
+
+    return keys, cumulative
+
+
+def weighted_choice(keys, cumulative):
+    point = random.random()
+
+    for key, limit in zip(keys, cumulative):
+        if point < limit:
+            return key
+
+    return keys[-1]
+
+
+#
+# Payloads
+#
+
+def random_string(size):
+    return ''.join(random.choice(string.ascii_letters) for _ in xrange(size))
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+FIELD_GENERATORS = {
+    'datetime': lambda options: _now_ms() - random.randint(0, 3600000),
+    'userid': lambda options: random.randint(1, 200000000),
+    'userids': lambda options: [random.randint(1, 200000000)
+                                for _ in xrange(random.randint(1, 10))],
+    'integer': lambda options: random.randint(0, 100000),
+    'points': lambda options: random.randint(-1000, 1000),
+    'bid': lambda options: random.randint(0, 100000),
+    'string': lambda options: random_string(random.randint(4, 32)),
+    'boolean': lambda options: random.choice((True, False)),
+    'latitude': lambda options: random.uniform(-80, 80),
+    'longitude': lambda options: random.uniform(-179, 179),
+    'location_string': lambda options: 'Santiago, RM, CL',
+    'birthday': lambda options: _now_ms() - random.randint(14, 80) * 31536000000,
+    'ui': lambda options: random.choice((
+        'Android SKOUT 3.1.0', 'iPhone SKOUT 3.0.1', 'Freya 3.0.0')),
+    'useragent': lambda options: ''.join(
+        random.choice('0123456789abcdef') for _ in xrange(40)),
+    'deviceid': lambda options: ''.join(
+        random.choice('0123456789abcdef') for _ in xrange(40)),
+    'device_type': lambda options: random.choice(('android', 'iphone', 'web')),
+    'device': lambda options: {
+        'model': 'Nexus 5', 'version': '4.4.2', 'brand': 'LGE'},
+    'dictionary': lambda options: {'key': random_string(8)},
+    'buzz_filtertype': lambda options: random.choice(
+        ('local', 'favorites', 'friends')),
+    'pushtype': lambda options: random.randint(0, 99),
+    'passport_source': lambda options: random.choice(
+        ('profile', 'meet', 'buzz', 'other', 'popular', 'search')),
+    'enum': lambda options: random.choice(options),
+}
+
+
+def rules_generator(rules):
+    """Returns a function that creates messages following the
+    validations defined in a rules file (see validation/rules/).
+    """
+
+    fields = []
+
+    for field, definition in rules['validations'].items():
+        options = None
+
+        if isinstance(definition, dict):
+            field_type = definition.get('type')
+            options = definition.get('options')
+
+            # Dependent enums are defined as {parent: [childs]}
+            if isinstance(options, dict):
+                options = sorted(set(
+                    child for childs in options.values() for child in childs))
+        else:
+            field_type = definition
+
+        if field_type in FIELD_GENERATORS:
+            fields.append((field, FIELD_GENERATORS[field_type], options))
+
+    def generate():
+        return dict(
+            (field, generator(options))
+            for field, generator, options in fields)
+
+    return generate
+
+
+def read_archived(paths, limit):
+    """Reads (routing key, message) pairs from archived files, as written
+    by the archiver (one {"rk": [...], "dt": ..., "msg": ...} per line).
+    """
+
+    samples = []
+
+    for path in paths:
+        if path.endswith('.msgpack'):
+            with open(path, 'rb') as file_r:
+                records = [record for record in msgpack.Unpacker(file_r)
+                           if isinstance(record, dict)]
+        else:
+            records = (json.loads(line) for line in file_utils.get_lines(path)
+                       if line.strip())
+
+        for record in records:
+            samples.append(('.'.join(record['rk']), record['msg']))
+
+            if len(samples) >= limit:
+                return samples
+
+    return samples
+
+
+def pad_message(message, size):
+    """Serializes a message adding (or trimming) a 'data' field to get
+    approximately 'size' bytes.
+    """
+
+    message = dict(message)
+    message['data'] = ''
+    body = json.dumps(message)
+    missing = size - len(body)
+
+    if missing > 0:
+        message['data'] = random_string(missing)
+        body = json.dumps(message)
+
+    return body
+
+
+def build_pool(args):
+    """Pre-generates the messages (rkey, body) to be sent, so the sending
+    loop doesn't pay for the serialization.
+    """
+
+    size = parse_size(args.size)
+    keys, cumulative = parse_routing_keys(args.routing_keys)
+
+    if args.payload_files:
+        samples = read_archived(args.payload_files, args.pool_size)
+        if not samples:
+            raise ValueError("No payloads found in {0}".format(
+                args.payload_files))
+        generate = None
+    elif args.rules:
+        rules = config_loader.load(
+            '{0}.yaml'.format(args.rules),
+            config_path=RULES_PATH)
+        generate = rules_generator(rules)
+    else:
+        generate = lambda: DEFAULT_MESSAGE
+
+    pool = []
+
+    for i in xrange(args.pool_size):
+        if generate is None:
+            rkey, message = samples[i % len(samples)]
+
+            # Keeps the archived routing keys unless a mix was given
+            if args.routing_keys != DEFAULT_ROUTING_KEY:
+                rkey = weighted_choice(keys, cumulative)
+        else:
+            rkey, message = weighted_choice(keys, cumulative), generate()
+
+        if size is None:
+            body = json.dumps(message)
+        else:
+            body = pad_message(message, size())
+
+        pool.append((str(rkey), body))
+
+    return pool
+
+
+#
+# Sending
+#
+
+def worker(args, worker_id, rate_share):
+    """Sends the messages of one process, pacing them across its sockets"""
+
+    random.seed(os.getpid() ^ int(time.time()))
+
+    pool = build_pool(args)
+    pool_size = len(pool)
+
+    context = zmq.Context()
+    sockets = []
+
+    for _ in xrange(args.sockets):
+        socket = context.socket(zmq.PUSH)
+        socket.connect(args.endpoint)
+        sockets.append(socket)
+
+    socket_count = len(sockets)
+    profile = parse_profile(args.profile, args.rate)
+    origin = os.getpid()
+
+    try:
+        with MessageProfiler(True) as mp:
+            start = next_send = next_check = time.time()
+            rate = 0
+            last_send = None
+            sent = 0
+            max_lag = 0
+
+            while True:
+                now = time.time()
+
+                if now >= next_check:
+                    elapsed = now - start
+
+                    if args.duration and elapsed >= args.duration:
+                        break
+
+                    new_rate = profile(elapsed)
+                    if new_rate is not None:
+                        new_rate *= rate_share
+
+                    if rate == 0 and new_rate:
+                        # Back from a pause, nothing was due meanwhile
+                        next_send = now
+                    elif new_rate != rate and new_rate and next_send > now:
+                        # The next deadline follows the new rate (a backlog
+                        # is kept, it's sent at the new rate)
+                        if last_send is None:
+                            next_send = now
+                        else:
+                            next_send = max(now, last_send + 1 / new_rate)
+
+                    rate = new_rate
+                    next_check = now + PROFILE_CHECK
+
+                if args.count and sent >= args.count:
+                    break
+
+                if rate == 0:
+                    # Paused until the profile gives a rate again
+                    time.sleep(max(0, next_check - now))
+                    continue
+
+                if rate is not None:
+                    if next_send > next_check:
+                        # The rate (or the duration) may change before the
+                        # deadline of this message, it's checked first
+                        time.sleep(max(0, next_check - now))
+                        continue
+
+                    # Open loop: wait for the deadline of this message
+                    wait = next_send - now
+
+                    if wait > SPIN_THRESHOLD:
+                        time.sleep(wait - SPIN_THRESHOLD)
+
+                    while time.time() < next_send:
+                        pass
+
+                    max_lag = max(max_lag, now - next_send)
+                    last_send = next_send
+                    next_send += 1 / rate
+
+                rkey, body = pool[sent % pool_size]
+
+                if args.trace:
+                    frames = [rkey, body, tracing.new_trace(origin, sent)]
+                else:
+                    frames = [rkey, body]
+
+                sockets[sent % socket_count].send_multipart(frames)
+                mp.msg_sent(len(rkey) + len(body))
+
+                sent += 1
+
+            print "Worker {0}: {1} messages, max lag {2:.4f} s".format(
+                worker_id, sent, max_lag)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        for socket in sockets:
+            socket.close()
+        context.term()
+
+
+def run(args):
+    if args.processes == 1:
+        worker(args, 0, 1)
+        return
+
+    rate_share = 1 / args.processes
+    processes = [
+        multiprocessing.Process(target=worker, args=(args, i, rate_share))
+        for i in xrange(args.processes)]
+
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="""Load generator that publishes messages to the
+        broker with a given rate profile, sizes and routing keys.""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        '-e',
+        '--endpoint',
+        default=DEFAULT_ENDPOINT,
+        help='broker endpoint')
+    parser.add_argument(
+        '-r',
+        '--rate',
+        type=float,
+        default=0,
+        help='target rate in msg/s of the constant profile (0 = as fast '
+             'as possible)')
+    parser.add_argument(
+        '-pr',
+        '--profile',
+        default='constant',
+        help='rate profile: constant, ramp:FROM:TO:SECONDS or '
+             'step:RATE@SECONDS,... (a rate of 0 pauses the ramps and '
+             'steps)')
+    parser.add_argument(
+        '-d',
+        '--duration',
+        type=float,
+        default=0,
+        help='seconds to run (0 = forever)')
+    parser.add_argument(
+        '-n',
+        '--count',
+        type=int,
+        default=0,
+        help='messages to send per worker (0 = no limit)')
+    parser.add_argument(
+        '-s',
+        '--size',
+        default='empirical',
+        help='size distribution: fixed:B, uniform:MIN:MAX, normal:MEAN:STD, '
+             'lognormal:MU:SIGMA or empirical')
+    parser.add_argument(
+        '-k',
+        '--routing_keys',
+        default=DEFAULT_ROUTING_KEY,
+        help='routing keys mix: KEY[:WEIGHT],...')
+
+    payloads = parser.add_mutually_exclusive_group()
+    payloads.add_argument(
+        '-pf',
+        '--payload_files',
+        nargs='+',
+        help='archived files used to sample payloads')
+    payloads.add_argument(
+        '-ru',
+        '--rules',
+        help='rules used to generate payloads')
+
+    parser.add_argument(
+        '-p',
+        '--processes',
+        type=int,
+        default=1,
+        help='worker processes')
+    parser.add_argument(
+        '-so',
+        '--sockets',
+        type=int,
+        default=1,
+        help='sockets per worker process')
+    parser.add_argument(
+        '-ps',
+        '--pool_size',
+        type=int,
+        default=1000,
+        help='pre-generated messages per worker')
+    parser.add_argument(
+        '-t',
+        '--trace',
+        action='store_true',
+        help='add a trace frame to each message')
+
+    return parser
+
+
+if __name__ == '__main__':
+    run(build_parser().parse_args())
@@ -1,4 +1,40 @@
+"""Message profiler.
+
+Counts messages and bytes going in and out of a process, plus latencies
+recorded in an HDR histogram (see histogram.py).
+
+Besides the totals printed when the profiler exits, it can report the
+stats of each interval every N seconds (one JSON object per line) to a
+file or to a ZeroMQ endpoint (a PUB socket connects to it). The interval
+and the output default to the PROFILER_INTERVAL and PROFILER_OUTPUT
+environment variables, so any process can enable them without changes.
+
+Live metrics (interval stats plus gauges such as queue depths, and the
+process RSS, CPU and GC stats) can also be published on a PUB socket
+bound by the process, see metrics.py and METRICS_ENDPOINT.
+
+SIGTERM is turned into SystemExit while the profiler is active (unless
+the process already handles it), so the final report is flushed when a
+process running an infinite loop is terminated.
+
+The stack sampler (see sampler.py) is installed too, so any process can
+be CPU profiled with SIGUSR2.
+
+"""
+
+from __future__ import division
+
+import os
+import sys
+import json
 import time
+import signal
+import threading
+
+import metrics
+import sampler
+
+from histogram import Histogram, DEFAULT_PERCENTILES
 
 # LOG_STR = ("Elapsed time: {0} ms | Messages received: {1} | "
 #            "Messages sent: {2} | Bytes in: {3} | Bytes out: {4} | "
@@ -7,20 +43,138 @@ import time
 
 LOG_STR = "{0}, {1}, {2}, {3}, {4}, {5}, {6}, {7}, {8}"
 
+ZMQ_SCHEMES = ('tcp://', 'ipc://', 'inproc://', 'pgm://', 'epgm://')
+
+
+def latency_stats(histogram):
+    stats = dict(
+        ("p{0}".format(percentile), value)
+        for percentile, value
+        in histogram.percentiles(DEFAULT_PERCENTILES).iteritems())
+    stats["count"] = histogram.total_count
+    stats["max"] = histogram.max
+    return stats
+
+
+def _sigterm_handler(signum, frame):
+    # Further SIGTERMs (i.e. sent to the whole process group) must not
+    # interrupt the final flush
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(128 + signum)
+
+
+class ReportOutput(object):
+    """Destination of the interval reports: a file path (lines are
+    appended), a ZeroMQ endpoint, or stdout when no output is given.
+    """
+
+    def __init__(self, output=None):
+        self.output = output
+        self.socket = None
+        self.file = None
+
+        if output is None:
+            return
+
+        if output.startswith(ZMQ_SCHEMES):
+            import zmq
+
+            self.socket = zmq.Context.instance().socket(zmq.PUB)
+            self.socket.setsockopt(zmq.LINGER, 1000)
+            self.socket.connect(output)
+        else:
+            self.file = open(output, 'a')
+
+    def write(self, line):
+        if self.socket is not None:
+            self.socket.send(line)
+        elif self.file is not None:
+            self.file.write(line + '\n')
+            self.file.flush()
+        else:
+            print line
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+        elif self.file is not None:
+            self.file.close()
+
 
 class MessageProfiler(object):
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, name=None, interval=None, output=None,
+                 metrics=None):
         self.verbose = verbose
+        self.name = name or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+        if interval is None:
+            interval = float(os.environ.get('PROFILER_INTERVAL', 0))
+        if output is None:
+            output = os.environ.get('PROFILER_OUTPUT')
+        if metrics is None:
+            metrics = os.environ.get('METRICS_ENDPOINT')
+
+        self.interval = interval
+        self.output = output
+        self.metrics = metrics
+        self.gauges = {}
 
     def __enter__(self):
-        self.start = time.time()
+        self.start = self.interval_start = time.time()
         self.count_in = 0
         self.count_out = 0
         self.bytes_in = 0
         self.bytes_out = 0
+
+        # Values at the start of the current interval
+        self.last = (0, 0, 0, 0)
+
+        self.latency = Histogram()
+        self.interval_latency = Histogram()
+
+        self.outputs = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.reporter = None
+        self.previous_sigterm = None
+
+        report_interval = self.interval
+
+        if self.interval > 0:
+            self.outputs.append(ReportOutput(self.output))
+
+        if self.metrics:
+            self.outputs.append(
+                metrics.MetricsPublisher(self.metrics, self.name))
+
+            if not report_interval:
+                report_interval = float(os.environ.get(
+                    'METRICS_INTERVAL', metrics.DEFAULT_INTERVAL))
+
+        # Signal handlers can only be set from the main thread
+        if (isinstance(threading.current_thread(), threading._MainThread)
+                and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL):
+            self.previous_sigterm = signal.signal(
+                signal.SIGTERM, _sigterm_handler)
+
+        self.stack_sampler = sampler.install(self.name)
+
+        if self.outputs:
+            self.reporter = threading.Thread(
+                target=self._report_loop, args=(report_interval, ))
+            self.reporter.daemon = True
+            self.reporter.start()
+
         return self
 
     def __exit__(self, *args):
+        if self.reporter is not None:
+            self.stopped.set()
+            self.reporter.join()
+
+        # Writes the stacks of an ongoing sampling window
+        self.stack_sampler.stop()
+
         self.end = time.time()
         self.secs = self.end - self.start
         self.msecs = self.secs * 1000  # millisecs
@@ -28,6 +182,18 @@ class MessageProfiler(object):
         self.bratio_in = float(self.bytes_in / self.secs)
         self.ratio_out = float(self.count_out / self.secs)
         self.bratio_out = float(self.bytes_out / self.secs)
+
+        # Final flush of the last (partial) interval, plus the latency
+        # percentiles of the whole run
+        if self.outputs:
+            self.report(final=True)
+
+        for output in self.outputs:
+            output.close()
+
+        if self.previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, self.previous_sigterm)
+
         if self.verbose:
             msg = LOG_STR.format(
                 self.msecs, self.count_in, self.count_out,
@@ -41,4 +207,74 @@ class MessageProfiler(object):
 
     def msg_sent(self, bytes):
         self.count_out += 1
-        self.bytes_out += bytes
\ No newline at end of file
+        self.bytes_out += bytes
+
+    def record_latency(self, seconds):
+        micros = seconds * 1000000
+        self.latency.record(micros)
+        self.interval_latency.record(micros)
+
+    def gauge(self, name, value):
+        """Sets an instantaneous value (i.e. a queue depth) to be reported"""
+        self.gauges[name] = value
+
+    def _report_loop(self, interval):
+        while not self.stopped.wait(interval):
+            self.report()
+
+    def interval_stats(self):
+        """Returns the stats of the interval since the last call, starting
+        a new one.
+        """
+
+        with self.lock:
+            now = time.time()
+            current = (self.count_in, self.count_out,
+                       self.bytes_in, self.bytes_out)
+            latency, self.interval_latency = self.interval_latency, Histogram()
+
+            count_in, count_out, bytes_in, bytes_out = [
+                value - last for value, last in zip(current, self.last)]
+            secs = (now - self.interval_start) or 1e-9
+
+            self.last = current
+            self.interval_start = now
+
+        stats = {
+            "name": self.name,
+            "pid": os.getpid(),
+            "ts": now,
+            "secs": secs,
+            "count_in": count_in,
+            "count_out": count_out,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "ratio_in": count_in / secs,
+            "ratio_out": count_out / secs,
+            "bratio_in": bytes_in / secs,
+            "bratio_out": bytes_out / secs,
+            "total_in": current[0],
+            "total_out": current[1],
+        }
+
+        if latency.total_count:
+            stats["latency"] = latency_stats(latency)
+
+        return stats
+
+    def report(self, final=False):
+        stats = self.interval_stats()
+
+        if final and self.latency.total_count:
+            stats["total_latency"] = latency_stats(self.latency)
+
+        if self.gauges:
+            stats["gauges"] = dict(self.gauges)
+
+        if self.metrics:
+            stats.update(metrics.process_stats())
+
+        line = json.dumps(stats)
+
+        for output in self.outputs:
+            output.write(line)
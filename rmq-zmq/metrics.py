@@ -0,0 +1,84 @@
+"""Metrics publisher.
+
+Live metrics of a process, published as JSON snapshots on a ZeroMQ PUB
+socket bound by the process itself, so an aggregator (see
+metrics_aggregator.py) can subscribe to any number of processes.
+
+The snapshots are built by MessageProfiler (see message_profiler.py),
+adding the process stats below to the interval stats. It's enabled with
+the METRICS_ENDPOINT environment variable (or the profiler 'metrics'
+argument). The endpoint may include {name} and {pid}, i.e.:
+
+    METRICS_ENDPOINT=ipc:///tmp/metrics-{name}-{pid}.ipc
+
+"""
+
+from __future__ import division
+
+import os
+import gc
+import resource
+import threading
+
+import zmq
+
+DEFAULT_INTERVAL = 1.0
+
+PAGE_SIZE = resource.getpagesize()
+
+
+def rss_bytes():
+    """Current resident set size, falling back to the maximum RSS where
+    /proc is not available
+    """
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (IOError, IndexError, ValueError):
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def process_stats():
+    times = os.times()
+
+    return {
+        "rss": rss_bytes(),
+        "cpu_user": times[0],
+        "cpu_system": times[1],
+        "fds": open_fds(),
+        "threads": threading.active_count(),
+        "gc_counts": gc.get_count(),
+    }
+
+
+class MetricsPublisher(object):
+    """PUB socket bound to the metrics endpoint of a process"""
+
+    def __init__(self, endpoint, name=''):
+        self.endpoint = endpoint.format(name=name, pid=os.getpid())
+
+        self.socket = zmq.Context.instance().socket(zmq.PUB)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(self.endpoint)
+
+    def write(self, line):
+        self.socket.send(line)
+
+    def close(self):
+        self.socket.close()
+
+        # Removes the ipc file, so the aggregator doesn't find it anymore
+        if self.endpoint.startswith('ipc://'):
+            try:
+                os.remove(self.endpoint[len('ipc://'):])
+            except OSError:
+                pass
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Metrics aggregator documentation.
+
+This scripts subscribes to the metrics endpoints of the pipeline
+processes (see metrics.py) and shows all of them in one live table.
+
+Endpoints are given explicitly and/or discovered from ipc files matching
+a glob pattern, which is checked again on every refresh, so processes
+started later (or respawned) show up automatically.
+
+Example:
+    Metrics aggregator usage example as follows:
+    usage: METRICS_ENDPOINT=ipc:///tmp/metrics-{name}-{pid}.ipc python broker.py
+           python metrics_aggregator.py -g '/tmp/metrics-*.ipc'
+
+Arguments:
+  endpoints             metrics endpoints to connect to
+  -g,  --glob           glob pattern of ipc endpoints to discover
+  -r,  --refresh        seconds between table refreshes
+  -o,  --once           print the table once and exit
+
+"""
+
+from __future__ import division
+
+__author__ = "Nicolas Estrada"
+__version__ = "0.0.1"
+
+import glob
+import json
+import time
+import argparse
+
+import zmq
+
+DEFAULT_GLOB = '/tmp/metrics-*.ipc'
+DEFAULT_REFRESH = 1.0
+
+# Refreshes without news before a process is dropped from the table
+STALE_REFRESHES = 5
+
+CLEAR_SCREEN = '\033[2J\033[H'
+
+HEADER = ("{0:<16} {1:>7} {2:>10} {3:>10} {4:>9} {5:>9} {6:>8} "
+          "{7:>9} {8:>9} {9:>6} {10:>8} {11:>5} {12:>14}")
+ROW = ("{name:<16.16} {pid:>7} {ratio_in:>10.0f} {ratio_out:>10.0f} "
+       "{mb_in:>9.2f} {mb_out:>9.2f} {depth:>8} {p50:>9} {p99:>9} "
+       "{cpu:>6.1f} {rss:>8.1f} {fds:>5} {gc:>14}")
+
+
+class Aggregator(object):
+
+    def __init__(self, endpoints=(), pattern=None):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self.pattern = pattern
+        self.connected = set()
+        self.processes = {}
+
+        for endpoint in endpoints:
+            self.connect(endpoint)
+
+    def connect(self, endpoint):
+        if endpoint not in self.connected:
+            self.socket.connect(endpoint)
+            self.connected.add(endpoint)
+
+    def discover(self):
+        if self.pattern:
+            for path in glob.glob(self.pattern):
+                self.connect('ipc://' + path)
+
+    def update(self, snapshot):
+        key = (snapshot['name'], snapshot['pid'])
+        previous = self.processes.get(key)
+
+        cpu_time = snapshot.get('cpu_user', 0) + snapshot.get('cpu_system', 0)
+        snapshot['cpu_time'] = cpu_time
+        snapshot['cpu'] = 0.0
+
+        if previous is not None and snapshot['ts'] > previous['ts']:
+            snapshot['cpu'] = 100 * (cpu_time - previous['cpu_time']) / (
+                snapshot['ts'] - previous['ts'])
+
+        snapshot['received_at'] = time.time()
+        self.processes[key] = snapshot
+
+    def collect(self, seconds):
+        """Receives snapshots for some seconds"""
+
+        deadline = time.time() + seconds
+
+        while True:
+            timeout = deadline - time.time()
+
+            if timeout <= 0 or not self.socket.poll(int(timeout * 1000)):
+                break
+
+            try:
+                self.update(json.loads(self.socket.recv()))
+            except (ValueError, KeyError):
+                continue
+
+    def expire(self, max_age):
+        limit = time.time() - max_age
+
+        for key, snapshot in self.processes.items():
+            if snapshot['received_at'] < limit:
+                del self.processes[key]
+
+    def rows(self):
+        for key in sorted(self.processes):
+            snapshot = self.processes[key]
+            latency = snapshot.get('latency', {})
+            gauges = snapshot.get('gauges', {})
+
+            yield ROW.format(
+                name=snapshot['name'],
+                pid=snapshot['pid'],
+                ratio_in=snapshot['ratio_in'],
+                ratio_out=snapshot['ratio_out'],
+                mb_in=snapshot['bratio_in'] / (1024 * 1024),
+                mb_out=snapshot['bratio_out'] / (1024 * 1024),
+                depth=gauges.get('queue_depth', '-'),
+                p50=latency.get('p50', '-'),
+                p99=latency.get('p99', '-'),
+                cpu=snapshot['cpu'],
+                rss=snapshot.get('rss', 0) / (1024 * 1024),
+                fds=snapshot.get('fds', '-'),
+                gc='/'.join(str(count) for count in snapshot.get('gc_counts', ())))
+
+    def table(self):
+        lines = [HEADER.format(
+            'name', 'pid', 'in msg/s', 'out msg/s', 'in MB/s', 'out MB/s',
+            'depth', 'p50 us', 'p99 us', 'cpu%', 'rss MB', 'fds', 'gc')]
+        lines.extend(self.rows())
+        return '\n'.join(lines)
+
+    def close(self):
+        self.socket.close()
+        self.context.term()
+
+
+def run(endpoints, pattern, refresh, once=False):
+    aggregator = Aggregator(endpoints, pattern)
+
+    try:
+        while True:
+            aggregator.discover()
+            aggregator.collect(refresh)
+            aggregator.expire(refresh * STALE_REFRESHES)
+
+            if once:
+                print aggregator.table()
+                break
+
+            print CLEAR_SCREEN + time.strftime('%Y-%m-%d %H:%M:%S')
+            print aggregator.table()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        aggregator.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="""Shows the live metrics of the pipeline processes in
+        one table.""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        'endpoints',
+        nargs='*',
+        help='metrics endpoints to connect to')
+    parser.add_argument(
+        '-g',
+        '--glob',
+        default=DEFAULT_GLOB,
+        help='glob pattern of ipc endpoints to discover')
+    parser.add_argument(
+        '-r',
+        '--refresh',
+        type=float,
+        default=DEFAULT_REFRESH,
+        help='seconds between table refreshes')
+    parser.add_argument(
+        '-o',
+        '--once',
+        action='store_true',
+        help='print the table once and exit')
+
+    args = parser.parse_args()
+
+    run(args.endpoints, args.glob, args.refresh, args.once)
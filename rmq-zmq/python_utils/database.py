@@ -1,8 +1,17 @@
 """This is a wrapper for MySQL. Super simple to use.
 """
 
+import contextlib
+import heapq
+import Queue
+import random
+import re
+import sqlite3
+import threading
 import time
 
+from multiprocessing.pool import ThreadPool
+
 import MySQLdb
 import MySQLdb.cursors
 
@@ -13,15 +22,146 @@ import logging_manager
 __author__ = "Nicolas, Matias, Gonzalo"
 __version__ = "0.2"
 
-RETRY_IN = 10
+RETRY_IN = 10  # Longest wait between connection attempts
+RETRY_BASE = 0.1
+CONNECT_RETRIES = 5
+
+DEFAULT_POOL_SIZE = 8
+# Idle connections are checked (ping) before being used again
+HEALTH_CHECK_AFTER = 30
+
+DEFAULT_INSERT_CHUNK = 500
+MAX_PARAMS = 65535
+
+# Cached INSERT statements, by (table, cols, rows)
+STATEMENTS = {}
 HOST_TEMPLATE = 'hostname_with_{0}_fill'
 DB_TEMPLATE = 'dbname_with_{0}_fill'
 
+# Batches a shard reads ahead in ShardedDatabase.parallel_big_query
+SHARD_QUEUE_SIZE = 4
+# Seconds between checks of a shard thread waiting for the consumer
+PUT_TIMEOUT = 0.1
+
+# End of the batches of a shard
+DONE = object()
+
+# Attempts of a page of big_query before giving up
+PAGE_ATTEMPTS = 2
+
 logger = logging_manager.start_logger('python_utils.database', use_root_logger=False)
 
 
+class QueryError(Exception):
+    """A failed query, whose missing result must not be taken as no rows"""
+
+
+def keyset_condition(columns, values):
+    """Condition of the rows after the given values of the key columns:
+    (a > %s) OR (a = %s AND b > %s)... which, unlike (a, b) > (%s, %s),
+    MySQL resolves with the index. Returns (condition, parameters)."""
+
+    terms = []
+    params = []
+
+    for position, column in enumerate(columns):
+        equals = ["{0} = %s".format(previous) for previous in columns[:position]]
+        terms.append("({0})".format(" AND ".join(equals + ["{0} > %s".format(column)])))
+        params.extend(values[:position + 1])
+
+    return "({0})".format(" OR ".join(terms)), params
+
+
+def backoff_delay(attempt):
+    """Seconds to wait before the next connection attempt: exponential,
+    with jitter so the processes that lost the server don't reconnect all
+    at the same time."""
+
+    return min(RETRY_IN, RETRY_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def retry_connect(open_connection, retries=CONNECT_RETRIES):
+    """Calls open_connection until it works, up to retries times, raising
+    the last error."""
+
+    for attempt in xrange(retries):
+        try:
+            return open_connection()
+
+        except Exception, e:
+            if attempt + 1 >= retries:
+                logger.exception("Error connecting: {0}. Not retrying".format(e))
+                raise
+
+            delay = backoff_delay(attempt)
+            logger.warning("Error connecting: {0}. Retrying in {1:.2f}s".format(e, delay))
+            time.sleep(delay)
+
+
+def insert_statement(table, cols, rows=1, ignore=False, update=None):
+    """INSERT of rows rows in the columns of a table. The statements are
+    cached, a bulk load uses the same couple of them over and over.
+
+    ignore makes it an INSERT IGNORE (duplicates are skipped), and update
+    a list of columns set to the new values on duplicates (ON DUPLICATE
+    KEY UPDATE col = VALUES(col)...)."""
+
+    key = (table, tuple(cols), rows, ignore, tuple(update or ()))
+    statement = STATEMENTS.get(key)
+
+    if statement is None:
+        values = "({0})".format(', '.join("%s" for col in cols))
+
+        statement = "INSERT {0}INTO {1} ({2}) VALUES {3}".format(
+            'IGNORE ' if ignore else '',
+            table,
+            ', '.join(cols),
+            ', '.join(values for row in xrange(rows)))
+
+        if update:
+            statement += " ON DUPLICATE KEY UPDATE {0}".format(
+                ', '.join("{0} = VALUES({0})".format(col) for col in update))
+
+        STATEMENTS[key] = statement
+
+    return statement
+
+
+def execute_insert(cursor, table, cols, rows, chunk_size=DEFAULT_INSERT_CHUNK, max_params=MAX_PARAMS,
+                   ignore=False, update=None):
+    """Inserts rows with a cursor, chunk_size rows per statement (see
+    Database.insert_rows). Returns the number of rows inserted, or with
+    ignore or update the rows affected as MySQL counts them (skipped
+    duplicates are 0, updated rows 2)."""
+
+    if isinstance(rows, tuple):
+        rows = [rows]
+    elif not isinstance(rows, list):
+        rows = list(rows)
+
+    chunk_size = max(1, min(chunk_size, max_params // max(1, len(cols))))
+    count = 0
+
+    for start in xrange(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        params = [value for row in chunk for value in row]
+
+        cursor.execute(insert_statement(table, cols, len(chunk), ignore, update), params)
+
+        if ignore or update:
+            count += cursor.rowcount
+        else:
+            count += len(chunk)
+
+    return count
+
+
 # Database class
 class Database(object):
+
+    # Most parameters of a statement
+    max_params = MAX_PARAMS
+
     def __init__(self, host='localhost', port=3306, dbname='test', username='root', password=''):
         self.host = host
         self.port = port
@@ -50,36 +190,17 @@ class Database(object):
             self.dbname)
         logger.info(log_msg)
 
-        while not self.db_connection:
-            try:
-                self.db_connection = MySQLdb.connect(
-                    passwd=self.password,
-                    db=self.dbname,
-                    host=self.host,
-                    port=self.port,
-                    user=self.username,
-                    cursorclass=MySQLdb.cursors.DictCursor,
-                    charset="utf8",
-                    use_unicode="True")
-
-                logger.info("Connection stablished")
-
-                # Setting autocommit True for InnoDB transactions
-                self.db_connection.autocommit(True)
-                self.cursor = self.db_connection.cursor()
-                self.connecting = False
-
-            except MySQLdb.Error, e:
-                logger.exception(("DB Error {0}: {1}".format(e.args[0], e.args[1])))
-                # Waiting the db connection
-                time.sleep(RETRY_IN)
-                return False
-
-            except Exception, e:
-                logger.exception("Error: {0}".format(str(e)))
-                time.sleep(RETRY_IN)
-                return False
+        try:
+            self.db_connection = retry_connect(self.open_connection)
+        except Exception:
+            # retry_connect already logged the errors
+            return False
+        finally:
+            self.connecting = False
 
+        logger.info("Connection stablished")
+
+        self.cursor = self.open_cursor(self.db_connection)
         return True
 
     def disconnect(self):
@@ -115,7 +236,8 @@ class Database(object):
                 return None
             else:
                 logger.info("Connecting to db: {0}".format(self.dbname))
-                self.connect()
+                if not self.connect():
+                    return None
 
         try:
             self.cursor.execute(query, data)
@@ -132,28 +254,59 @@ class Database(object):
 
             return None
 
-    def big_query(self, query, data=None, batchsize=1000):
+    def big_query(self, query, data=None, batchsize=1000, key=None, start=None, stream=False):
         """Use this function if you want to return more data than just
         a few lines. It returns a generator instead of just a huge bunch
         of data at once. Please don't add the ';' to the end of the query,
         because we'll be appending LIMITs to the end of the query.
 
+        By default the pages are read with LIMIT offset, batchsize, which
+        makes MySQL go through all the previous rows for each page. For
+        big tables use one of:
+
+            key, keyset pagination: each page starts after the last row
+                of the previous one (WHERE key > last ORDER BY key LIMIT),
+                so with an index on the key all the pages cost the same.
+                key is an indexed column (e.g. 'id'), or a tuple of them
+                when the first one is not unique (e.g. ('datetime', 'id')).
+                The query can't have ORDER BY, LIMIT or GROUP BY, the
+                key columns must be selected, and an OR in its WHERE must
+                be in parentheses (the key condition is added with AND).
+            stream, a server side cursor (SSDictCursor) on its own
+                connection: a single query whose rows are fetched as they
+                are consumed.
+
         Input:  query, string with mysql query, use %s for input parameters
                 data (optional), an array of strings (or objects that are
                     correctly formatted if you call them with str()) which
                     should be placed in the position of the %s in the query.
                 batchsize (optional), the amount of rows to return per next().
                 Defaults to 1000.
+                key (optional), column(s) for the keyset pagination.
+                start (optional), value(s) of the key to start after.
+                stream (optional), use a server side cursor.
         Output: A generator that returns results of the 'query' function
-                    (but then with limited size) on every next() call."""
+                    (but then with limited size) on every next() call.
+                    A page that fails raises QueryError (see page_query)."""
+
+        if stream:
+            for rows in self.stream_query(query, data, batchsize):
+                yield rows
+            return
+
+        if key is not None:
+            for rows in self.keyset_query(query, key, data, batchsize, start):
+                yield rows
+            return
+
         offset = 0
         while True:
             logger.debug(("Running query from {0} with limit {1}"
                           .format(offset, batchsize)))
             new_query = "{0} LIMIT {1}, {2};".format(query, offset, batchsize)
-            result = self.query(new_query, data)
+            result = self.page_query(new_query, data)
 
-            if len(result) > 0:
+            if result:
                 yield result
             else:
                 break
@@ -161,28 +314,132 @@ class Database(object):
 
         return
 
-    def insert_rows(self, table, cols, rows):
+    def page_query(self, query, data=None):
+        """query for the pages of big_query: query returns None when it
+        fails, which would end the pages as if there were no more rows.
+        The page is tried again (query reconnects) and then QueryError is
+        raised."""
+
+        for attempt in xrange(PAGE_ATTEMPTS):
+            result = self.query(query, data)
+
+            if result is not None:
+                return result
+
+            logger.warning("Page query failed (attempt {0} of {1})".format(attempt + 1, PAGE_ATTEMPTS))
+
+        raise QueryError("Query failed on {0}: {1}".format(self.dbname, query))
+
+    def keyset_query(self, query, key, data=None, batchsize=1000, start=None):
+        """Keyset pagination of a query, see big_query"""
+
+        columns = [key] if isinstance(key, basestring) else list(key)
+
+        # Names of the columns in the rows, without table or quotes
+        fields = [column.split('.')[-1].strip('`') for column in columns]
+
+        if start is not None and isinstance(key, basestring):
+            start = [start]
+
+        joiner = " AND " if re.search(r'\bWHERE\b', query, re.IGNORECASE) else " WHERE "
+        order = ", ".join(columns)
+        last = start
+
+        while True:
+            if last is None:
+                new_query = "{0} ORDER BY {1} LIMIT {2};".format(query, order, batchsize)
+                params = data
+            else:
+                condition, values = keyset_condition(columns, last)
+                new_query = "{0}{1}{2} ORDER BY {3} LIMIT {4};".format(
+                    query, joiner, condition, order, batchsize)
+                params = list(data or ()) + values
+
+            logger.debug("Running query after {0} with limit {1}".format(last, batchsize))
+            result = self.page_query(new_query, params)
+
+            if not result:
+                break
+
+            yield result
+
+            if len(result) < batchsize:
+                break
+
+            last = [result[-1][field] for field in fields]
+
+    def open_connection(self, cursorclass=MySQLdb.cursors.DictCursor):
+        connection = MySQLdb.connect(
+            passwd=self.password,
+            db=self.dbname,
+            host=self.host,
+            port=self.port,
+            user=self.username,
+            cursorclass=cursorclass,
+            charset="utf8",
+            use_unicode="True")
+
+        # Setting autocommit True for InnoDB transactions
+        connection.autocommit(True)
+        return connection
+
+    def open_cursor(self, connection):
+        return connection.cursor()
+
+    def check_connection(self, connection):
+        """Raises an error if the connection is not usable anymore"""
+        connection.ping()
+
+    def stream_query(self, query, data=None, batchsize=1000):
+        """Runs a query with a server side cursor (SSDictCursor), yielding
+        its rows in batches as they are read, so the memory used doesn't
+        depend on the size of the result. It uses its own connection, as
+        the connection is busy until all the rows are read.
+
+        """
+
+        connection = self.open_connection(MySQLdb.cursors.SSDictCursor)
+        cursor = connection.cursor()
+
+        try:
+            logger.debug("Streaming the query in batches of {0}".format(batchsize))
+            cursor.execute(query, data)
+
+            while True:
+                rows = cursor.fetchmany(batchsize)
+
+                if not rows:
+                    break
+
+                yield rows
+        finally:
+            # Closing the connection discards the rows not read
+            connection.close()
+
+    def insert_rows(self, table, cols, rows, chunk_size=DEFAULT_INSERT_CHUNK, ignore=False, update=None):
         """Insert rows in the specified columns into the table.
 
+        Lists of rows are inserted with multi-row INSERTs, of chunk_size
+        rows each (less if the parameters of a statement would be more
+        than max_params).
+
         Input:  table, string name of table.
                 cols, list of strings with the cols to be filled.
                 rows, list of tuples with the corresponding values for
                 each column. Must be in the same order.
+                chunk_size (optional), rows per INSERT statement.
+                ignore (optional), skip the duplicates (INSERT IGNORE).
+                update (optional), columns to update on duplicates.
+
+        Output: Number of rows inserted (affected with ignore or update).
+                Raises QueryError if the database can't be reached.
 
         """
 
-        query = "INSERT INTO {0} ({1}) VALUES ({2})".format(
-            table,
-            ', '.join(cols),
-            ', '.join(("%s" for i in xrange(len(cols)))))
+        if not self.db_connection and not self.connect():
+            raise QueryError("Can't connect to {0}, rows not inserted in {1}".format(self.dbname, table))
 
-        if isinstance(rows, list):
-            if len(rows) > 1:
-                self.cursor.executemany(query, rows)
-            else:
-                self.cursor.execute(query, rows[0])
-        elif isinstance(rows, tuple):
-            self.cursor.execute(query, rows)
+        return execute_insert(self.cursor, table, cols, rows, chunk_size, self.max_params, ignore, update)
 
     def get_cols(self, table):
         """This function get a list of columns names for the specified table
@@ -211,7 +468,82 @@ class Database(object):
 # Peewee helpers
 
 
-def insert_into_mysql(model_class, raws_as_dict, silent=True):
+class PeeweeCursor(object):
+    """Cursor of a peewee database for execute_insert, the statements go
+    through execute_sql (which commits them in autocommit mode)"""
+
+    def __init__(self, database):
+        self.database = database
+        self.rowcount = -1
+
+    def execute(self, query, data=None):
+        self.rowcount = self.database.execute_sql(query, data).rowcount
+
+
+def model_rows(model_class, raws_as_dict):
+    """Yields (columns, values) of each dictionary as peewee would insert
+    it: with the defaults of the model, and the values converted by the
+    fields. Auto increment ids are left out when not given."""
+
+    fields = model_class._meta.get_fields()
+
+    for raw in raws_as_dict:
+        data = model_class(**raw)._data
+        present = [field for field in fields
+                   if field.name in raw or data.get(field.name) is not None]
+
+        yield (tuple(field.db_column for field in present),
+               tuple(field.db_value(data.get(field.name)) for field in present))
+
+
+def group_rows(rows, chunk_size):
+    """Groups (columns, values) into (columns, [values...]) of up to
+    chunk_size rows, as a multi-row INSERT needs the same columns"""
+
+    pending = {}
+
+    for cols, values in rows:
+        chunk = pending.setdefault(cols, [])
+        chunk.append(values)
+
+        if len(chunk) >= chunk_size:
+            yield cols, pending.pop(cols)
+
+    for cols, chunk in pending.iteritems():
+        yield cols, chunk
+
+
+def bulk_insert_into_mysql(model_class, raws_as_dict, update=None, chunk_size=DEFAULT_INSERT_CHUNK):
+    """Same as insert_into_mysql, with multi-row INSERTs of chunk_size
+    rows instead of a query (or two) per row. Duplicates are skipped
+    (INSERT IGNORE), or updated with the given columns (field names, or
+    True for all the inserted ones but the primary key) with ON DUPLICATE
+    KEY UPDATE.
+
+    Output: Number of rows affected, as MySQL counts them (skipped
+            duplicates are 0, updated rows 2).
+    """
+
+    meta = model_class._meta
+    cursor = PeeweeCursor(meta.database)
+    count = 0
+
+    for cols, rows in group_rows(model_rows(model_class, raws_as_dict), chunk_size):
+        if update is True:
+            update_cols = [col for col in cols if col != meta.primary_key.db_column]
+        elif update:
+            update_cols = [meta.fields[name].db_column for name in update]
+        else:
+            update_cols = None
+
+        count += execute_insert(
+            cursor, meta.db_table, cols, rows, chunk_size, ignore=not update_cols, update=update_cols)
+
+    return count
+
+
+def insert_into_mysql(model_class, raws_as_dict, silent=True, bulk=False, update=None,
+                      chunk_size=DEFAULT_INSERT_CHUNK):
     """Function to insert dictionaries into MySql.
     This function use peewee and the models defined on Rig to keep
     consistency and if we have to made some changes, just modify the code
@@ -225,9 +557,15 @@ def insert_into_mysql(model_class, raws_as_dict, silent=True):
             raws dict generator or list.
             silent (boolean), when this option is True, the insert will
             not fail on duplicate data. Otherwise, will raise an error.
+            bulk (optional), insert chunk_size rows per query, see
+            bulk_insert_into_mysql (with update, the columns to update
+            on duplicates).
 
     Output: Number of rows afected.
     """
+    if bulk or update:
+        return bulk_insert_into_mysql(model_class, raws_as_dict, update, chunk_size)
+
     count = 0
     for raw in raws_as_dict:
         if silent:
@@ -247,8 +585,322 @@ def insert_into_mysql(model_class, raws_as_dict, silent=True):
     return count
 
 
+class SQLiteCursor(object):
+    """sqlite3 cursor taking the %s parameters of MySQLdb"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def execute(self, query, data=None):
+        # INSERT IGNORE is INSERT OR IGNORE (ON DUPLICATE KEY UPDATE has
+        # no equivalent before SQLite 3.24)
+        if query.startswith('INSERT IGNORE '):
+            query = 'INSERT OR IGNORE ' + query[len('INSERT IGNORE '):]
+
+        return self.cursor.execute(query.replace('%s', '?'), data or ())
+
+    def executemany(self, query, rows):
+        return self.cursor.executemany(query.replace('%s', '?'), rows)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def close(self):
+        self.cursor.close()
+
+
+def dict_factory(cursor, row):
+    return dict((column[0], value) for column, value in zip(cursor.description, row))
+
+
+class SQLiteDatabase(Database):
+    """Database on SQLite with the interface of Database, to run the code
+    using MySQL (i.e. the feeders or ShardedDatabase) against local files
+    or in memory databases. Queries keep the %s parameters, and
+    LIMIT offset, count works on both."""
+
+    # SQLITE_MAX_VARIABLE_NUMBER of the older versions
+    max_params = 999
+
+    def __init__(self, path=':memory:'):
+        super(SQLiteDatabase, self).__init__(host=None, port=None, dbname=path)
+
+    def open_connection(self, cursorclass=None):
+        # Used by a single thread at a time, but not always the same one
+        connection = sqlite3.connect(self.dbname, check_same_thread=False, isolation_level=None)
+        connection.row_factory = dict_factory
+        return connection
+
+    def open_cursor(self, connection):
+        return SQLiteCursor(connection.cursor())
+
+    def check_connection(self, connection):
+        connection.execute("SELECT 1")
+
+    def connect(self):
+        self.db_connection = self.open_connection()
+        self.cursor = self.open_cursor(self.db_connection)
+        return True
+
+    def disconnect(self):
+        if self.db_connection is not None:
+            self.db_connection.close()
+            self.db_connection = None
+
+    def is_connected(self):
+        return self.db_connection is not None
+
+    def query(self, query, data=None):
+        if not self.db_connection:
+            self.connect()
+
+        try:
+            self.cursor.execute(query, data)
+            return self.cursor.fetchall()
+
+        except sqlite3.Error, e:
+            logger.exception("DB Error: {0} Last query executed {1}".format(e, query))
+            return None
+
+    def stream_query(self, query, data=None, batchsize=1000):
+        # SQLite cursors already read the rows as they are fetched (and a
+        # new connection would be a different in memory database)
+        if not self.db_connection:
+            self.connect()
+
+        cursor = SQLiteCursor(self.db_connection.cursor())
+
+        try:
+            cursor.execute(query, data)
+
+            while True:
+                rows = cursor.fetchmany(batchsize)
+
+                if not rows:
+                    break
+
+                yield rows
+        finally:
+            cursor.close()
+
+
+class ConnectionPool(object):
+    """Thread safe pool of connections to the database of a Database (or
+    SQLiteDatabase), for processes querying it from several threads:
+
+        pool = ConnectionPool(Database(host='...', dbname='...'), size=8)
+        rows = pool.query("SELECT ...", data)
+
+        with pool.connection() as connection:
+            cursor = pool.database.open_cursor(connection)
+            ...
+
+    Up to size connections are opened as they are needed (with the
+    jittered backoff of retry_connect). The ones idle for more than
+    check_after seconds are checked before being used again, and the ones
+    failing with a database error are discarded.
+    """
+
+    def __init__(self, database, size=DEFAULT_POOL_SIZE, timeout=None, check_after=HEALTH_CHECK_AFTER):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+
+        # (connection, released at), last used first: the rest can stay
+        # idle (and be checked later). Waiters are notified whenever a
+        # connection is released or discarded, as they may open a new one
+        self.idle = []
+        self.opened = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """A connection of the pool, waiting up to timeout seconds for one
+        if all of them are in use (Queue.Empty if there's none)"""
+
+        deadline = None if self.timeout is None else time.time() + self.timeout
+
+        while True:
+            connection = None
+
+            with self.condition:
+                while not self.idle and self.opened >= self.size:
+                    if deadline is None:
+                        self.condition.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise Queue.Empty
+                        self.condition.wait(remaining)
+
+                if self.idle:
+                    connection, released_at = self.idle.pop()
+                else:
+                    self.opened += 1
+
+            if connection is None:
+                try:
+                    return retry_connect(self.database.open_connection)
+                except Exception:
+                    self.closed()
+                    raise
+
+            if time.time() - released_at < self.check_after or self.healthy(connection):
+                return connection
+
+            self.discard(connection)
+
+    def healthy(self, connection):
+        try:
+            self.database.check_connection(connection)
+            return True
+        except Exception, e:
+            logger.warning("Discarding a broken connection: {0}".format(e))
+            return False
+
+    def release(self, connection):
+        with self.condition:
+            self.idle.append((connection, time.time()))
+            self.condition.notify()
+
+    def closed(self):
+        """A connection is gone, a waiter can open another one"""
+
+        with self.condition:
+            self.opened -= 1
+            self.condition.notify()
+
+    def discard(self, connection):
+        self.closed()
+
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.acquire()
+
+        try:
+            yield connection
+        except (MySQLdb.Error, sqlite3.Error):
+            # It may be broken, a new one is opened when needed
+            self.discard(connection)
+            raise
+        except BaseException:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def query(self, query, data=None):
+        """Same as Database.query, on a connection of the pool (errors are
+        raised instead of returning None)"""
+
+        with self.connection() as connection:
+            cursor = self.database.open_cursor(connection)
+
+            try:
+                cursor.execute(query, data)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    def insert_rows(self, table, cols, rows, chunk_size=DEFAULT_INSERT_CHUNK, ignore=False, update=None):
+        """Same as Database.insert_rows, on a connection of the pool"""
+
+        with self.connection() as connection:
+            cursor = self.database.open_cursor(connection)
+
+            try:
+                return execute_insert(
+                    cursor, table, cols, rows, chunk_size, self.database.max_params, ignore, update)
+            finally:
+                cursor.close()
+
+    def close(self):
+        """Closes the idle connections"""
+
+        while True:
+            with self.condition:
+                if not self.idle:
+                    break
+                connection, _ = self.idle.pop()
+
+            self.discard(connection)
+
+
+def sort_function(sort_key):
+    """Function giving the sort value of a row, from a column name (or
+    a list of them) or a function"""
+
+    if callable(sort_key):
+        return sort_key
+    if isinstance(sort_key, basestring):
+        return lambda row: row[sort_key]
+    return lambda row: tuple(row[column] for column in sort_key)
+
+
+def merge_sorted(iterables, sort_key):
+    """k-way merge of row iterables, each one sorted by sort_key"""
+
+    key = sort_function(sort_key)
+
+    # heapq.merge has no key, the rows are decorated with it (and with
+    # the number of their iterable, to never compare the rows themselves)
+    decorated = [((key(row), number, row) for row in rows)
+                 for number, rows in enumerate(iterables)]
+
+    for _, _, row in heapq.merge(*decorated):
+        yield row
+
+
+def put_until(output, item, stop):
+    """Puts an item in a bounded queue, unless stop is set meanwhile (the
+    consumer is gone). Returns whether it was put."""
+
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=PUT_TIMEOUT)
+            return True
+        except Queue.Full:
+            continue
+
+    return False
+
+
+def produce_batches(batches, output, stop):
+    """Runs in a shard thread: puts the batches in the queue, followed by
+    DONE (or the exception raised). It stops reading when stop is set,
+    closing the batches (and their cursor or connection)."""
+
+    try:
+        for batch in batches:
+            if not put_until(output, batch, stop):
+                break
+    except Exception, e:
+        logger.exception("Error in a shard query")
+        put_until(output, e, stop)
+    finally:
+        batches.close()
+        put_until(output, DONE, stop)
+
+
 class ShardedDatabase(object):
-    """Class that handles queries over all shards"""
+    """Class that handles queries over all shards
+
+    The parallel_* methods query all the shards at once, with a thread
+    (and the connection of its Database) per shard, yielding the results
+    as they arrive or, with a sort_key, merged in order."""
+
     def __init__(self, host_template=HOST_TEMPLATE, port=3306, db_template=DB_TEMPLATE,
                  shardids=[], username='test', password=''):
 
@@ -263,6 +915,16 @@ class ShardedDatabase(object):
                 username=username,
                 password=password)
 
+    @classmethod
+    def from_databases(cls, dbs):
+        """ShardedDatabase over the given {shardid: Database} (i.e. some
+        SQLiteDatabase for testing)"""
+
+        sharded = cls()
+        sharded.shardids = sorted(dbs)
+        sharded.dbs = dict(dbs)
+        return sharded
+
     def query(self, query, data=None):
         """Performs query over multiple shards"""
         logger.debug("Performing the query")
@@ -279,3 +941,97 @@ class ShardedDatabase(object):
         for shard in self.shardids:
             yield self.dbs[shard].big_query(query, data, batchsize)
 
+    def parallel_query(self, query, data=None, sort_key=None):
+        """Performs query over all the shards at once. A shard whose query
+        fails raises QueryError, instead of looking like one without rows.
+
+        Output: the result of each shard as it arrives, or with sort_key
+                (column name(s) or function), the rows of all the shards
+                in order (the query must be sorted by the same key)."""
+
+        logger.debug("Performing the query on {0} shards".format(len(self.shardids)))
+
+        def shard_query(shard):
+            result = self.dbs[shard].query(query, data)
+
+            if result is None:
+                raise QueryError("Query failed on shard {0}: {1}".format(shard, query))
+
+            return result
+
+        pool = ThreadPool(len(self.shardids) or 1)
+
+        try:
+            if sort_key is None:
+                for result in pool.imap_unordered(shard_query, self.shardids):
+                    yield result
+            else:
+                for row in merge_sorted(pool.map(shard_query, self.shardids), sort_key):
+                    yield row
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def parallel_big_query(self, query, data=None, batchsize=1000, sort_key=None, **options):
+        """Performs a big query (see Database.big_query, which gets the
+        options, i.e. key or stream) over all the shards at once. Each
+        shard keeps up to SHARD_QUEUE_SIZE batches ahead of the consumer.
+        The error of a shard (i.e. QueryError) is raised here, and when
+        the consumer stops early the shard threads stop and are joined.
+
+        Output: the batches of the shards as they arrive, or with sort_key,
+                the rows of all the shards in order (the query must be
+                sorted by the same key, as it is with key)."""
+
+        logger.debug("Performing the big query on {0} shards".format(len(self.shardids)))
+
+        if sort_key is None:
+            # All the shards put their batches in the same queue
+            output = Queue.Queue(SHARD_QUEUE_SIZE * len(self.shardids))
+            queues = [output] * len(self.shardids)
+        else:
+            queues = [Queue.Queue(SHARD_QUEUE_SIZE) for shard in self.shardids]
+
+        # Set when the consumer finishes, stops early or fails
+        stop = threading.Event()
+        threads = []
+
+        for shard, output in zip(self.shardids, queues):
+            batches = self.dbs[shard].big_query(query, data, batchsize, **options)
+
+            thread = threading.Thread(target=produce_batches, args=(batches, output, stop))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            if sort_key is None:
+                for batch in shard_batches(output, len(self.shardids)):
+                    yield batch
+            else:
+                rows = [(row for batch in shard_batches(output) for row in batch)
+                        for output in queues]
+
+                for row in merge_sorted(rows, sort_key):
+                    yield row
+        finally:
+            stop.set()
+
+            # The connections of the shards are free again when this ends
+            for thread in threads:
+                thread.join()
+
+
+def shard_batches(output, producers=1):
+    """Batches put in a queue by produce_batches, until all the producers
+    are done"""
+
+    while producers:
+        batch = output.get()
+
+        if batch is DONE:
+            producers -= 1
+        elif isinstance(batch, Exception):
+            raise batch
+        else:
+            yield batch
@@ -2,11 +2,21 @@ import errno
 import gzip
 import os
 import re
+import zlib
 
 import logging_manager
 
 logger = logging_manager.start_logger('python_utils.file_utils', use_root_logger=False)
 
+READ_SIZE = 1048576  # 1 MB
+
+# Sidecar line index of a file (see write_line_index)
+INDEX_SUFFIX = '.idx'
+DEFAULT_INDEX_EVERY = 10000  # Lines
+
+# zlib window bits to decode (only) the gzip format
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
 
 def better_open(path, mode='r'):
 
@@ -67,3 +77,135 @@ def delete_files(files, silent=False):
             silent_remove(path)
         else:
             os.remove(path)
+
+
+def read_chunks(file_handler, size=READ_SIZE):
+    while True:
+        data = file_handler.read(size)
+        if not data:
+            break
+        yield data
+
+
+def decompress_gzip(chunks):
+    """Decompresses a gzip stream given in chunks, as they arrive. Files
+    with several gzip members (i.e. the ones appended by the archiver,
+    one member per message) are decompressed entirely.
+
+    Yields (offset, data): the decompressed data and the offset, in the
+    compressed stream, of the member it belongs to.
+
+    """
+
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    member_offset = 0
+    position = 0
+
+    for chunk in chunks:
+        position += len(chunk)
+
+        while chunk:
+            data = decompressor.decompress(chunk)
+
+            if data:
+                yield member_offset, data
+
+            chunk = decompressor.unused_data
+
+            # The member is over, the rest of the chunk is the next one
+            if chunk:
+                member_offset = position - len(chunk)
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+
+    data = decompressor.flush()
+
+    if data:
+        yield member_offset, data
+
+
+def split_lines(chunks):
+    """Lines (with the line break) of a stream given in chunks"""
+
+    pending = ''
+
+    for data in chunks:
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+
+        for line in lines:
+            yield line + '\n'
+
+    if pending:
+        yield pending
+
+
+def stream_lines(chunks, compressed=False):
+    """Lines of a stream given in chunks, decompressing it if needed"""
+
+    if compressed:
+        chunks = (data for _, data in decompress_gzip(chunks))
+
+    return split_lines(chunks)
+
+
+def line_index(path, every=DEFAULT_INDEX_EVERY):
+    """Yields (line number, offset) of the lines where a read of the file
+    can start, about one every 'every' lines. Lines are counted from 0.
+
+    In gzip files the offsets are the start of gzip members, so the
+    index is only as fine as the members of the file.
+
+    """
+
+    yield (0, 0)
+
+    line_number = 0
+    last_indexed = 0
+
+    with open(path, 'rb') as file_handler:
+        if re.search('\.gz$', path):
+            member_offset = 0
+            line_start = True
+
+            for offset, data in decompress_gzip(read_chunks(file_handler)):
+                # A new member starting with a new line is a starting point
+                if (offset != member_offset and line_start
+                        and line_number - last_indexed >= every):
+                    yield (line_number, offset)
+                    last_indexed = line_number
+
+                member_offset = offset
+                line_number += data.count('\n')
+                line_start = data.endswith('\n')
+        else:
+            offset = 0
+
+            for line in file_handler:
+                if line_number - last_indexed >= every:
+                    yield (line_number, offset)
+                    last_indexed = line_number
+
+                offset += len(line)
+                line_number += 1
+
+
+def write_line_index(path, every=DEFAULT_INDEX_EVERY):
+    """Writes the line index of a file next to it, one "line offset" per
+    line. Returns its path.
+
+    """
+
+    index_path = path + INDEX_SUFFIX
+
+    with open(index_path, 'w') as index_file:
+        for line_number, offset in line_index(path, every):
+            index_file.write("{0} {1}\n".format(line_number, offset))
+
+    return index_path
+
+
+def parse_line_index(content):
+    """List of (line number, offset) from the content of an index file"""
+
+    return [tuple(int(value) for value in line.split())
+            for line in content.splitlines() if line.strip()]
@@ -1,23 +1,224 @@
 """A class to convert longitudes and latitudes in to country/city/state.
-This is the same conversion method that Skout currently uses."""
+This is the same conversion method that Skout currently uses.
+
+The geo database is data/geo.cp (a pickled dict of lists). To start
+faster, it's converted into a flat binary file which is mapped in
+memory, so all the processes using it share the same pages:
+
+    python geo.py [data/geo.cp] [data/geo.bin]
+
+The binary file (little endian) is a header followed by the arrays:
+
+    header      magic, places, cells, size of the names
+    lats        float64 x places
+    lons        float64 x places
+    weights     float64 x places, 1 / log10(population)
+    cells       int32 (lat, lon, start, stop) x cells
+    offsets     uint32 x places + 1, of the names of each place
+    names       "country\tstate\tcity" of each place
+"""
 
 __author__ = "Nicolas, Matias, GOnzalo"
 __version__ = "0.1"
 
 import cPickle
-import math
+import mmap
 import os
+import struct
+import sys
+
+import numpy
 
 # Relative location of the geolocation conversion file to this file
 GEOFILE = 'data/geo.cp'
+GEOBINFILE = 'data/geo.bin'
+
+BIN_MAGIC = 'GEOBIN01'
+BIN_HEADER = struct.Struct('<8sIII4x')
+FLOAT = numpy.dtype('<f8')
+CELL = numpy.dtype('<i4')
+OFFSET = numpy.dtype('<u4')
+
+# Cells around the one of a location where its place is looked for
+NEIGHBOURS = [(dlat, dlon) for dlat in xrange(-1, 2) for dlon in xrange(-1, 2)]
+
+# Locations resolved at once in convert_many (the distances to all the
+# candidates of a cell are a locations x candidates matrix)
+BATCH_SIZE = 1024
+
+
+def cell_of(lat, lon):
+    # Cells are the integer part of the coordinates, as the keys of the
+    # geo database ("lat_lon", truncated towards zero)
+    return int(lat), int(lon)
+
+
+def data_path(filename):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+
+
+def read_pickle(path):
+    """Places of the pickled database, grouped by cell: returns (cells,
+    lats, lons, weights, places) as used by GeoConversion"""
+
+    with open(path, 'rb') as geo_data:
+        locations = cPickle.load(geo_data)
+
+    cells = {}
+    points = []
+
+    for key in sorted(locations):
+        positions = locations[key]
+
+        if not positions:
+            continue
+
+        lat, lon = key.split('_')
+        cells[int(lat), int(lon)] = (len(points), len(points) + len(positions))
+        points.extend(positions)
+
+    lats = numpy.array([pos[0] for pos in points], dtype=FLOAT)
+    lons = numpy.array([pos[1] for pos in points], dtype=FLOAT)
+    weights = 1 / numpy.log10(numpy.array([pos[2] for pos in points], dtype=FLOAT))
+    places = [pos[3:6] for pos in points]
+
+    return cells, lats, lons, weights, places
+
+
+def write_binary(path, cells, lats, lons, weights, places):
+    cell_table = numpy.array(
+        [(lat, lon, start, stop) for (lat, lon), (start, stop) in sorted(cells.iteritems())],
+        dtype=CELL).reshape(-1, 4)
+
+    names = ['\t'.join(place) for place in places]
+    offsets = numpy.zeros(len(names) + 1, dtype=OFFSET)
+    offsets[1:] = numpy.cumsum([len(name) for name in names])
+
+    # Written aside and renamed, the processes starting meanwhile read
+    # the old file (or the pickle)
+    temporary = path + '.tmp'
+
+    with open(temporary, 'wb') as output:
+        output.write(BIN_HEADER.pack(BIN_MAGIC, len(lats), len(cell_table), int(offsets[-1])))
+
+        for array in (lats, lons, weights, cell_table, offsets):
+            output.write(array.tobytes())
+
+        output.write(''.join(names))
+
+    os.rename(temporary, path)
+
+
+def build_binary(source=None, target=None):
+    """Converts the pickled geo database into the binary one"""
+
+    source = source or data_path(GEOFILE)
+    target = target or data_path(GEOBINFILE)
+
+    write_binary(target, *read_pickle(source))
+    return target
+
+
+class PlaceNames(object):
+    """[country, state, city] of each place, sliced from the names in the
+    mapping of the binary database (which start at base) when they are
+    asked for, so they are never copied as a whole"""
+
+    def __init__(self, offsets, mapping, base):
+        self.offsets = offsets
+        self.mapping = mapping
+        self.base = base
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start = self.base + int(self.offsets[index])
+        stop = self.base + int(self.offsets[index + 1])
+        return self.mapping[start:stop].split('\t')
+
+
+def read_binary(path):
+    """Maps the binary database in memory (read only, shared by all the
+    processes): returns (cells, lats, lons, weights, places) with arrays
+    on top of the mapping"""
+
+    with open(path, 'rb') as geo_data:
+        mapping = mmap.mmap(geo_data.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, count, cell_count, names_size = BIN_HEADER.unpack_from(mapping, 0)
+
+    if magic != BIN_MAGIC:
+        raise ValueError("{0} is not a geo database".format(path))
+
+    offset = BIN_HEADER.size
+    arrays = []
+
+    for dtype, size in ((FLOAT, count), (FLOAT, count), (FLOAT, count),
+                        (CELL, cell_count * 4), (OFFSET, count + 1)):
+        arrays.append(numpy.frombuffer(mapping, dtype=dtype, count=size, offset=offset))
+        offset += dtype.itemsize * size
+
+    lats, lons, weights, cell_table, offsets = arrays
+
+    cells = dict(((lat, lon), (start, stop))
+                 for lat, lon, start, stop in cell_table.reshape(-1, 4).tolist())
+
+    if len(mapping) < offset + names_size:
+        raise ValueError("{0} is truncated".format(path))
+
+    return cells, lats, lons, weights, PlaceNames(offsets, mapping, offset)
 
 
 class GeoConversion(object):
     """This object loads a geo database that we use to convert a lat/lon
-    location in to a location string."""
+    location in to a location string.
+
+    The places are kept in flat arrays, grouped by cell: each cell is a
+    slice of them (see self.cells), so the candidates of a location are
+    the concatenation of the slices of the nine cells around it. The
+    population term of the distance, 1 / log10(population), is computed
+    once for all. The arrays are mapped from the binary database when
+    it's been built, otherwise they are read from the pickle."""
     def __init__(self):
-        with open(os.path.join(os.path.dirname(__file__), GEOFILE)) as geo_data:
-            self.locations = cPickle.load(geo_data)
+        binary = data_path(GEOBINFILE)
+
+        if os.path.exists(binary):
+            geo_data = read_binary(binary)
+        else:
+            geo_data = read_pickle(data_path(GEOFILE))
+
+        self.cells, self.lats, self.lons, self.weights, self.places = geo_data
+
+        # Candidates of each cell, as they are looked up
+        self.neighbourhoods = {}
+
+    def candidates(self, cell):
+        """Indexes of the places in the nine cells around a cell, in the
+        same order the cells were always looked up (so the ties go to the
+        same place)"""
+
+        indexes = self.neighbourhoods.get(cell)
+
+        if indexes is None:
+            ranges = [self.cells.get((cell[0] + dlat, cell[1] + dlon), (0, 0))
+                      for dlat, dlon in NEIGHBOURS]
+
+            indexes = numpy.concatenate(
+                [numpy.arange(start, stop) for start, stop in ranges]).astype(numpy.intp)
+
+            self.neighbourhoods[cell] = indexes
+
+        return indexes
+
+    def nearest(self, indexes, lats, lons):
+        """Index of the nearest place among indexes of each location"""
+
+        distances = ((lats[:, numpy.newaxis] - self.lats[indexes]) ** 2
+                     + (lons[:, numpy.newaxis] - self.lons[indexes]) ** 2
+                     + self.weights[indexes])
+
+        return indexes[distances.argmin(axis=1)]
 
     def convert(self, lat, lon):
         """Convert a latitude and longitude in to a location string.
@@ -25,19 +226,49 @@ class GeoConversion(object):
         If no viable results are found, the function will return None."""
 
         lat, lon = float(lat), float(lon)
-        positions = []
+        indexes = self.candidates(cell_of(lat, lon))
+
+        if len(indexes) == 0:
+            return None
 
-        def distance(pos):
-            return (math.pow(lat - pos[0], 2)
-                    + math.pow(lon - pos[1], 2)
-                    + 1 / math.log10(pos[2]))
+        nearest = self.nearest(indexes, numpy.array([lat]), numpy.array([lon]))
+        return list(self.places[nearest[0]])
 
-        for dlat in xrange(-1, 2):
-            for dlon in xrange(-1, 2):
-                key = "{}_{}".format(int(lat) + dlat, int(lon) + dlon)
-                positions += self.locations[key]
+    def convert_many(self, lats, lons):
+        """Same as convert for lists (or arrays) of latitudes and
+        longitudes, i.e. for the locations of a whole file. The locations
+        are grouped by cell, and those of a cell are resolved at once.
 
-        if len(positions) == 0:
-            return None
-        else:
-            return sorted(positions, key=distance)[0][3:6]
+        Output: list with the [country, city, state] (or None) of each
+        location."""
+
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+
+        cell_lats = numpy.trunc(lats).astype(int)
+        cell_lons = numpy.trunc(lons).astype(int)
+
+        results = [None] * len(lats)
+        groups = {}
+
+        for position, cell in enumerate(zip(cell_lats.tolist(), cell_lons.tolist())):
+            groups.setdefault(cell, []).append(position)
+
+        for cell, positions in groups.iteritems():
+            indexes = self.candidates(cell)
+
+            if len(indexes) == 0:
+                continue
+
+            for start in xrange(0, len(positions), BATCH_SIZE):
+                batch = numpy.array(positions[start:start + BATCH_SIZE])
+                nearest = self.nearest(indexes, lats[batch], lons[batch])
+
+                for position, index in zip(batch.tolist(), nearest.tolist()):
+                    results[position] = list(self.places[index])
+
+        return results
+
+
+if __name__ == '__main__':
+    print "Geo database written to {0}".format(build_binary(*sys.argv[1:3]))
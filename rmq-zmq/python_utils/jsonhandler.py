@@ -7,6 +7,7 @@ __author__ = "Nicolas, Matias, Gonzalo"
 __version__ = "0.2"
 
 import datetime
+import decimal
 
 import date_utils
 
@@ -34,6 +35,9 @@ def _handler(obj):
         return date_utils.datetime_to_millisec(obj)
     elif hasattr(obj, 'isoformat'):
         return obj.isoformat()
+    elif isinstance(obj, decimal.Decimal):
+        # As simplejson does, a number (MySQL DECIMAL columns)
+        return float(obj)
     else:
         msg = "Object of type {0} with value of {1} is not JSON serializable"
         raise ValueError(msg.format(type(obj), repr(obj)))
@@ -1,15 +1,23 @@
-import gzip
+import bisect
+import hashlib
+import itertools
 import logging
 import os
 import os.path
 import re
+import sre_constants
+import sre_parse
+import threading
 import time
 
+from multiprocessing.pool import ThreadPool
 from tempfile import NamedTemporaryFile, SpooledTemporaryFile
 
 import boto.s3.key
 
 from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
+from boto.s3.prefix import Prefix
 
 import file_utils
 import logging_manager
@@ -24,14 +32,166 @@ logging.getLogger('boto').setLevel(logging.CRITICAL)
 MAX_TEMP_FILE_SIZE = 3221225472  # 3 GB
 DEFAULT_CHUNK_SIZE = 104857600  # 100 MB
 MIN_CHUNK = 5242880  # 5 MB
+DEFAULT_READ_SIZE = 8388608  # 8 MB
 DEFAULT_REDUCED_REDUNDANCY = False
+DEFAULT_UPLOAD_WORKERS = 4
+DEFAULT_PART_RETRIES = 3
+PART_RETRY_DELAY = 1  # Seconds, doubled on each retry
+DEFAULT_LIST_DEPTH = 3  # '/' levels split to list in parallel
+DELETE_BATCH = 1000  # Keys per delete request, the S3 limit
+
+
+def throughput(size, elapsed):
+    """MiB/s of a transfer"""
+
+    return (float(size) / 1024 / 1024) / max(elapsed, 0.001)
+
+
+def literal_prefix(regexp):
+    """Literal start of a regexp anchored with '^' (or \\A), the prefix
+    all its matches share. Empty if there isn't one.
+
+    """
+
+    try:
+        parsed = sre_parse.parse(regexp)
+    except (sre_constants.error, TypeError):
+        return ''
+
+    if parsed.pattern.flags & (sre_constants.SRE_FLAG_IGNORECASE | sre_constants.SRE_FLAG_VERBOSE):
+        return ''
+
+    items = list(parsed)
+
+    if not items or items[0] not in ((sre_constants.AT, sre_constants.AT_BEGINNING),
+                                     (sre_constants.AT, sre_constants.AT_BEGINNING_STRING)):
+        return ''
+
+    # The literals are bytes of a str pattern, code points of a unicode one
+    character = unichr if isinstance(regexp, unicode) else chr
+    prefix = []
+
+    for opcode, value in items[1:]:
+        if opcode != sre_constants.LITERAL:
+            break
+        prefix.append(character(value))
+
+    return ''.join(prefix)
+
+
+def narrow_prefix(prefix, other):
+    """The longest of two prefixes, or None if no key can have both"""
+
+    if prefix.startswith(other):
+        return prefix
+    if other.startswith(prefix):
+        return other
+    return None
+
+
+def batched(iterable, size):
+    """Yields lists of up to size elements of an iterable"""
+
+    iterator = iter(iterable)
+
+    while True:
+        batch = list(itertools.islice(iterator, size))
+
+        if not batch:
+            break
+
+        yield batch
+
+
+class UploadDigest(object):
+    """md5 digests of a file being written, to verify its upload without
+    reading it again. Besides the md5 of the whole file, it keeps the md5
+    of each chunk, following S3BucketWrapper.file_offsets, which give the
+    ETag of the multipart uploads: the md5 of the md5 of the parts,
+    followed by "-" and the amount of parts.
+
+    """
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = max(chunk_size, MIN_CHUNK)
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.parts = []
+        self.part = hashlib.md5()
+        self.part_size = 0
+
+        # The previous part, also fed with the current one, in case the
+        # current one ends up too small and is merged into it
+        self.extended_part = None
+
+    def update(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+
+        while data:
+            piece = data[:self.chunk_size - self.part_size]
+            data = data[len(piece):]
+
+            self.part.update(piece)
+            self.part_size += len(piece)
+
+            if self.extended_part is not None:
+                self.extended_part.update(piece)
+
+            if self.part_size == self.chunk_size:
+                self.parts.append(self.part.digest())
+                self.extended_part = self.part.copy()
+                self.part = hashlib.md5()
+                self.part_size = 0
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def etag(self):
+        """ETag S3 gives to the file uploaded by upload_file"""
+
+        if self.size <= self.chunk_size * 2:
+            return self.md5.hexdigest()
+
+        parts = list(self.parts)
+
+        if self.part_size >= MIN_CHUNK:
+            parts.append(self.part.digest())
+        elif self.part_size:
+            # The last bytes go with the previous part
+            parts[-1] = self.extended_part.digest()
+
+        return "{0}-{1}".format(hashlib.md5(''.join(parts)).hexdigest(), len(parts))
 
 
 class S3BucketWrapper(object):
 
-    def __init__(self, access_key, secret_key, bucketname, reduced_redundancy=DEFAULT_REDUCED_REDUNDANCY):
-        self.connection = S3Connection(access_key, secret_key)
+    def __init__(self, access_key, secret_key, bucketname, reduced_redundancy=DEFAULT_REDUCED_REDUNDANCY,
+                 upload_workers=DEFAULT_UPLOAD_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE,
+                 host=None, port=None, is_secure=True, calling_format=None):
+        """host, port, is_secure and calling_format allow using other
+        S3 compatible services (i.e. a local one for testing, with
+        calling_format='boto.s3.connection.OrdinaryCallingFormat')
+        """
+
+        # Boto connections are not thread safe, so the parameters are kept
+        # to open one connection per upload thread
+        self.connection_params = dict(
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            is_secure=is_secure,
+            port=port)
+
+        if host is not None:
+            self.connection_params['host'] = host
+        if calling_format is not None:
+            self.connection_params['calling_format'] = calling_format
+
+        self.connection = S3Connection(**self.connection_params)
         self.reduced_redundancy = reduced_redundancy
+        self.upload_workers = upload_workers
+        self.chunk_size = max(chunk_size, MIN_CHUNK)
+        self.local = threading.local()
 
         # Temporal fix to have a better name for this property
         self.boto_bucket = self.bucket = self.connection.get_bucket(bucketname)
@@ -62,7 +222,18 @@ class S3BucketWrapper(object):
 
         """
 
-        return self.boto_bucket.get_key(key_name)
+        return self.thread_bucket().get_key(key_name)
+
+    def thread_bucket(self):
+        """Bucket object with its own connection, one per thread"""
+
+        bucket = getattr(self.local, 'bucket', None)
+
+        if bucket is None:
+            connection = S3Connection(**self.connection_params)
+            bucket = self.local.bucket = connection.get_bucket(self.bucket_name, validate=False)
+
+        return bucket
 
     def get_or_create_key(self, key_name):
         """Helper function to get an existing key, or create a
@@ -176,8 +347,18 @@ class S3BucketWrapper(object):
                     log_msg += ' Retrying'
                     logger.info(log_msg)
 
-    def upload_file(self, filename, key, retries=2, reduced_redundancy=None):
-        """
+    def upload_file(self, filename, key, retries=2, reduced_redundancy=None, workers=None):
+        """Uploads a file to S3. Files bigger than two chunks are uploaded
+        in parts by a pool of threads (see upload_multipart), retrying
+        each part on its own.
+
+        Input:
+            filename, path of the file to upload
+            key, S3 key name of the file
+            retries, number of tries of the upload (of each part in
+                     multipart mode)
+            reduced_redundancy, use the reduced redundancy storage
+            workers, parts uploaded at the same time
 
         """
 
@@ -192,78 +373,161 @@ class S3BucketWrapper(object):
 
         log_msg = "Uploading {0} to {1}/{2}".format(filename, self.s3_bucket_url, key)
 
-        for retry in xrange(retries):
-            try:
-                # If the file is too big...
-                if file_size > (DEFAULT_CHUNK_SIZE * 2):
-                    log_msg += " using multipart mode"
-                    logger.info(log_msg)
-
-                    # The multipart uploads begins here
-                    multipart = self.boto_bucket.initiate_multipart_upload(
-                        key,
-                        reduced_redundancy=reduced_redundancy)
-
-                    # Get the points where the file should be divided
-                    checkpoints = self.file_offsets(filename)
-
-                    # Open a file handler
-                    with open(filename, 'r') as input_file:
-                        # Cycle through the checkpoints
-                        for part, offset in checkpoints:
-
-                            logger.debug("Uploading chunk #{0} (offset: {1})".format(
-                                part,
-                                offset))
-
-                            # Upload the part and add the number of bytes
-                            # uploaded
-                            multipart.upload_part_from_file(
-                                input_file,
-                                part,
-                                size=offset)
+        # If the file is too big...
+        if file_size > (self.chunk_size * 2):
+            log_msg += " using multipart mode"
+            logger.info(log_msg)
 
-                    # Finish the upload
-                    mp_status = multipart.complete_upload()
+            self.upload_multipart(
+                filename,
+                key,
+                reduced_redundancy=reduced_redundancy,
+                workers=workers,
+                retries=max(retries, DEFAULT_PART_RETRIES))
 
-                    # Show the upload status in the logs
-                    logger.debug(str(mp_status))
-                else:
-                    log_msg += " using simple mode"
-                    logger.info(log_msg)
+        else:
+            log_msg += " using simple mode"
+            logger.info(log_msg)
 
+            for retry in xrange(retries):
+                try:
                     # Creates a new Key in the bucket, using the output filename
-                    new_key = self.boto_bucket.new_key(key)
+                    new_key = self.thread_bucket().new_key(key)
 
                     with open(filename, 'r') as input_file:
                         new_key.set_contents_from_file(
                             input_file,
                             reduced_redundancy=reduced_redundancy)
 
-                break
+                    break
 
-            except Exception as e:
-                logger.exception(e)
+                except Exception as e:
+                    logger.exception(e)
 
-                log_msg = 'Upload failed for {0} to {1}/{2}...'.format(filename, self.s3_bucket_url, key)
-                fails += 1
+                    log_msg = 'Upload failed for {0} to {1}/{2}...'.format(filename, self.s3_bucket_url, key)
+                    fails += 1
 
-                if fails >= retries:
-                    log_msg += ' Not retrying (Failed retries: {0})'.format(retry)
-                    logger.error(log_msg)
-                    raise
-                else:
-                    log_msg += ' Retrying'
-                    logger.info(log_msg)
+                    if fails >= retries:
+                        log_msg += ' Not retrying (Failed retries: {0})'.format(retry)
+                        logger.error(log_msg)
+                        raise
+                    else:
+                        log_msg += ' Retrying'
+                        logger.info(log_msg)
 
         size_mb = ((float(file_size) / 1024) / 1024)
         elapsed = time.time() - ping
 
-        logger.info("File {0} successfully uploaded! {1:6.1f} MiB in {2:.1f}s ({3} KiB/s)".format(
+        logger.info("File {0} successfully uploaded! {1:6.1f} MiB in {2:.1f}s ({3:.1f} MiB/s)".format(
             filename,
             size_mb,
             elapsed,
-            int(size_mb * 1000 / elapsed)))
+            throughput(file_size, elapsed)))
+
+    def upload_multipart(self, filename, key, reduced_redundancy=None, workers=None, retries=DEFAULT_PART_RETRIES):
+        """Multipart upload of a file, with the parts uploaded at the same
+        time by a pool of threads. Each thread reads its part from its own
+        file handler at the part offset, and a failed part is retried
+        without restarting the whole upload. If a part can't be uploaded,
+        the multipart upload is cancelled (so S3 doesn't keep the parts).
+
+        """
+
+        if reduced_redundancy is None:
+            reduced_redundancy = self.reduced_redundancy
+
+        parts = list(self.file_parts(filename))
+        workers = max(1, min(workers or self.upload_workers, len(parts)))
+
+        # The multipart uploads begins here
+        multipart = self.thread_bucket().initiate_multipart_upload(
+            key,
+            reduced_redundancy=reduced_redundancy)
+
+        logger.debug("Uploading {0} chunks with {1} threads (upload id: {2})".format(
+            len(parts),
+            workers,
+            multipart.id))
+
+        def upload(part):
+            return self.upload_part(multipart.id, key, filename, part, retries)
+
+        try:
+            pool = ThreadPool(workers)
+
+            try:
+                for part_number, size, elapsed in pool.imap_unordered(upload, parts):
+                    logger.debug("Chunk #{0} uploaded: {1} bytes in {2:.1f}s ({3:.1f} MiB/s)".format(
+                        part_number,
+                        size,
+                        elapsed,
+                        throughput(size, elapsed)))
+            finally:
+                # If a part failed, the pending ones are discarded and the
+                # ones being uploaded are waited for before cancelling
+                pool.terminate()
+                pool.join()
+
+            # Finish the upload
+            mp_status = multipart.complete_upload()
+
+            # Show the upload status in the logs
+            logger.debug(str(mp_status))
+
+        except Exception:
+            logger.error("Multipart upload of {0} to {1}/{2} failed, cancelling it".format(
+                filename,
+                self.s3_bucket_url,
+                key))
+
+            multipart.cancel_upload()
+            raise
+
+    def upload_part(self, upload_id, key, filename, part, retries=DEFAULT_PART_RETRIES):
+        """Uploads one part of a multipart upload, retrying it if it fails.
+        Runs in the upload threads, so it uses the bucket of the thread.
+
+        Output:
+            (part number, size, seconds spent)
+
+        """
+
+        part_number, offset, size = part
+
+        multipart = MultiPartUpload(self.thread_bucket())
+        multipart.id = upload_id
+        multipart.key_name = key
+
+        for retry in xrange(retries):
+            try:
+                ping = time.time()
+
+                with open(filename, 'rb') as input_file:
+                    input_file.seek(offset)
+
+                    multipart.upload_part_from_file(
+                        input_file,
+                        part_number,
+                        size=size)
+
+                return part_number, size, time.time() - ping
+
+            except Exception as e:
+                log_msg = "Chunk #{0} of {1} failed (offset: {2}): {3}...".format(
+                    part_number,
+                    filename,
+                    offset,
+                    e)
+
+                if retry + 1 >= retries:
+                    log_msg += ' Not retrying (Failed retries: {0})'.format(retry)
+                    logger.error(log_msg)
+                    raise
+                else:
+                    log_msg += ' Retrying'
+                    logger.warning(log_msg)
+
+                    time.sleep(PART_RETRY_DELAY * 2 ** retry)
 
     # def compress_and_upload(self, filename, key, reduced_redundancy=REDUNDANCY):
     #     with NamedTemporaryFile(delete=False) as compressed_file:
@@ -280,8 +544,19 @@ class S3BucketWrapper(object):
     #     with open(filename, 'r') as file_handler:
     #         self.upload_file(file_handler)
 
+    def file_parts(self, filename):
+        """Yields (part number, offset, size) of each chunk of a file"""
+
+        offset = 0
+
+        for part, chunk_size in self.file_offsets(filename):
+            yield (part, offset, chunk_size)
+
+            offset += chunk_size
+
     def file_offsets(self, filename):
-        """
+        """Yields (part number, size) of each chunk of a file, the last
+        chunk takes the remaining bytes when they're less than MIN_CHUNK
 
         """
 
@@ -296,7 +571,7 @@ class S3BucketWrapper(object):
             chunk_size = 0
 
             # How much bytes are left after sending one chunk
-            remaining_bytes = file_size - offset - DEFAULT_CHUNK_SIZE
+            remaining_bytes = file_size - offset - self.chunk_size
 
             # If after the upload there's more data to be uploaded...
             if remaining_bytes > 0:
@@ -309,7 +584,7 @@ class S3BucketWrapper(object):
 
                 # Otherwise, upload one complete chunk
                 else:
-                    chunk_size = DEFAULT_CHUNK_SIZE
+                    chunk_size = self.chunk_size
                     offset += chunk_size
 
             # Otherwise, just upload the remaining data
@@ -321,9 +596,69 @@ class S3BucketWrapper(object):
 
             part += 1
 
+    def iter_chunks(self, key, start=0, end=None, chunk_size=DEFAULT_READ_SIZE, retries=2):
+        """Reads a key with ranged GETs of chunk_size bytes, yielding each
+        chunk as it arrives. A failed request is retried on its own.
+
+        Input:
+            key, S3 key name to read
+            start, offset of the first byte to read
+            end, offset of the last byte to read (the end of the key if None)
+
+        """
+
+        k = self.get_key(key)
+
+        if k is None:
+            raise IOError("Key {0}/{1} not found".format(self.s3_bucket_url, key))
+
+        last_byte = k.size - 1 if end is None else min(end, k.size - 1)
+        offset = start
+
+        while offset <= last_byte:
+            range_end = min(offset + chunk_size, last_byte + 1) - 1
+
+            for retry in xrange(retries):
+                try:
+                    data = k.get_contents_as_string(
+                        headers={'Range': 'bytes={0}-{1}'.format(offset, range_end)})
+                    break
+
+                except Exception:
+                    log_msg = 'Ranged read failed for {0}/{1} (bytes {2}-{3})...'.format(
+                        self.s3_bucket_url,
+                        key,
+                        offset,
+                        range_end)
+
+                    if retry + 1 >= retries:
+                        log_msg += ' Not retrying (Failed retries: {0})'.format(retry)
+                        logger.error(log_msg)
+                        raise
+                    else:
+                        log_msg += ' Retrying'
+                        logger.info(log_msg)
+
+            if not data:
+                break
+
+            offset += len(data)
+            yield data
+
+    def iter_lines(self, key, start=0, end=None, chunk_size=DEFAULT_READ_SIZE):
+        """Streams the lines of a key, decompressing it on the fly if it's
+        a gzip file. Lines are yielded as the chunks arrive, without
+        downloading the whole key first.
+
+        """
+
+        chunks = self.iter_chunks(key, start=start, end=end, chunk_size=chunk_size)
+
+        return file_utils.stream_lines(chunks, compressed=bool(re.search('\.gz$', key)))
+
     def file_to_dicts(self, key):
-        """Fetchs a key from S3 as a temporary file and the returns a
-        generetor, which yields each line as a Python dictionary
+        """Streams a key from S3 and then returns a generetor, which
+        yields each line as a Python dictionary
 
         Input:
             key: string, name of S3 key, such as
@@ -335,26 +670,50 @@ class S3BucketWrapper(object):
 
         """
 
-        _, filename = os.path.split(key)
+        for line in self.iter_lines(key):
+            clean_line = line.strip()
 
-        with self.download_file(key, temporary=True, on_memory=True) as file_handler:
-            if re.search('\.gz$', key):
-                file_content = gzip.GzipFile(fileobj=file_handler)
-            else:
-                file_content = file_handler
+            if clean_line:
+                try:
+                    yield json.loads(clean_line)
+                except ValueError as e:
+                    logger.exception('JSON decode error: {0}'.format(e))
 
-            for line in file_content:
-                clean_line = line.strip()
+    def get_line_index(self, key):
+        """Line index of a key (see file_utils.write_line_index), uploaded
+        next to it. None if there's no index.
 
-                if clean_line:
-                    try:
-                        yield json.loads(clean_line)
-                    except ValueError as e:
-                        logger.exception('JSON decode error: {0}'.format(e))
+        """
+
+        index_key = self.get_key(key + file_utils.INDEX_SUFFIX)
+
+        if index_key is None:
+            return None
+
+        return file_utils.parse_line_index(index_key.get_contents_as_string())
+
+    def upload_line_index(self, filename, key, every=file_utils.DEFAULT_INDEX_EVERY):
+        """Builds the line index of a local file and uploads it next to
+        the key of the file.
 
-    def get_file_lines(self, key, start_line_offset=0, end_line_offset=None):
         """
 
+        index_path = file_utils.write_line_index(filename, every)
+
+        try:
+            self.upload_file(index_path, key + file_utils.INDEX_SUFFIX)
+        finally:
+            file_utils.silent_remove(index_path)
+
+    def get_file_lines(self, key, start_line_offset=0, end_line_offset=None):
+        """Yields the lines of a key from start_line_offset to
+        end_line_offset (both included, counting from 0).
+
+        With a line index for the key, only the bytes between the indexed
+        lines around the slice are read (a single ranged GET for slices
+        smaller than the read chunks). Otherwise, the key is streamed from
+        the beginning.
+
         """
 
         end_line_offset = float('inf') if end_line_offset is None else end_line_offset
@@ -365,37 +724,131 @@ class S3BucketWrapper(object):
             start_line_offset,
             end_line_offset))
 
-        with self.download_file(key, temporary=True, on_memory=True) as file_handler:
-            if re.search('\.gz$', key):
-                new_handler = gzip.GzipFile(fileobj=file_handler)
-            else:
-                new_handler = file_handler
+        index = self.get_line_index(key) or [(0, 0)]
+
+        # Last indexed line before the slice, and first one after it
+        first_line, start = index[bisect.bisect_right(index, (start_line_offset, float('inf'))) - 1]
+        following = bisect.bisect_right(index, (end_line_offset, float('inf')))
+        end = index[following][1] - 1 if following < len(index) else None
+
+        logger.debug("Reading bytes {0}-{1} (line {2})".format(start, end, first_line))
+
+        for line_count, line in enumerate(self.iter_lines(key, start=start, end=end), start=first_line):
+            if start_line_offset <= line_count <= end_line_offset:
+                yield line
+            elif line_count > end_line_offset:
+                break
+
+    def list_partitions(self, pool, prefix='', partitions=None, max_depth=DEFAULT_LIST_DEPTH):
+        """Splits the keys under a prefix in disjoint prefixes (i.e. one
+        per date of the hourly archives), going down the '/' levels until
+        there are enough of them to be listed in parallel. The prefixes of
+        each level are listed at the same time by the pool.
 
-            return file_utils.get_lines_from_handler(
-                new_handler,
-                start_line_offset=start_line_offset,
-                end_line_offset=end_line_offset)
+        Output:
+            (prefixes, keys): the prefixes, sorted, and the keys found on
+            the way (the ones not inside any of the prefixes)
+
+        """
+
+        partitions = partitions or self.upload_workers * 4
+        prefixes = [prefix]
+        keys = []
+
+        def list_level(current):
+            return list(self.thread_bucket().list(prefix=current, delimiter='/'))
+
+        for depth in xrange(max_depth):
+            if len(prefixes) >= partitions:
+                break
+
+            found = []
+
+            for items in pool.imap(list_level, prefixes):
+                for item in items:
+                    if isinstance(item, Prefix):
+                        found.append(item.name)
+                    else:
+                        keys.append(item)
+
+            prefixes = found
 
-    def find_keys(self, regexp, prefix='', return_real_key=False):
+            if not prefixes:
+                break
+
+        return sorted(prefixes), sorted(keys, key=lambda key: key.name)
+
+    def list_keys(self, prefix='', workers=None):
+        """Lists the keys under a prefix, with a pool of threads listing
+        its partitions (see list_partitions) at the same time. Keys are
+        yielded in the order of their partitions.
+
+        """
+
+        workers = workers or self.upload_workers
+
+        def list_prefix(partition):
+            return list(self.thread_bucket().list(prefix=partition))
+
+        pool = ThreadPool(workers)
+
+        try:
+            prefixes, keys = self.list_partitions(pool, prefix, partitions=workers * 4)
+
+            for partition_keys in itertools.chain([keys], pool.imap(list_prefix, prefixes)):
+                for key in partition_keys:
+                    yield key
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def find_keys(self, regexp, prefix='', return_real_key=False, workers=None):
         """This function returns a list of key names that match the regexp.
 
+        Only the keys under the literal start of the regexp (when it's
+        anchored with '^') are listed, so '^summaries/2014-04-.*\\.gz$'
+        lists summaries/2014-04- and not the whole bucket.
+
         """
 
+        pattern = re.compile(regexp)
+        search_prefix = narrow_prefix(prefix, literal_prefix(regexp))
+
         logger.debug("Searching for pattern '{0}', Using prefix '{1}' on {2}".format(
             regexp,
-            prefix,
+            search_prefix,
             self.s3_bucket_url))
 
-        pattern = re.compile(regexp)
+        if search_prefix is None:
+            # The prefix and the regexp can't match the same keys
+            return
 
-        for key in self.boto_bucket.list(prefix=prefix):
+        for key in self.list_keys(search_prefix, workers):
             if pattern.search(key.name):
                 if return_real_key:
                     yield key
                 else:
                     yield key.name
 
-    def delete_keys(self, keys=None, regexp=None, prefix=''):
+    def delete_batch(self, keys):
+        """Deletes up to DELETE_BATCH keys with a single request"""
+
+        results = self.thread_bucket().delete_keys(keys)
+
+        for result in results.errors:
+            logger.error("Couldn't delete key {0}: {1} ({2})".format(
+                result.key,
+                result.message,
+                result.code))
+
+        for result in results.deleted:
+            logger.debug("Key {0} deleted (DeleteMarker: {1})".format(
+                result.key,
+                result.delete_marker))
+
+        return len(results.deleted), len(results.errors)
+
+    def delete_keys(self, keys=None, regexp=None, prefix='', workers=None):
         """Deletes a set of keys. If the keys parameter is specified,
         it's assumed that it is an iterable with the keys to be deleted.
 
@@ -404,34 +857,44 @@ class S3BucketWrapper(object):
         Optionally, a prefix could be specified to make the search for keys
         faster.
 
+        Keys are deleted in batches of DELETE_BATCH keys (the most a
+        request takes), several batches at once.
+
         """
 
         if regexp:
             search_pattern = 'regexp'
-            keys = self.find_keys(regexp, prefix)
+            keys = self.find_keys(regexp, prefix, workers=workers)
         # This conditions is here for debugging purposes (look at the log message below!)
         elif keys:
             search_pattern = 'key list'
         else:
             raise ValueError("None of the parameters are valid [keys: {0} / regexp: {1}]".format(keys, regexp))
 
+        workers = workers or self.upload_workers
+
         deleted_count = 0
         error_count = 0
 
-        if keys:
-            results = self.boto_bucket.delete_keys(keys)
+        batches = batched(keys, DELETE_BATCH)
+        pool = ThreadPool(workers)
+
+        try:
+            while True:
+                # A few batches at a time, not to keep all the keys in memory
+                wave = list(itertools.islice(batches, workers * 2))
 
-            for error_count, result in enumerate(results.errors, start=1):
-                logger.error("Couldn't delete key {0}: {1} ({2})".format(
-                    result.key,
-                    result.message,
-                    result.code))
+                if not wave:
+                    break
 
-            for deleted_count, result in enumerate(results.deleted, start=1):
-                logger.debug("Key {0} deleted (DeleteMarker: {1})".format(
-                    result.key,
-                    result.delete_marker))
+                for deleted, errors in pool.imap_unordered(self.delete_batch, wave):
+                    deleted_count += deleted
+                    error_count += errors
+        finally:
+            pool.terminate()
+            pool.join()
 
+        if deleted_count or error_count:
             logger.info("{0} keys deleted, {1} with errors [Using {2}]".format(
                 deleted_count,
                 error_count,
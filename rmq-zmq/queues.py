@@ -4,45 +4,137 @@
 
 This scripts implements a queue using ZeroMQ to receive and deliver messages.
 
+The messages are delivered to the archivers using a credit based protocol
+(see flow_control.py), so only archivers with available credits receive
+messages, and messages are kept until the archivers acknowledge them.
+
 Example:
     Queues usage example as follows:
-    usage: python queues.py
+    usage: python queues.py [-b BROKER] [-e ENDPOINT] [-rk ROUTING_KEY]
+
+Arguments:
+  -b,  --broker         broker endpoint to subscribe to
+  -e,  --endpoint       endpoint where the archivers connect
+  -rk, --routing_key    routing keys to subscribe to
 
 """
 
 __author__ = "Nicolas Estrada"
 __version__ = "0.0.1"
 
-import sys
+import argparse
 
 import zmq
 
+import flow_control
+import tracing
+
 from message_profiler import MessageProfiler
 
+parser = argparse.ArgumentParser(
+    description="""Queue that subscribes to the broker and delivers the
+    messages to the archivers.""",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument(
+    '-b',
+    '--broker',
+    default='tcp://localhost:11001',
+    help='broker endpoint to subscribe to')
+parser.add_argument(
+    '-e',
+    '--endpoint',
+    default='tcp://*:12001',
+    help='endpoint where the archivers connect')
+parser.add_argument(
+    '-rk',
+    '--routing_key',
+    nargs='+',
+    default=['routing_key.example'],
+    help='routing keys to subscribe to')
+
+args = parser.parse_args()
+
 # Getting context and defining bindings
 context = zmq.Context()
 
 queue = context.socket(zmq.SUB)
-pub = context.socket(zmq.PUSH)
+pub = context.socket(zmq.ROUTER)
+
+queue.connect(args.broker)
+for routing_key in args.routing_key:
+    queue.setsockopt(zmq.SUBSCRIBE, routing_key)
+
+pub.bind(args.endpoint)
+
+dispatcher = flow_control.CreditDispatcher()
+
+poller = zmq.Poller()
+poller.register(pub, zmq.POLLIN)
+
+# Milliseconds
+POLL_TIMEOUT = int(flow_control.HEARTBEAT_INTERVAL * 1000)
+
 
-queue.connect("tcp://localhost:11001")
-queue.setsockopt(zmq.SUBSCRIBE, 'routing_key.example')
+def deliver(mp, delivery):
+    identity, seq, frames = delivery
+    pub.send_multipart([identity, flow_control.MESSAGE, seq] + frames)
+    mp.msg_sent(len(frames[0]) + len(frames[1]))
+
+
+def handle_archiver(frames):
+    identity, command = frames[0], frames[1]
+
+    if command == flow_control.READY:
+        dispatcher.ready_peer(identity, int(frames[2]))
+    elif command == flow_control.CREDIT:
+        if not dispatcher.credit_peer(identity, frames[3:]):
+            pub.send_multipart([identity, flow_control.RESET])
 
-pub.bind("tcp://*:12001")
 
 try:
     with MessageProfiler(True) as mp:
+        reading = False
+
         # Broker (receive and deliver)
         while True:
-            rkey, message = queue.recv_multipart()
-            bytes = sys.getsizeof(rkey + message)
-            mp.msg_received(bytes)
+            # Only read from the broker when some archiver can take the
+            # messages, otherwise they are left in the SUB socket buffer
+            if dispatcher.has_credits() != reading:
+                reading = not reading
+
+                if reading:
+                    poller.register(queue, zmq.POLLIN)
+                else:
+                    poller.unregister(queue)
+
+            events = dict(poller.poll(POLL_TIMEOUT))
+
+            if pub in events:
+                handle_archiver(pub.recv_multipart())
+
+            # Messages waiting for credits are delivered first
+            delivery = dispatcher.next_pending()
+            while delivery is not None:
+                deliver(mp, delivery)
+                delivery = dispatcher.next_pending()
+
+            if queue in events:
+                frames = queue.recv_multipart()
+                mp.msg_received(len(frames[0]) + len(frames[1]))
+
+                # Optional trace frame
+                if len(frames) > 2:
+                    frames[2] = tracing.stamp(frames[2])
+
+                delivery = dispatcher.next_delivery(frames)
+                if delivery is not None:
+                    deliver(mp, delivery)
 
-            # print("Received and sending message [%s] RKEY: [%s]" % (message, rkey))
-            # processing, persistence?, ACK handling ?
+            dispatcher.expire_peers()
 
-            pub.send_multipart([rkey, message])
-            mp.msg_sent(bytes)
+            mp.gauge('queue_depth', len(dispatcher.pending))
+            mp.gauge('archivers', len(dispatcher.peers))
 except:
     queue.close()
     pub.close()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Replay documentation.
+
+This scripts streams the hourly files written by the archiver
+(messages/<source>/<YYYY-MM-DD>/HH00.txt[.gz|.msgpack]) back into the
+broker, preserving the original inter-arrival gaps (the "dt" field of
+each archived record) scaled by a speed factor, or as fast as possible.
+
+Each file is split between parallel readers, reader i of N sending its
+records i, i + N, i + 2N... (so a single big file is replayed in parallel
+too). They all share the same clock: a record is sent at
+start + (dt - first dt) / speed, no matter which reader handles it, so
+the merged stream keeps the original ordering in time. Every reader goes
+through the whole files (decompressing them), but only decodes and sends
+its own records.
+
+Example:
+    Replay usage example as follows:
+    usage: python replay.py -x 10 messages/thesis/2014-04-18
+
+Arguments:
+  paths                 archived files or folders (searched recursively)
+  -e,  --endpoint       broker PULL endpoint
+  -x,  --speed          speed factor (0 = as fast as possible)
+  -rd, --readers        parallel reader processes
+  -rk, --routing_key    override the archived routing keys
+  -t,  --trace          add a trace frame (see tracing.py) to each message
+
+"""
+
+from __future__ import division
+
+__author__ = "Nicolas Estrada"
+__version__ = "0.0.1"
+
+import os
+import time
+import argparse
+import multiprocessing
+
+import zmq
+import msgpack
+
+import tracing
+
+from message_profiler import MessageProfiler
+from python_utils import file_utils
+from python_utils.jsonhandler import json
+
+DEFAULT_ENDPOINT = "tcp://localhost:10001"
+ARCHIVE_EXTENSIONS = ('.txt', '.gz', '.msgpack')
+
+# Seconds given to the readers to start before the first record is sent
+START_DELAY = 1.0
+SPIN_THRESHOLD = 0.002
+
+
+def find_files(paths):
+    """Expands the folders in paths, returning the archived files sorted"""
+
+    files = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                files.extend(
+                    os.path.join(dirpath, filename)
+                    for filename in filenames
+                    if filename.endswith(ARCHIVE_EXTENSIONS))
+        else:
+            files.append(path)
+
+    return sorted(files)
+
+
+def read_records(path, part=0, parts=1):
+    """Yields the archived records ({"rk": [...], "dt": ..., "msg": ...})
+    of a plain, gzip or msgpack file, only the records part, part + parts,
+    part + 2 * parts... when the file is split in parts.
+    """
+
+    position = 0
+
+    if path.endswith('.msgpack'):
+        with open(path, 'rb') as file_r:
+            # The archiver writes a '\n' after each packed record, which
+            # is unpacked as the integer 10
+            for record in msgpack.Unpacker(file_r):
+                if isinstance(record, dict):
+                    if position % parts == part:
+                        yield record
+                    position += 1
+    else:
+        for line in file_utils.get_lines(path):
+            if line.strip():
+                # Lines of the other parts aren't even decoded
+                if position % parts == part:
+                    yield json.loads(line)
+                position += 1
+
+
+def to_frames(record, routing_key=None):
+    """Rebuilds the (rkey, message) frames received by the archiver"""
+
+    msg = record['msg']
+
+    if isinstance(msg, unicode):
+        body = msg.encode('utf-8')
+    elif isinstance(msg, str):
+        body = msg
+    else:
+        body = json.dumps(msg)
+
+    if routing_key is None:
+        routing_key = '.'.join(record['rk'])
+
+    return [str(routing_key), body]
+
+
+def first_dt(path):
+    for record in read_records(path):
+        return record['dt']
+
+    return None
+
+
+def reader(files, part, parts, endpoint, speed, start_at, base_dt, routing_key,
+           trace):
+    """Sends a part of the records of the files (see read_records),
+    waiting for the scheduled time of each one (unless speed is 0)
+    """
+
+    context = zmq.Context()
+    socket = context.socket(zmq.PUSH)
+    socket.connect(endpoint)
+
+    origin = os.getpid()
+    seq = 0
+
+    try:
+        with MessageProfiler(True) as mp:
+            for path in files:
+                for record in read_records(path, part, parts):
+                    if speed > 0:
+                        send_at = start_at + (record['dt'] - base_dt) / 1000 / speed
+                        wait = send_at - time.time()
+
+                        if wait > SPIN_THRESHOLD:
+                            time.sleep(wait - SPIN_THRESHOLD)
+
+                        while time.time() < send_at:
+                            pass
+
+                    frames = to_frames(record, routing_key)
+                    mp.msg_sent(len(frames[0]) + len(frames[1]))
+
+                    if trace:
+                        frames.append(tracing.new_trace(origin, seq))
+                        seq += 1
+
+                    socket.send_multipart(frames)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        socket.close()
+        context.term()
+
+
+def replay(paths, endpoint=DEFAULT_ENDPOINT, speed=1, readers=1,
+           routing_key=None, trace=False):
+    files = find_files(paths)
+
+    if not files:
+        raise ValueError("No archived files found in {0}".format(paths))
+
+    dts = [dt for dt in (first_dt(path) for path in files) if dt is not None]
+    base_dt = min(dts) if dts else 0
+
+    readers = max(1, readers)
+    start_at = time.time() + START_DELAY
+
+    # Every reader takes its part of each file, so they all send through
+    # the whole replay, whatever the number and size of the files
+    processes = [
+        multiprocessing.Process(
+            target=reader,
+            args=(files, i, readers, endpoint, speed, start_at, base_dt,
+                  routing_key, trace))
+        for i in xrange(readers)]
+
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="""Replays archived files into the broker, keeping the
+        original inter-arrival times scaled by a speed factor.""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        'paths',
+        nargs='+',
+        help='archived files or folders')
+    parser.add_argument(
+        '-e',
+        '--endpoint',
+        default=DEFAULT_ENDPOINT,
+        help='broker endpoint')
+    parser.add_argument(
+        '-x',
+        '--speed',
+        type=float,
+        default=1,
+        help='speed factor (0 = as fast as possible)')
+    parser.add_argument(
+        '-rd',
+        '--readers',
+        type=int,
+        default=1,
+        help="""parallel reader processes, each one sending every Nth
+        record of each file""")
+    parser.add_argument(
+        '-rk',
+        '--routing_key',
+        help='routing key used instead of the archived one')
+    parser.add_argument(
+        '-t',
+        '--trace',
+        action='store_true',
+        help='add a trace frame to each message')
+
+    args = parser.parse_args()
+
+    replay(args.paths, args.endpoint, args.speed, args.readers,
+           args.routing_key, args.trace)
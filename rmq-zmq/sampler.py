@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Sampler documentation.
+
+Sampling CPU profiler for long-running processes. While active, a
+background thread takes the stacks of the other threads every few
+milliseconds (sys._current_frames()), and when the window is over they
+are written as collapsed stacks, one line per distinct stack with the
+amount of samples:
+
+    thread;archiver.py:<module>;archiver.py:main;archiver.py:handle_message 42
+
+which is the input of flamegraph.pl (or speedscope, inferno...):
+
+    flamegraph.pl archiver-1234-20150101-120000.collapsed > archiver.svg
+
+The overhead is a walk of the stacks per sample and only while sampling,
+so it can be used on production processes without restarting them.
+MessageProfiler installs it in every pipeline process:
+
+    kill -USR2 <pid>        starts sampling for SAMPLER_DURATION seconds
+                            (a second signal stops it early)
+
+Environment variables:
+  SAMPLER_DURATION     seconds of each sampling window (default 30)
+  SAMPLER_INTERVAL     milliseconds between samples (default 10)
+  SAMPLER_OUTPUT       folder of the collapsed stack files (default /tmp)
+  SAMPLER_START        start sampling as soon as the process starts
+
+"""
+
+from __future__ import division
+
+__author__ = "Nicolas Estrada"
+__version__ = "0.0.1"
+
+import os
+import sys
+import time
+import signal
+import threading
+
+DEFAULT_DURATION = 30.0
+DEFAULT_INTERVAL = 10.0  # Milliseconds
+DEFAULT_OUTPUT = '/tmp'
+
+SAMPLE_SIGNAL = signal.SIGUSR2
+
+FILENAME_TEMPLATE = "{name}-{pid}-{ts}.collapsed"
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "{0}:{1}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+def collapse(frame):
+    """Stack of a frame as a string, from the outermost call"""
+
+    names = []
+
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+
+    names.reverse()
+    return ';'.join(names)
+
+
+class StackSampler(object):
+
+    def __init__(self, name, duration=None, interval=None, output=None):
+        self.name = name
+        self.duration = float(
+            duration or os.environ.get('SAMPLER_DURATION', DEFAULT_DURATION))
+        self.interval = float(
+            interval or os.environ.get('SAMPLER_INTERVAL', DEFAULT_INTERVAL))
+        self.output = output or os.environ.get('SAMPLER_OUTPUT', DEFAULT_OUTPUT)
+
+        self.stacks = {}
+        self.samples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+        self.path = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return False
+
+        self.stacks = {}
+        self.samples = 0
+        self.stopped.clear()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """Stops sampling, waiting for the stacks to be written"""
+
+        if self.running:
+            self.stopped.set()
+            self.thread.join()
+
+    def toggle(self):
+        if not self.start():
+            # Stopping from the signal handler can't wait for the thread,
+            # it could be waiting for the main thread (i.e. the GIL)
+            self.stopped.set()
+
+    def sample(self):
+        own = threading.current_thread().ident
+        names = dict((thread.ident, thread.name)
+                     for thread in threading.enumerate())
+
+        for ident, frame in sys._current_frames().iteritems():
+            if ident == own:
+                continue
+
+            stack = "{0};{1}".format(
+                names.get(ident, 'thread-{0}'.format(ident)), collapse(frame))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+        self.samples += 1
+
+    def _run(self):
+        interval = self.interval / 1000
+        deadline = time.time() + self.duration
+
+        while time.time() < deadline and not self.stopped.wait(interval):
+            self.sample()
+
+        self.path = self.dump()
+
+    def dump(self):
+        if not os.path.isdir(self.output):
+            os.makedirs(self.output)
+
+        path = os.path.join(self.output, FILENAME_TEMPLATE.format(
+            name=self.name,
+            pid=os.getpid(),
+            ts=time.strftime('%Y%m%d-%H%M%S')))
+
+        with open(path, 'w') as output:
+            for stack, count in sorted(self.stacks.iteritems()):
+                output.write("{0} {1}\n".format(stack, count))
+
+        sys.stderr.write("Sampler: {0} samples written to {1}\n".format(
+            self.samples, path))
+
+        return path
+
+
+def install(name):
+    """Returns a StackSampler started by SIGUSR2 (when the signal is not
+    used by the process already), and right away if SAMPLER_START is set.
+    """
+
+    sampler = StackSampler(name)
+
+    # Signal handlers can only be set from the main thread
+    if (isinstance(threading.current_thread(), threading._MainThread)
+            and signal.getsignal(SAMPLE_SIGNAL) == signal.SIG_DFL):
+        signal.signal(SAMPLE_SIGNAL, lambda signum, frame: sampler.toggle())
+
+    if os.environ.get('SAMPLER_START'):
+        sampler.start()
+
+    return sampler
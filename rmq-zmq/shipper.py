@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Shipper documentation.
+
+This scripts ships the hourly files written by the archiver to S3. It
+watches the raw, valid and invalid trees
+(<path>/<source>/<YYYY-MM-DD>/HH00.txt[.gz|.msgpack]) and, once an hour
+bucket is closed (the hour is over, plus a grace period for late
+messages, and the file is not being written anymore), it uploads it and
+deletes the local copy.
+
+Each file is read once: it's compressed into a temporary gzip file while
+its line index (see file_utils.write_line_index) and the md5 digests of
+the upload (see s3.UploadDigest) are computed, so the upload can be
+verified against the ETag given by S3 without reading anything again.
+The gzip file has a member every --index_every lines, which are the
+starting points of the index. Several files are shipped at once.
+
+Keys are <prefix>/<tree>/<source>/<YYYY-MM-DD>/HH00.txt.gz (.msgpack.gz
+for msgpack files), with the index in the same key plus .idx. If the key
+already exists (i.e. late messages after the bucket was shipped), a
+number is added to the name instead of overwriting it.
+
+Example:
+    Shipper usage example as follows:
+    usage: python shipper.py -v thesis -b my-bucket -w 4
+
+Arguments:
+  -c,  --config_file    config file name within config/ folder to be used
+  -v,  --vhost          vhost to be used (included in a config section)
+  -b,  --bucket         S3 bucket (s3_bucket in the config)
+  -p,  --prefix         prefix of the keys (s3_prefix in the config)
+  -w,  --workers        files shipped at the same time
+  -g,  --grace          seconds after the end of an hour before shipping it
+  -st, --settle         seconds without changes before shipping a file
+  -i,  --interval       seconds between scans of the trees
+  -ie, --index_every    lines between the gzip members (and index entries)
+  -k,  --keep           don't delete the local files once shipped
+  -o,  --once           ship what is closed and exit
+
+The S3 credentials are taken from AWS_ACCESS_KEY_ID and
+AWS_SECRET_ACCESS_KEY.
+
+"""
+
+from __future__ import division
+
+__author__ = "Nicolas Estrada"
+__version__ = "0.0.1"
+
+import os
+import re
+import time
+import zlib
+import calendar
+import argparse
+import tempfile
+import datetime
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from python_utils import config_loader, file_utils, logging_manager
+from python_utils.s3 import S3BucketWrapper, UploadDigest
+
+TREES = ('raw', 'valid', 'invalid')
+DEFAULT_PREFIX = 'hourly-archive'
+
+# <YYYY-MM-DD>/HH00.txt[.gz|.msgpack], as written by the archiver
+ARCHIVE_PATTERN = re.compile(
+    r'(?P<date>\d{4}-\d{2}-\d{2})/(?P<hour>\d{2})00\.txt(?P<ext>\.gz|\.msgpack)?$')
+
+HOUR = 3600
+COMPRESSION_LEVEL = 6
+
+# Keys being shipped by the workers, so two files of the same hour (i.e.
+# HH00.txt and HH00.txt.gz) never take the same key. The keys of an hour
+# are chosen by one worker at a time (KEY_LOCKS, by the key without
+# number).
+CLAIMED_KEYS = set()
+KEY_LOCKS = {}
+CLAIM_LOCK = threading.Lock()
+
+SCRIPT_DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Shipper that uploads the closed hourly files of the
+        archivers to S3, deleting them once verified.""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        '-c',
+        '--config_file',
+        default='archiver.yaml',
+        help='config file to be used')
+    parser.add_argument(
+        '-v',
+        '--vhost',
+        default='default',
+        help='vhost to be used')
+    parser.add_argument(
+        '-b',
+        '--bucket',
+        help='S3 bucket')
+    parser.add_argument(
+        '-p',
+        '--prefix',
+        help='prefix of the keys')
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=4,
+        help='files shipped at the same time')
+    parser.add_argument(
+        '-g',
+        '--grace',
+        type=int,
+        default=600,
+        help='seconds after the end of an hour before shipping it')
+    parser.add_argument(
+        '-st',
+        '--settle',
+        type=int,
+        default=120,
+        help='seconds without changes before shipping a file')
+    parser.add_argument(
+        '-i',
+        '--interval',
+        type=int,
+        default=60,
+        help='seconds between scans of the trees')
+    parser.add_argument(
+        '-ie',
+        '--index_every',
+        type=int,
+        default=file_utils.DEFAULT_INDEX_EVERY,
+        help='lines between the gzip members (and index entries)')
+    parser.add_argument(
+        '-k',
+        '--keep',
+        action='store_true',
+        help="don't delete the local files once shipped")
+    parser.add_argument(
+        '-o',
+        '--once',
+        action='store_true',
+        help='ship what is closed and exit')
+
+    args = parser.parse_args()
+
+    logger = logging_manager.start_logger('shipper', use_root_logger=False)
+
+    config = config_loader.load(args.config_file, section=args.vhost)
+
+    STORAGE_PATHS = {
+        'raw': os.path.join(SCRIPT_DIRNAME, config['storage_path']),
+        'valid': os.path.join(SCRIPT_DIRNAME, config['valid_path']),
+        'invalid': os.path.join(SCRIPT_DIRNAME, config['invalid_path'])
+    }
+
+
+def bucket_end(date, hour):
+    """Timestamp of the end of an hour bucket (the archiver uses UTC)"""
+
+    start = datetime.datetime.strptime(date, '%Y-%m-%d').replace(hour=int(hour))
+    return calendar.timegm(start.timetuple()) + HOUR
+
+
+def closed_files(now):
+    """Yields (tree, path, relative path) of the files of closed hours"""
+
+    for tree in TREES:
+        root = STORAGE_PATHS[tree]
+
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                relative = os.path.relpath(path, root)
+                match = ARCHIVE_PATTERN.search(relative)
+
+                if match is None:
+                    continue
+
+                end = bucket_end(match.group('date'), match.group('hour'))
+
+                try:
+                    modified = os.stat(path).st_mtime
+                except OSError:
+                    continue
+
+                if now >= end + args.grace and now - modified >= args.settle:
+                    yield tree, path, relative
+
+
+def compress(path, output, digest, every):
+    """Compresses a file into output, a new gzip member every 'every'
+    lines, feeding the digest with what is written. Returns the line index
+    of the output (only for text files).
+    """
+
+    if path.endswith('.msgpack'):
+        # Not made of lines, it goes in a single member
+        with open(path, 'rb') as input_file:
+            pieces = file_utils.read_chunks(input_file)
+            return write_members(((0, piece) for piece in pieces), output, digest, None)
+
+    with open(path, 'rb') as input_file:
+        lines = file_utils.stream_lines(
+            file_utils.read_chunks(input_file),
+            compressed=path.endswith('.gz'))
+
+        return write_members(enumerate(lines), output, digest, every)
+
+
+def write_members(numbered, output, digest, every):
+    index = [(0, 0)]
+    compressor = None
+    member_start = 0
+    offset = 0
+
+    def write(data):
+        if data:
+            output.write(data)
+            digest.update(data)
+        return len(data)
+
+    for number, data in numbered:
+        if compressor is None:
+            compressor = zlib.compressobj(
+                COMPRESSION_LEVEL, zlib.DEFLATED, file_utils.GZIP_WBITS)
+
+        offset += write(compressor.compress(data))
+
+        if every and number + 1 - member_start >= every:
+            offset += write(compressor.flush())
+            compressor = None
+            member_start = number + 1
+            index.append((member_start, offset))
+
+    if compressor is not None:
+        offset += write(compressor.flush())
+    elif len(index) > 1:
+        # The last member ended with the file
+        index.pop()
+
+    return index if every else None
+
+
+def numbered_keys(key):
+    """The key, then the key with a number: HH00.txt.gz, HH00-1.txt.gz..."""
+
+    name, ext = key, ''
+    match = re.search(r'(\.txt|\.msgpack)\.gz$', key)
+    if match:
+        name, ext = key[:match.start()], key[match.start():]
+
+    yield key
+
+    number = 0
+    while True:
+        number += 1
+        yield "{0}-{1}{2}".format(name, number, ext)
+
+
+def same_upload(uploaded, digest):
+    return uploaded.etag.strip('"') == digest.etag() and uploaded.size == digest.size
+
+
+def claim_key(s3, key, digest):
+    """Takes the first key (see numbered_keys) that is free, or that
+    already has this data: a file shipped before the shipper could
+    delete it (or upload its index) is not uploaded again. Returns
+    (key, already shipped). The key must be released with release_key.
+    """
+
+    with CLAIM_LOCK:
+        key_lock = KEY_LOCKS.setdefault(key, threading.Lock())
+
+    with key_lock:
+        for candidate in numbered_keys(key):
+            with CLAIM_LOCK:
+                if candidate in CLAIMED_KEYS:
+                    continue
+
+            uploaded = s3.get_key(candidate)
+
+            if uploaded is None or same_upload(uploaded, digest):
+                with CLAIM_LOCK:
+                    CLAIMED_KEYS.add(candidate)
+                return candidate, uploaded is not None
+
+
+def release_key(key):
+    with CLAIM_LOCK:
+        CLAIMED_KEYS.discard(key)
+
+
+def upload(s3, filename, key, digest):
+    """Uploads a file and verifies it against its digest, deleting the
+    key if it doesn't match. Returns True if it was uploaded."""
+
+    s3.upload_file(filename, key)
+
+    uploaded = s3.get_key(key)
+
+    if uploaded is not None and same_upload(uploaded, digest):
+        return True
+
+    logger.error("Verification failed for {0}: ETag {1}, expected {2}".format(
+        key,
+        uploaded.etag if uploaded is not None else None,
+        digest.etag()))
+
+    if uploaded is not None:
+        s3.delete_keys(keys=[key])
+
+    return False
+
+
+def upload_index(s3, index, key):
+    with tempfile.NamedTemporaryFile(suffix=file_utils.INDEX_SUFFIX) as index_file:
+        for line_number, offset in index:
+            index_file.write("{0} {1}\n".format(line_number, offset))
+        index_file.flush()
+
+        s3.upload_file(index_file.name, key + file_utils.INDEX_SUFFIX)
+
+
+def ship(s3, prefix, tree, path, relative):
+    """Compresses, uploads and verifies a file, deleting it when done.
+    Returns True if it was shipped.
+    """
+
+    ping = time.time()
+
+    if relative.endswith('.gz'):
+        relative = relative[:-len('.gz')]
+
+    with tempfile.NamedTemporaryFile(suffix='.gz') as output:
+        digest = UploadDigest(s3.chunk_size)
+        index = compress(path, output, digest, args.index_every)
+        output.flush()
+
+        key, shipped = claim_key(s3, '/'.join([prefix, tree, relative + '.gz']), digest)
+
+        try:
+            if shipped:
+                logger.info("{0} was already shipped to {1}".format(path, key))
+            elif not upload(s3, output.name, key, digest):
+                # The local file is shipped again in the next scan
+                return False
+
+            # Uploaded again if it's there, it may be what failed before
+            if index is not None:
+                upload_index(s3, index, key)
+        finally:
+            release_key(key)
+
+    logger.info("{0} shipped to {1}/{2} ({3} bytes, md5 {4}) in {5:.1f}s".format(
+        path,
+        s3.s3_url,
+        key,
+        digest.size,
+        digest.hexdigest(),
+        time.time() - ping))
+
+    if not args.keep:
+        file_utils.silent_remove(path)
+
+        # The date folder goes away with its last file
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    return True
+
+
+def main():
+    s3 = S3BucketWrapper(
+        os.environ.get('AWS_ACCESS_KEY_ID'),
+        os.environ.get('AWS_SECRET_ACCESS_KEY'),
+        args.bucket or config['s3_bucket'],
+        host=config.get('s3_host'))
+
+    prefix = (args.prefix or config.get('s3_prefix', DEFAULT_PREFIX)).strip('/')
+
+    pool = ThreadPool(args.workers)
+
+    def ship_file(closed):
+        try:
+            return ship(s3, prefix, *closed)
+        except Exception:
+            logger.exception("Couldn't ship {0}".format(closed[1]))
+            return False
+
+    try:
+        while True:
+            closed = list(closed_files(time.time()))
+
+            if closed:
+                logger.info("Shipping {0} files".format(len(closed)))
+
+                results = pool.map(ship_file, closed, chunksize=1)
+
+                logger.info("{0} files shipped, {1} failed".format(
+                    results.count(True),
+                    results.count(False)))
+
+            if args.once:
+                break
+
+            time.sleep(args.interval)
+
+    except KeyboardInterrupt:
+        logger.info("Keyboard Interrupt... finishing")
+
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    logger.info('Starting the Shipper')
+    main()
+    logger.info('Shipper finished')
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tracing documentation.
+
+Optional trace frame sent after the (rkey, message) frames, used to
+measure the latency of each hop of the pipeline without decoding the
+payload:
+
+    [rkey, message, trace]
+
+The trace frame is binary: a header with the origin id, the sequence
+number and the origin timestamp, followed by one timestamp per hop
+appended by each process that forwards the message:
+
+    !IQd     origin (feeder id), sequence number, origin timestamp
+    !d ...   hop timestamps (broker, queue, archiver)
+
+Stamping is just appending 8 bytes to the frame.
+
+"""
+
+from __future__ import division
+
+__author__ = "Nicolas Estrada"
+__version__ = "0.0.1"
+
+import time
+import struct
+
+from histogram import Histogram, DEFAULT_PERCENTILES
+
+HEADER = struct.Struct('!IQd')
+STAMP = struct.Struct('!d')
+
+HOPS = ('feeder', 'broker', 'queue', 'archiver')
+
+REPORT_STR = ("{hop}: count={count} mean={mean:.0f}us "
+              "p50={p50}us p99={p99}us p99.9={p999}us max={max}us")
+
+
+def new_trace(origin, seq, timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    return HEADER.pack(origin & 0xffffffff, seq, timestamp)
+
+
+def stamp(trace, timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    return trace + STAMP.pack(timestamp)
+
+
+def parse(trace):
+    """Returns (origin, seq, timestamps), being timestamps[0] the origin
+    timestamp and the rest the timestamps of each hop.
+    """
+
+    origin, seq, origin_ts = HEADER.unpack_from(trace)
+    hops = (len(trace) - HEADER.size) // STAMP.size
+    timestamps = [origin_ts]
+    timestamps.extend(
+        STAMP.unpack_from(trace, HEADER.size + i * STAMP.size)[0]
+        for i in xrange(hops))
+
+    return origin, seq, timestamps
+
+
+class SequenceTracker(object):
+    """Detects gaps (lost messages) and reordering (late or duplicated
+    messages) from the sequence numbers of each origin.
+
+    Note that with several archivers each one only gets a share of the
+    sequence numbers, so gaps are only meaningful with a single archiver
+    (or adding up the missing counts of all of them).
+    """
+
+    def __init__(self):
+        self.expected = {}
+        self.gaps = 0
+        self.missing = 0
+        self.reordered = 0
+
+    def track(self, origin, seq):
+        expected = self.expected.get(origin)
+
+        if expected is None or seq == expected:
+            self.expected[origin] = seq + 1
+        elif seq > expected:
+            self.gaps += 1
+            self.missing += seq - expected
+            self.expected[origin] = seq + 1
+        else:
+            self.reordered += 1
+
+
+class TraceCollector(object):
+    """Keeps a latency histogram (in microseconds) per hop, plus the end
+    to end latency, and tracks the sequence numbers.
+    """
+
+    def __init__(self, hops=HOPS):
+        self.hops = hops
+        self.names = ['{0}->{1}'.format(hops[i], hops[i + 1])
+                      for i in xrange(len(hops) - 1)]
+        self.histograms = dict((name, Histogram()) for name in self.names)
+        self.histograms['end_to_end'] = Histogram()
+        self.sequences = SequenceTracker()
+
+    def record(self, trace):
+        origin, seq, timestamps = parse(trace)
+
+        self.sequences.track(origin, seq)
+
+        for name, start, end in zip(self.names, timestamps, timestamps[1:]):
+            self.histograms[name].record((end - start) * 1000000)
+
+        # End to end latency (seconds)
+        latency = timestamps[-1] - timestamps[0]
+
+        if len(timestamps) > 1:
+            self.histograms['end_to_end'].record(latency * 1000000)
+
+        return latency
+
+    def reset(self):
+        for histogram in self.histograms.itervalues():
+            histogram.reset()
+
+    def report(self):
+        lines = []
+
+        for name in self.names + ['end_to_end']:
+            histogram = self.histograms[name]
+
+            if not histogram.total_count:
+                continue
+
+            percentiles = histogram.percentiles(DEFAULT_PERCENTILES)
+            lines.append(REPORT_STR.format(
+                hop=name,
+                count=histogram.total_count,
+                mean=histogram.mean(),
+                p50=percentiles[50],
+                p99=percentiles[99],
+                p999=percentiles[99.9],
+                max=histogram.max))
+
+        lines.append("sequence: gaps={0} missing={1} reordered={2}".format(
+            self.sequences.gaps,
+            self.sequences.missing,
+            self.sequences.reordered))
+
+        return '\n'.join(lines)
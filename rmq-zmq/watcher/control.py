@@ -0,0 +1,151 @@
+"""Control socket of the watcher.
+
+A Unix socket where local clients (see watcherctl.py) send commands as
+JSON lines, getting one JSON line back for each of them:
+
+    {"command": "status"}
+    {"command": "start", "group": "archivers"}
+    {"command": "stop", "group": "archivers"}
+    {"command": "scale", "group": "archivers", "instances": 4}
+    {"command": "restart", "group": "archivers"}
+
+    {"ok": true, ...} or {"ok": false, "error": "..."}
+
+The server is non-blocking, its sockets are added to the select() of the
+watcher main loop.
+
+"""
+
+import errno
+import json
+import os
+import socket
+
+READ_SIZE = 4096
+
+# Clients sending more than this without a new line are dropped
+MAX_LINE = 1024 * 1024
+
+# Seconds a client has to take a response, after that it's dropped (a
+# client that doesn't read would stall the watcher main loop)
+SEND_TIMEOUT = 1.0
+
+
+class ControlServer(object):
+
+    def __init__(self, path):
+        self.path = path
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self.socket.bind(path)
+        self.socket.listen(5)
+
+        self.clients = {}
+
+    def fds(self):
+        return [self.socket] + self.clients.keys()
+
+    def handle(self, readable, dispatch):
+        """Accepts new clients and answers the commands of the readable
+        ones with dispatch(request) -> response
+        """
+
+        if self.socket in readable:
+            self.accept()
+
+        for client in [client for client in self.clients
+                       if client in readable]:
+            self.serve(client, dispatch)
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+
+            self.clients[client] = ''
+
+    def serve(self, client, dispatch):
+        try:
+            data = client.recv(READ_SIZE)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+
+        if not data or len(self.clients[client]) > MAX_LINE:
+            self.drop(client)
+            return
+
+        lines = (self.clients[client] + data).split('\n')
+        self.clients[client] = lines.pop()
+
+        for line in lines:
+            if not line.strip():
+                continue
+
+            try:
+                response = dispatch(json.loads(line))
+            except Exception as e:
+                # A bad request must not take the watcher down
+                response = dict(ok=False, error=str(e))
+
+            try:
+                # Responses are small, the client is waiting for them
+                client.settimeout(SEND_TIMEOUT)
+                client.sendall(json.dumps(response) + '\n')
+                client.setblocking(False)
+            except socket.error:
+                # socket.timeout included
+                self.drop(client)
+                return
+
+    def drop(self, client):
+        self.clients.pop(client, None)
+        client.close()
+
+    def close(self):
+        for client in self.clients.keys():
+            self.drop(client)
+
+        self.socket.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ControlClient(object):
+    """Client of the control socket, i.e. for scripts driving the watcher:
+
+        client = ControlClient('/tmp/watcher.sock')
+        client.request('scale', group='archivers', instances=4)
+    """
+
+    def __init__(self, path, timeout=10):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(path)
+        self.buffer = ''
+
+    def request(self, command, **params):
+        params['command'] = command
+        self.socket.sendall(json.dumps(params) + '\n')
+
+        while '\n' not in self.buffer:
+            data = self.socket.recv(READ_SIZE)
+            if not data:
+                raise IOError("The watcher closed the connection")
+            self.buffer += data
+
+        line, self.buffer = self.buffer.split('\n', 1)
+        return json.loads(line)
+
+    def close(self):
+        self.socket.close()
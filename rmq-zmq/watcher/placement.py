@@ -0,0 +1,283 @@
+"""CPU and I/O placement of the watcher processes.
+
+Per group settings of the watcher config:
+
+    cpu_affinity    list of cpus (or a cpulist string like "0-3,8") where
+                    all the instances run, or "auto" to give each
+                    instance its own cpu
+    cpu_pool        cpus used by "auto" (default: all the allowed cpus,
+                    except the ones pinned by other groups)
+    numa_node       restricts the pool to the cpus of a NUMA node
+    nice            niceness of the processes
+    ionice          I/O class ("realtime", "best-effort" or "idle") and
+                    level (0-7), i.e. {class: best-effort, level: 7}
+
+Linux only: the affinity uses sched_setaffinity() and the I/O priority
+the ioprio_set() system call, through ctypes. Both (and setpriority())
+only change the thread they are given, so they are applied in the new
+process before it runs the script (Popen preexec_fn, or the worker
+branch of the zygote), and all the threads it creates inherit them.
+
+"""
+
+import ctypes
+import ctypes.util
+import glob
+import multiprocessing
+import os
+import platform
+import re
+import sys
+
+AUTO = 'auto'
+
+PRIO_PROCESS = 0
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+
+# ioprio_set() has no wrapper in the C library
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64': 273,
+    'ppc64le': 273,
+}
+
+NICE_RANGE = (-20, 19)
+IOPRIO_LEVELS = 8
+
+CPU_SETSIZE = 1024
+CPU_MASK_BITS = 8 * ctypes.sizeof(ctypes.c_ulong)
+
+NODE_PATH = '/sys/devices/system/node/node*'
+
+_libc = None
+
+
+def libc():
+    global _libc
+
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    return _libc
+
+
+def _check(result):
+    if result == -1:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def parse_cpulist(cpulist):
+    """Parses a cpulist ("0-3,8,10-11") or a list of cpus"""
+
+    if isinstance(cpulist, (list, tuple)):
+        return [int(cpu) for cpu in cpulist]
+
+    if isinstance(cpulist, int):
+        return [cpulist]
+
+    cpus = []
+
+    for part in str(cpulist).split(','):
+        part = part.strip()
+        if not part:
+            continue
+
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+
+    return cpus
+
+
+def allowed_cpus():
+    """Cpus the watcher is allowed to run on"""
+
+    try:
+        with open('/proc/self/status') as status:
+            match = re.search(r'^Cpus_allowed_list:\s*(\S+)', status.read(),
+                              re.MULTILINE)
+    except IOError:
+        match = None
+
+    if match:
+        return parse_cpulist(match.group(1))
+
+    return range(multiprocessing.cpu_count())
+
+
+def numa_nodes():
+    """Returns {node: cpus} from sysfs (empty if there's no NUMA info)"""
+
+    nodes = {}
+
+    for path in glob.glob(NODE_PATH):
+        try:
+            with open(os.path.join(path, 'cpulist')) as cpulist:
+                nodes[int(path.rsplit('node', 1)[1])] = parse_cpulist(
+                    cpulist.read())
+        except (IOError, ValueError):
+            continue
+
+    return nodes
+
+
+def set_affinity(pid, cpus):
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // CPU_MASK_BITS))()
+
+    for cpu in cpus:
+        mask[cpu // CPU_MASK_BITS] |= 1 << (cpu % CPU_MASK_BITS)
+
+    _check(libc().sched_setaffinity(pid, ctypes.sizeof(mask), mask))
+
+
+def set_nice(pid, nice):
+    _check(libc().setpriority(PRIO_PROCESS, pid, nice))
+
+
+def set_ionice(pid, ioclass, level=0):
+    syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+
+    if syscall is None:
+        raise OSError("ioprio_set() is unknown for {0}".format(
+            platform.machine()))
+
+    value = (IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT) | level
+    _check(libc().syscall(syscall, IOPRIO_WHO_PROCESS, pid, value))
+
+
+class Placement(object):
+    """Placement settings of a group. Invalid ones raise ValueError when
+    the config is loaded, they would fail in every new process otherwise.
+    """
+
+    def __init__(self, definition, reserved=()):
+        self.nice = definition.get('nice')
+        self.ionice = definition.get('ionice')
+        self.cpus = None
+        self.auto = False
+
+        affinity = definition.get('cpu_affinity')
+
+        if isinstance(self.ionice, basestring):
+            self.ionice = {'class': self.ionice}
+
+        if affinity == AUTO:
+            self.auto = True
+            self.cpus = self.pool(definition, reserved)
+        elif affinity is not None:
+            self.cpus = parse_cpulist(affinity)
+
+        self.validate()
+
+    def validate(self):
+        if self.nice is not None:
+            if (not isinstance(self.nice, int)
+                    or not NICE_RANGE[0] <= self.nice <= NICE_RANGE[1]):
+                raise ValueError("nice must be an integer from {0} to {1}, not {2!r}".format(
+                    NICE_RANGE[0], NICE_RANGE[1], self.nice))
+
+        if self.ionice:
+            if not isinstance(self.ionice, dict) or self.ionice.get('class') not in IOPRIO_CLASSES:
+                raise ValueError("ionice class must be one of {0}, not {1!r}".format(
+                    ', '.join(sorted(IOPRIO_CLASSES)), self.ionice))
+
+            level = self.ionice.get('level', 0)
+
+            if not isinstance(level, int) or not 0 <= level < IOPRIO_LEVELS:
+                raise ValueError("ionice level must be an integer from 0 to {0}, not {1!r}".format(
+                    IOPRIO_LEVELS - 1, level))
+
+        for cpu in self.cpus or ():
+            if not 0 <= cpu < CPU_SETSIZE:
+                raise ValueError("cpu {0} is out of range (0-{1})".format(cpu, CPU_SETSIZE - 1))
+
+    @staticmethod
+    def pool(definition, reserved):
+        if 'cpu_pool' in definition:
+            cpus = parse_cpulist(definition['cpu_pool'])
+        else:
+            cpus = allowed_cpus()
+
+        if 'numa_node' in definition:
+            node_cpus = numa_nodes().get(definition['numa_node'])
+            if node_cpus:
+                cpus = [cpu for cpu in cpus if cpu in node_cpus]
+
+        # The cpus pinned by other groups are left for them, unless
+        # there's nothing else
+        free = [cpu for cpu in cpus if cpu not in reserved]
+
+        return free or cpus
+
+    @property
+    def enabled(self):
+        return bool(self.cpus or self.nice is not None or self.ionice)
+
+    def cpus_for(self, slot):
+        if self.auto:
+            return [self.cpus[slot % len(self.cpus)]]
+        return self.cpus
+
+    def settings(self, slot):
+        """Settings of the instance in a slot, for apply()"""
+
+        return dict(
+            cpus=self.cpus_for(slot) if self.cpus else None,
+            nice=self.nice,
+            ionice=self.ionice)
+
+
+def apply(settings, pid=0):
+    """Applies the settings of Placement.settings() to a process (0 is
+    the calling one)"""
+
+    if settings.get('cpus'):
+        set_affinity(pid, settings['cpus'])
+
+    if settings.get('nice') is not None:
+        set_nice(pid, settings['nice'])
+
+    if settings.get('ionice'):
+        set_ionice(
+            pid,
+            settings['ionice']['class'],
+            settings['ionice'].get('level', 0))
+
+
+def apply_in_child(settings):
+    """apply() in a new process, before it runs anything. A placement
+    that can't be set is reported, but the process goes on (an exception
+    raised in preexec_fn would be raised by Popen in the watcher)."""
+
+    try:
+        apply(settings)
+    except Exception as e:
+        sys.stderr.write("Can't set the placement {0}: {1}\n".format(settings, e))
+
+
+def reserved_cpus(definitions):
+    """Cpus pinned explicitly by some group"""
+
+    reserved = set()
+
+    for definition in definitions:
+        affinity = definition.get('cpu_affinity')
+
+        if affinity is not None and affinity != AUTO:
+            reserved.update(parse_cpulist(affinity))
+
+    return reserved
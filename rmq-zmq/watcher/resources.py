@@ -0,0 +1,165 @@
+"""Resource accounting for the watcher.
+
+CPU, RSS and open file descriptors of each job are read from /proc, and
+the throughput and backlog come from the metrics endpoint each pipeline
+process can expose (see metrics.py in rmq-zmq): the watcher subscribes
+to the endpoints of its jobs, and optionally to other endpoints (i.e.
+the queues feeding a group of archivers) found with a glob pattern.
+
+ZeroMQ is optional, without it only the /proc stats are available.
+
+"""
+
+from __future__ import division
+
+import glob
+import json
+import os
+import time
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Snapshots older than this are not taken into account
+METRICS_MAX_AGE = 10
+
+
+def process_stats(pid):
+    """Returns (cpu seconds, rss bytes, open fds) of a process, or None if
+    it's gone
+    """
+
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as stat:
+            data = stat.read()
+    except IOError:
+        return None
+
+    # The command name may contain spaces, the fields start after it
+    fields = data[data.rfind(')') + 2:].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    rss = int(fields[21]) * PAGE_SIZE
+
+    try:
+        fds = len(os.listdir('/proc/{0}/fd'.format(pid)))
+    except OSError:
+        fds = None
+
+    return cpu, rss, fds
+
+
+class ResourceSampler(object):
+    """Keeps the last CPU time of each process to compute its CPU usage"""
+
+    def __init__(self):
+        self.last = {}
+
+    def sample(self, pid):
+        """Returns a dict with the cpu (%), rss (bytes) and fds of a
+        process, or None if it's gone
+        """
+
+        stats = process_stats(pid)
+
+        if stats is None:
+            self.last.pop(pid, None)
+            return None
+
+        cpu_time, rss, fds = stats
+        now = time.time()
+        cpu = 0.0
+
+        previous = self.last.get(pid)
+        if previous is not None and now > previous[0]:
+            cpu = 100 * (cpu_time - previous[1]) / (now - previous[0])
+
+        self.last[pid] = (now, cpu_time)
+
+        return dict(cpu=cpu, rss=rss, fds=fds)
+
+    def forget(self, pid):
+        self.last.pop(pid, None)
+
+
+class MetricsReader(object):
+    """Latest metrics snapshot of each process, by pid"""
+
+    def __init__(self):
+        self.enabled = zmq is not None
+        self.snapshots = {}
+        self.connected = set()
+
+        if self.enabled:
+            self.context = zmq.Context.instance()
+            self.socket = self.context.socket(zmq.SUB)
+            self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+            self.socket.setsockopt(zmq.LINGER, 0)
+
+    def connect(self, endpoint):
+        if self.enabled and endpoint not in self.connected:
+            self.socket.connect(endpoint)
+            self.connected.add(endpoint)
+
+    def disconnect(self, endpoint):
+        if endpoint in self.connected:
+            self.connected.discard(endpoint)
+
+            try:
+                self.socket.disconnect(endpoint)
+            except zmq.ZMQError:
+                pass
+
+    def discover(self, pattern):
+        """Connects to the ipc endpoints matching a glob pattern, returning
+        them
+        """
+
+        endpoints = ['ipc://' + path for path in glob.glob(pattern)]
+
+        for endpoint in endpoints:
+            self.connect(endpoint)
+
+        return endpoints
+
+    def update(self):
+        if not self.enabled:
+            return
+
+        while True:
+            try:
+                snapshot = json.loads(self.socket.recv(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+            except ValueError:
+                continue
+
+            if 'pid' in snapshot:
+                snapshot['received_at'] = time.time()
+                self.snapshots[snapshot['pid']] = snapshot
+
+        limit = time.time() - METRICS_MAX_AGE
+
+        for pid, snapshot in self.snapshots.items():
+            if snapshot['received_at'] < limit:
+                del self.snapshots[pid]
+
+    def get(self, pid):
+        return self.snapshots.get(pid)
+
+    def gauge(self, name, pids=None, process=None):
+        """Sum of a gauge (i.e. queue_depth) over the given pids, or the
+        processes with the given name. None if no process reports it.
+        """
+
+        values = [snapshot['gauges'][name]
+                  for pid, snapshot in self.snapshots.iteritems()
+                  if (pids is None or pid in pids)
+                  and (process is None or snapshot.get('name') == process)
+                  and name in snapshot.get('gauges', {})]
+
+        return sum(values) if values else None
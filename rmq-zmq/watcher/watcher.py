@@ -1,11 +1,18 @@
 import argparse
+import errno
 import os
+import select
+import signal
 import subprocess
 import sys
 import time
 
 import yaml
 
+import control
+import placement
+import resources
+import zygote
 from python_utils import logging_manager
 
 
@@ -15,6 +22,23 @@ DEFAULT_POLLING_TIME = 10
 DEFAULT_PYTHON_BIN = "python"
 DEFAULT_KEEP_ALIVE = True
 DEFAULT_RESPAWN_RETRIES = INFINITE_RETRIES  # This means "infinite"
+DEFAULT_RESPAWN_BACKOFF = 0.5
+DEFAULT_RESPAWN_BACKOFF_MAX = 60
+DEFAULT_ZYGOTE = False
+DEFAULT_PRELOAD = 'auto'
+DEFAULT_RESOURCES_INTERVAL = 5
+
+# Rolling restarts, see step_rolling_restart()
+DEFAULT_READY_TIMEOUT = 30
+DEFAULT_STOP_TIMEOUT = 30
+ROLLING_RESTART_TICK = 0.5
+
+# Autoscaling defaults, see autoscale_group()
+DEFAULT_AUTOSCALE = dict(
+    metric='backlog',
+    scale_up=1000,
+    scale_down=100,
+    cooldown=30)
 
 MIN_UPTIME_THRESHOLD = 60
 RESPAWN_WARNING_THRESHOLD = 2
@@ -33,7 +57,7 @@ if __name__ == '__main__':
         '--polling',
         default=DEFAULT_POLLING_TIME,
         type=int,
-        help='Polling time (in seconds)')
+        help='Seconds between the status summaries in the log')
 
     parser.add_argument(
         '--python-bin',
@@ -45,6 +69,17 @@ if __name__ == '__main__':
         type=int,
         help="""Maximum number of respawn retries per process.
         "-1" means no limit""")
+    parser.add_argument(
+        '--respawn-backoff',
+        default=DEFAULT_RESPAWN_BACKOFF,
+        type=float,
+        help="""Seconds to wait before respawning a process that keeps
+        dying too soon, doubled on each consecutive early death""")
+    parser.add_argument(
+        '--respawn-backoff-max',
+        default=DEFAULT_RESPAWN_BACKOFF_MAX,
+        type=float,
+        help="""Maximum seconds to wait before respawning a process""")
     parser.add_argument(
         '--respawn-warning',
         default=RESPAWN_WARNING_THRESHOLD,
@@ -59,6 +94,23 @@ if __name__ == '__main__':
         If a process dies before this time, a warning is raised. This is done
         to detect processes that die too soon""")
 
+    parser.add_argument(
+        '--resources-interval',
+        default=DEFAULT_RESOURCES_INTERVAL,
+        type=float,
+        help="""Seconds between samples of the resources (CPU, RSS, FDs
+        and metrics) of the processes, also used for autoscaling""")
+    parser.add_argument(
+        '--control-socket',
+        help="""Unix socket where the watcher takes commands and gives
+        its status (see control.py and watcherctl.py)""")
+    parser.add_argument(
+        '--zygote',
+        action='store_true',
+        default=DEFAULT_ZYGOTE,
+        help="""Fork the processes from a pre-imported template process
+        per group (see zygote.py) instead of starting a new interpreter""")
+
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         '--keep-alive',
@@ -82,131 +134,848 @@ if __name__ == '__main__':
 def any_running(processes):
     for group in processes.itervalues():
         for job in group['running_jobs']:
-            if job['process'].poll() is None:
+            # Jobs waiting to be respawned count as running
+            if (job['process'] is None or job['process'].returncode is None
+                    or job['respawn_at'] is not None):
                 return True
 
     return False
 
 
-def check_dead_processes(group_name, group):
-    respawned_count = 0
-    dead_count = 0
+def install_sighup_handler(restart_requests):
+    """SIGHUP asks for a rolling restart of all the groups. As with
+    SIGCHLD, the wakeup fd gets the main loop out of select().
+    """
 
-    # Check the dead processes
-    for job in group["running_jobs"]:
-        # If the process is not flagged as "failed permanently"
-        # but we found that the process returned an exit code
-        job_exit_code = job["process"].poll()
+    def handler(signum, frame):
+        restart_requests.append(None)
 
-        if (not job["failed_permanently"] and job_exit_code is not None):
-            # Check if the job exceeded the amount of respawns
-            if group["max_respawn_retries"] == INFINITE_RETRIES:
-                not_excessive_respawns = True
-            else:
-                not_excessive_respawns = (
-                    job["respawn_retries"] < group["max_respawn_retries"])
+    signal.signal(signal.SIGHUP, handler)
+    signal.siginterrupt(signal.SIGHUP, False)
 
-            # If we need to keep the job alive and is not a "respawn aggressor"
-            if (group["keep_alive"] and not_excessive_respawns):
 
-                job_params = job["parameters"]
+def install_sigchld_handler():
+    """Returns the read end of a self-pipe, that gets a byte every time a
+    child process finishes, so the main loop can wait on it with select().
+    """
 
-                if isinstance(job_params, list):
-                    if job_params:
-                        print_nice_params = " ".join(job_params)
-                    else:
-                        print_nice_params = ""
-                else:
-                    print_nice_params = job_params
+    wakeup_r, wakeup_w = os.pipe()
 
-                logger.info("Respawing Job {} [{}] (Exit Code {})".format(
-                    job["id"],
-                    "{} {}".format(
-                        group["script"], print_nice_params),
-                    job_exit_code))
-
-                # WARNING: This metric is not accurate!
-                now = time.time()
-                uptime = now - job["last_start_at"]
-
-                uptime_warning = (uptime <= MIN_UPTIME_THRESHOLD)
-                respawn_warning = (
-                    job["respawn_retries"] > RESPAWN_WARNING_THRESHOLD)
-
-                if uptime_warning and respawn_warning:
-                    logger.warning(
-                        "{} [{}]: Job {} respawned {} times. Last uptime: {} seconds".format(
-                            group_name,
-                            group["id"],
-                            job["id"],
-                            job["respawn_retries"],
-                            uptime))
-
-                elif uptime_warning:
-                    logger.warning(
-                        "{} [{}]: Job {} died early. Last uptime: ~{} seconds".format(
-                            group_name,
-                            group["id"],
-                            job["id"],
-                            uptime))
-
-                elif respawn_warning:
-                    logger.warning(
-                        "{} [{}]: Job {} respawned {} times in {} seconds".format(
-                            group_name,
-                            group["id"],
-                            job["id"],
-                            job["respawn_retries"],
-                            (now - job["created_at"])))
-
-                timestamp = time.time()
-
-                job["process"] = new_instance(
-                    group["script"],
-                    group["python_exec"],
-                    parameters=job["parameters"])
-
-                job["last_start_at"] = timestamp
-                job["last_updated_at"] = timestamp
-                job["respawn_retries"] += 1
-                job["uptime"] = 0
-
-                respawned_count += 1
-
-            # Here we just leave the poor bastard dead
+    for fd in (wakeup_r, wakeup_w):
+        zygote.set_nonblocking(fd)
+        zygote.set_cloexec(fd)
+
+    # The handler does nothing, the interpreter writes to the wakeup fd
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    # Other system calls are restarted instead of failing with EINTR
+    signal.siginterrupt(signal.SIGCHLD, False)
+
+    return wakeup_r
+
+
+def drain(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError as e:
+        if e.errno != errno.EAGAIN:
+            raise
+
+
+def exit_code(status):
+    # Same convention as Popen.returncode
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def reap_children():
+    """Yields (pid, exit code) of the finished children, without blocking"""
+
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                return
+            raise
+
+        if pid == 0:
+            return
+
+        yield pid, exit_code(status)
+
+
+def respawn_delay(group, job, uptime):
+    """Seconds to wait before respawning a job. Jobs that die before
+    MIN_UPTIME_THRESHOLD are crash looping: the first time they are
+    respawned right away, then the delay doubles each time up to the
+    group maximum. A job that runs long enough resets the backoff.
+    """
+
+    if uptime > MIN_UPTIME_THRESHOLD:
+        job["crashes"] = 0
+        return 0
+
+    job["crashes"] += 1
+
+    if job["crashes"] == 1:
+        return 0
+
+    return min(
+        group["respawn_backoff"] * 2 ** (job["crashes"] - 2),
+        group["respawn_backoff_max"])
+
+
+def new_job(group, parameters):
+    timestamp = time.time()
+
+    group["last_instance_id"] += 1
+
+    return dict(
+        id=((group["id"] * 100) + group["last_instance_id"]),
+        created_at=timestamp,
+        uptime=0,
+        respawn_retries=0,
+        crashes=0,
+        respawn_at=None,
+        last_start_at=timestamp,
+        last_updated_at=timestamp,
+        failed_permanently=False,
+        stopping=False,
+        stats=None,
+        slot=None,
+        parameters=parameters,
+        process=None)
+
+
+def start_job(group, job, jobs_by_pid):
+    """Starts (or respawns) a job. Returns False if it couldn't be
+    started, then it's scheduled to be tried again.
+    """
+
+    settings = place_job(group, job)
+
+    try:
+        if group["zygote"] is not None:
+            job["process"] = group["zygote"].spawn(
+                instance_parameters(job["parameters"]),
+                placement_settings=settings)
+        else:
+            job["process"] = new_instance(
+                group["script"],
+                group["python_exec"],
+                parameters=job["parameters"],
+                env=group["env"],
+                placement_settings=settings)
+
+    except OSError as e:
+        start_failed(group, job, e)
+        return False
+
+    timestamp = time.time()
+
+    job["last_start_at"] = timestamp
+    job["last_updated_at"] = timestamp
+    job["respawn_at"] = None
+    job["uptime"] = 0
+
+    jobs_by_pid[job["process"].pid] = (group, job)
+    return True
+
+
+def start_failed(group, job, error):
+    """A job that couldn't be started waits to be tried again, as if it
+    had crashed. If its zygote is gone (or not answering) it's killed, so
+    the main loop reaps it and starts it again (see restart_zygote).
+    """
+
+    delay = max(respawn_delay(group, job, 0), group["respawn_backoff"])
+
+    logger.error("{} [{}]: Can't start Job {}: {}. Retrying in {} seconds".format(
+        group["name"],
+        group["id"],
+        job["id"],
+        error,
+        delay))
+
+    group_zygote = group["zygote"]
+
+    if (group_zygote is not None
+            and error.errno in (errno.ECHILD, errno.EPIPE, errno.EBADF, errno.ETIMEDOUT)
+            and group_zygote.process.returncode is None):
+        try:
+            group_zygote.process.kill()
+        except OSError:
+            pass
+
+    job["respawn_at"] = time.time() + delay
+
+
+def free_slot(group, job):
+    used = set(other["slot"] for other in group["running_jobs"]
+               if other is not job)
+
+    slot = 0
+    while slot in used:
+        slot += 1
+
+    return slot
+
+
+def place_job(group, job):
+    """Placement settings (cpu affinity, nice and ionice) of a job, which
+    are applied by the new process itself. Each job keeps its slot (and
+    so its cpu in the "auto" mode) when respawned.
+    """
+
+    if group["placement"] is None:
+        return None
+
+    if job["slot"] is None:
+        job["slot"] = free_slot(group, job)
+
+    return group["placement"].settings(job["slot"])
+
+
+def handle_exit(group, job, job_exit_code):
+    """Decides the fate of a job that finished: it's scheduled to be
+    respawned, or flagged as failed permanently.
+    """
+
+    # Lets Popen know, as it won't be able to wait for the process
+    job["process"].returncode = job_exit_code
+
+    now = time.time()
+    uptime = now - job["last_start_at"]
+    job["uptime"] = uptime
+    job["last_updated_at"] = now
+
+    # Stopped by the autoscaling, it's not coming back
+    if job["stopping"]:
+        logger.info("{} [{}]: Job {} stopped (Exit Code {})".format(
+            group["name"],
+            group["id"],
+            job["id"],
+            job_exit_code))
+
+        group["running_jobs"].remove(job)
+        return
+
+    # Check if the job exceeded the amount of respawns
+    if group["max_respawn_retries"] == INFINITE_RETRIES:
+        not_excessive_respawns = True
+    else:
+        not_excessive_respawns = (
+            job["respawn_retries"] < group["max_respawn_retries"])
+
+    # If we need to keep the job alive and is not a "respawn aggressor"
+    if (group["keep_alive"] and not_excessive_respawns):
+
+        job_params = job["parameters"]
+
+        if isinstance(job_params, list):
+            if job_params:
+                print_nice_params = " ".join(job_params)
             else:
-                logger.info(
-                    "{} [{}]: Job {} failed permanently (Exit Code {})".format(
-                        group_name,
-                        group["id"],
-                        job["id"],
-                        job_exit_code))
+                print_nice_params = ""
+        else:
+            print_nice_params = job_params
+
+        delay = respawn_delay(group, job, uptime)
+
+        logger.info("Respawing Job {} [{}] (Exit Code {}) in {} seconds".format(
+            job["id"],
+            "{} {}".format(
+                group["script"], print_nice_params),
+            job_exit_code,
+            delay))
+
+        uptime_warning = (uptime <= MIN_UPTIME_THRESHOLD)
+        respawn_warning = (
+            job["respawn_retries"] > RESPAWN_WARNING_THRESHOLD)
+
+        if uptime_warning and respawn_warning:
+            logger.warning(
+                "{} [{}]: Job {} respawned {} times. Last uptime: {} seconds".format(
+                    group["name"],
+                    group["id"],
+                    job["id"],
+                    job["respawn_retries"],
+                    uptime))
+
+        elif uptime_warning:
+            logger.warning(
+                "{} [{}]: Job {} died early. Last uptime: ~{} seconds".format(
+                    group["name"],
+                    group["id"],
+                    job["id"],
+                    uptime))
+
+        elif respawn_warning:
+            logger.warning(
+                "{} [{}]: Job {} respawned {} times in {} seconds".format(
+                    group["name"],
+                    group["id"],
+                    job["id"],
+                    job["respawn_retries"],
+                    (now - job["created_at"])))
+
+        job["respawn_at"] = now + delay
+
+    # Here we just leave the poor bastard dead
+    else:
+        logger.info(
+            "{} [{}]: Job {} failed permanently (Exit Code {})".format(
+                group["name"],
+                group["id"],
+                job["id"],
+                job_exit_code))
+
+        job["failed_permanently"] = True
+
+        group["running_jobs"].remove(job)
+        group["dead_jobs"].append(job)
+        group["failed_count"] += 1
+
+
+def restart_zygote(group, jobs_by_pid, zygotes_by_pid):
+    """Starts again the zygote of a group that died. Its workers got
+    SIGTERM, so they are handled as finished jobs.
+    """
+
+    group_zygote = group["zygote"]
+    exits = list(group_zygote.read_exits()) + list(group_zygote.orphans())
+
+    logger.error("{} [{}]: Zygote died (Exit Code {}), restarting it".format(
+        group["name"],
+        group["id"],
+        group_zygote.process.returncode))
+
+    group_zygote.close()
+    group_zygote.start()
+    zygotes_by_pid[group_zygote.process.pid] = group
+
+    for pid, job_exit_code in exits:
+        if pid in jobs_by_pid:
+            group, job = jobs_by_pid.pop(pid)
+            handle_exit(group, job, job_exit_code)
+
+
+def respawn_due_jobs(processes, jobs_by_pid):
+    """Respawns the jobs whose backoff is over, returning the time of the
+    next scheduled respawn (or None)
+    """
+
+    now = time.time()
+    next_respawn = None
+
+    for group in processes.itervalues():
+        for job in group["running_jobs"]:
+            if job["respawn_at"] is None:
+                continue
+
+            if job["respawn_at"] <= now:
+                if start_job(group, job, jobs_by_pid):
+                    job["respawn_retries"] += 1
+                    group["respawned_count"] += 1
+                elif next_respawn is None or job["respawn_at"] < next_respawn:
+                    next_respawn = job["respawn_at"]
+            elif next_respawn is None or job["respawn_at"] < next_respawn:
+                next_respawn = job["respawn_at"]
+
+    return next_respawn
+
+
+def job_endpoint(group, job):
+    return group["metrics_endpoint"].format(
+        name=os.path.splitext(os.path.basename(group["script"]))[0],
+        pid=job["process"].pid)
+
+
+def account_resources(processes, sampler, metrics):
+    """Samples the CPU, RSS and FDs of every job, and the metrics of the
+    jobs exposing them, adding them up by group in group["stats"]
+    """
+
+    endpoints = set()
+
+    for group in processes.itervalues():
+        autoscale = group["autoscale"]
+
+        for job in group["running_jobs"]:
+            if job["respawn_at"] is not None:
+                continue
+
+            if group["metrics_endpoint"]:
+                endpoints.add(job_endpoint(group, job))
+
+        if autoscale and autoscale.get("backlog_metrics"):
+            endpoints.update(metrics.discover(autoscale["backlog_metrics"]))
 
-                job["failed_permanently"] = True
-                job["last_updated_at"] = time.time()
+    for endpoint in endpoints:
+        metrics.connect(endpoint)
 
-                dead_count += 1
+    # Endpoints of jobs that are gone
+    for endpoint in metrics.connected - endpoints:
+        metrics.disconnect(endpoint)
 
-        # If the job keeps running
+    metrics.update()
+
+    for group in processes.itervalues():
+        stats = dict(cpu=0.0, rss=0, fds=0, ratio_in=None, backlog=None)
+        pids = set()
+
+        for job in group["running_jobs"]:
+            if job["respawn_at"] is not None:
+                continue
+
+            pid = job["process"].pid
+            job["stats"] = job_stats = sampler.sample(pid)
+            pids.add(pid)
+
+            if job_stats is None:
+                continue
+
+            stats["cpu"] += job_stats["cpu"]
+            stats["rss"] += job_stats["rss"]
+            stats["fds"] += job_stats["fds"] or 0
+
+            snapshot = metrics.get(pid)
+            if snapshot is not None:
+                job_stats["ratio_in"] = snapshot.get("ratio_in", 0)
+                stats["ratio_in"] = (
+                    (stats["ratio_in"] or 0) + job_stats["ratio_in"])
+
+        autoscale = group["autoscale"]
+
+        if autoscale and autoscale.get("backlog_process"):
+            stats["backlog"] = metrics.gauge(
+                'queue_depth', process=autoscale["backlog_process"])
         else:
-            timestamp = time.time()
-            job["uptime"] = (timestamp - job["last_start_at"])
-            job["last_updated_at"] = timestamp
+            stats["backlog"] = metrics.gauge('queue_depth', pids=pids)
+
+        group["stats"] = stats
+
+
+def add_job(group, parameters, jobs_by_pid):
+    job = new_job(group, parameters)
+    start_job(group, job, jobs_by_pid)
+    group["running_jobs"].append(job)
+    return job
+
+
+def stop_job(group, job):
+    """Stops a job for good (it gets SIGTERM and it's not respawned)"""
+
+    if job["respawn_at"] is not None:
+        # Waiting to be respawned, it's enough to forget it
+        group["running_jobs"].remove(job)
+    else:
+        job["stopping"] = True
+        job["process"].terminate()
+
+
+def scale_group(group, instances, jobs_by_pid):
+    """Starts or stops jobs until the group has the given instances. New
+    jobs take the parameters of the configured instances in order.
+    """
+
+    active = [job for job in group["running_jobs"] if not job["stopping"]]
+
+    for index in xrange(len(active), instances):
+        parameters = group["instances"][index % len(group["instances"])]
+        active.append(add_job(group, parameters, jobs_by_pid))
+
+    # The newest jobs are stopped first
+    while len(active) > instances:
+        stop_job(group, active.pop())
+
+    logger.info("{} [{}]: Scaled to {} jobs".format(
+        group["name"],
+        group["id"],
+        instances))
+
+
+def autoscale_group(group, jobs_by_pid):
+    """Adds or stops a job of the group, between the configured min and
+    max instances, when the backlog (the queue_depth gauge) or the mean
+    CPU per job crosses the scale_up or scale_down thresholds. After
+    scaling, the group is left alone for 'cooldown' seconds.
+    """
+
+    autoscale = group["autoscale"]
+    stats = group["stats"]
+    now = time.time()
+
+    if stats is None or now - autoscale["last_scaled_at"] < autoscale["cooldown"]:
+        return
+
+    active = [job for job in group["running_jobs"] if not job["stopping"]]
+
+    if autoscale["metric"] == 'cpu':
+        value = stats["cpu"] / len(active) if active else None
+    else:
+        value = stats["backlog"]
+
+    if value is None:
+        return
+
+    if value > autoscale["scale_up"] and len(active) < autoscale["max"]:
+        job = add_job(group, autoscale["parameters"], jobs_by_pid)
+
+        logger.info("{} [{}]: Scaled up to {} jobs ({} {}), started Job {}".format(
+            group["name"], group["id"], len(active) + 1,
+            autoscale["metric"], value, job["id"]))
+
+    elif value < autoscale["scale_down"] and len(active) > autoscale["min"]:
+        job = active[-1]
+        stop_job(group, job)
+
+        logger.info("{} [{}]: Scaled down to {} jobs ({} {}), stopping Job {}".format(
+            group["name"], group["id"], len(active) - 1,
+            autoscale["metric"], value, job["id"]))
+
+    else:
+        return
+
+    autoscale["last_scaled_at"] = now
+
+
+def start_rolling_restart(group, zygotes_by_pid):
+    """Returns the state of a rolling restart of the group: its current
+    jobs are replaced one at a time by step_rolling_restart()
+    """
+
+    logger.info("{} [{}]: Rolling restart of {} jobs".format(
+        group["name"],
+        group["id"],
+        len(group["running_jobs"])))
+
+    # New workers must be forked from the new code. The old zygote is
+    # kept until its workers are gone, they would die with it
+    if group["zygote"] is not None:
+        old_zygote = group["zygote"]
+        zygotes_by_pid.pop(old_zygote.process.pid, None)
+        group["retired_zygotes"].append(old_zygote)
+
+        group["zygote"] = zygote.Zygote(
+            old_zygote.script,
+            old_zygote.python_executable,
+            preload=old_zygote.preload,
+            env=old_zygote.env)
+        group["zygote"].start()
+        zygotes_by_pid[group["zygote"].process.pid] = group
+
+    return dict(
+        pending=[job for job in group["running_jobs"] if not job["stopping"]],
+        phase='next',
+        old_job=None,
+        new_job=None,
+        since=time.time())
+
+
+def job_ready(group, job, metrics):
+    """A job is ready once its metrics show it's moving messages. Jobs
+    without metrics, or not getting any traffic, are considered ready
+    after the ready timeout.
+    """
+
+    uptime = time.time() - job["last_start_at"]
+
+    if group["metrics_endpoint"]:
+        metrics.connect(job_endpoint(group, job))
+        metrics.update()
+
+        snapshot = metrics.get(job["process"].pid)
+
+        if snapshot is not None and (
+                snapshot.get("total_in") or snapshot.get("total_out")):
+            return True
+
+    return uptime >= group["ready_timeout"]
+
+
+def step_rolling_restart(group, state, jobs_by_pid, metrics):
+    """Moves a rolling restart forward. For each old job: a new job is
+    started, once it's ready the old one gets SIGTERM (SIGKILL after the
+    stop timeout), and once it's gone the next old job follows. If a new
+    job dies the restart is aborted, keeping the old jobs. Returns True
+    when the restart is over.
+    """
+
+    now = time.time()
+
+    if state["phase"] == 'next':
+        # Old jobs that died meanwhile were already respawned
+        state["pending"] = [job for job in state["pending"]
+                            if job in group["running_jobs"]]
 
-    return respawned_count, dead_count
+        if not state["pending"]:
+            logger.info("{} [{}]: Rolling restart finished".format(
+                group["name"],
+                group["id"]))
+            return True
+
+        state["old_job"] = state["pending"].pop(0)
+        state["new_job"] = new_job(group, state["old_job"]["parameters"])
+        start_job(group, state["new_job"], jobs_by_pid)
+        group["running_jobs"].append(state["new_job"])
+
+        state["phase"] = 'starting'
+        state["since"] = now
+
+    elif state["phase"] == 'starting':
+        new, old = state["new_job"], state["old_job"]
+
+        if new["respawn_at"] or new["process"].returncode is not None:
+            logger.error(
+                "{} [{}]: Job {} died while starting, rolling restart "
+                "aborted".format(group["name"], group["id"], new["id"]))
+
+            # It's not coming back, the old jobs keep the work
+            new["stopping"] = True
+            if new in group["running_jobs"] and new["respawn_at"]:
+                group["running_jobs"].remove(new)
+            return True
+
+        if job_ready(group, new, metrics):
+            logger.info(
+                "{} [{}]: Job {} ready after {:.1f} seconds, stopping "
+                "Job {}".format(group["name"], group["id"], new["id"],
+                                now - state["since"], old["id"]))
+
+            if old in group["running_jobs"]:
+                old["stopping"] = True
+                old["process"].terminate()
+
+            state["phase"] = 'stopping'
+            state["since"] = now
+
+    elif state["phase"] == 'stopping':
+        old = state["old_job"]
+
+        if old not in group["running_jobs"]:
+            state["phase"] = 'next'
+        elif now - state["since"] > group["stop_timeout"]:
+            logger.warning("{} [{}]: Job {} didn't stop, killing it".format(
+                group["name"], group["id"], old["id"]))
+
+            old["process"].kill()
+            state["since"] = now
+
+    return False
+
+
+def close_retired_zygotes(group):
+    for old_zygote in list(group["retired_zygotes"]):
+        if not old_zygote.workers:
+            old_zygote.close()
+            group["retired_zygotes"].remove(old_zygote)
+
+
+def job_status(job):
+    process = job["process"]
+
+    return dict(
+        id=job["id"],
+        pid=process.pid if process is not None else None,
+        state=('stopping' if job["stopping"]
+               else 'waiting' if job["respawn_at"] is not None
+               else 'failed' if job["failed_permanently"]
+               else 'running'),
+        parameters=job["parameters"],
+        uptime=(time.time() - job["last_start_at"]
+                if not job["failed_permanently"] else job["uptime"]),
+        created_at=job["created_at"],
+        respawn_retries=job["respawn_retries"],
+        respawn_at=job["respawn_at"],
+        exit_code=process.returncode if process is not None else None,
+        stats=job["stats"])
+
+
+def group_status(group_name, group, rolling_restarts):
+    autoscale = group["autoscale"]
+
+    return dict(
+        id=group["id"],
+        name=group["name"],
+        script=group["script"],
+        stopped=group["stopped"],
+        zygote=group["zygote"] is not None,
+        restarting=group_name in rolling_restarts,
+        autoscale=(dict((key, value) for key, value in autoscale.iteritems()
+                        if key != 'parameters') if autoscale else None),
+        stats=group["stats"],
+        running_jobs=[job_status(job) for job in group["running_jobs"]],
+        dead_jobs=[job_status(job) for job in group["dead_jobs"]])
+
+
+def control_command(request, processes, jobs_by_pid, restart_requests,
+                    rolling_restarts):
+    """Runs a command of the control socket, see control.py"""
+
+    command = request.get('command')
+
+    if command == 'status':
+        return dict(
+            ok=True,
+            pid=os.getpid(),
+            groups=dict(
+                (group_name, group_status(group_name, group, rolling_restarts))
+                for group_name, group in processes.iteritems()))
+
+    group_name = request.get('group')
+    group = processes.get(group_name)
+
+    if command not in ('start', 'stop', 'scale', 'restart'):
+        return dict(ok=False, error="Unknown command {0}".format(command))
+
+    if group is None:
+        return dict(ok=False, error="Unknown group {0}".format(group_name))
+
+    logger.info("Control command: {0}".format(request))
+
+    if command == 'start':
+        group["stopped"] = False
+        scale_group(group, group["number_of_instances"], jobs_by_pid)
+
+    elif command == 'stop':
+        # Also stops the autoscaling, until it's started again
+        group["stopped"] = True
+        rolling_restarts.pop(group_name, None)
+        scale_group(group, 0, jobs_by_pid)
+
+    elif command == 'scale':
+        instances = int(request['instances'])
+        if instances < 0:
+            return dict(ok=False, error="Invalid instances {0}".format(
+                instances))
+
+        group["stopped"] = instances == 0
+        scale_group(group, instances, jobs_by_pid)
+
+        # The autoscaling leaves it alone for a while
+        if group["autoscale"] is not None:
+            group["autoscale"]["last_scaled_at"] = time.time()
+
+    elif command == 'restart':
+        restart_requests.append(group_name)
+
+    return dict(
+        ok=True,
+        group=group_status(group_name, group, rolling_restarts))
+
+
+def log_summaries(processes):
+    for group_name, group in processes.iteritems():
+        # Here the notation is
+        # R: Running
+        # W: Waiting to be respawned
+        # S: Spawned (Resurrected)
+        # F: Failed Permanently (this cycle)
+        # D: Total Dead Jobs
+        waiting = len([job for job in group["running_jobs"]
+                       if job["respawn_at"] is not None])
+
+        logger.info((
+            "Summary for {} [{}]: R: {} | W: {} | S: {} | F: {} | D: {}"
+            .format(
+                group_name,
+                group['id'],
+                len(group["running_jobs"]) - waiting,
+                waiting,
+                group["respawned_count"],
+                group["failed_count"],
+                len(group["dead_jobs"]))))
+
+        group["respawned_count"] = 0
+        group["failed_count"] = 0
+
+        stats = group["stats"]
+
+        if stats is not None:
+            resources_summary = (
+                "Resources for {} [{}]: CPU: {:.1f}% | RSS: {:.1f} MB | "
+                "FDs: {}".format(
+                    group_name,
+                    group['id'],
+                    stats["cpu"],
+                    stats["rss"] / (1024.0 * 1024),
+                    stats["fds"]))
+
+            if stats["ratio_in"] is not None:
+                resources_summary += " | In: {:.0f} msg/s".format(
+                    stats["ratio_in"])
+
+            if stats["backlog"] is not None:
+                resources_summary += " | Backlog: {}".format(stats["backlog"])
+
+            logger.info(resources_summary)
 
 
 def perform():
     processes = {}
 
+    # Children exits are handled as soon as they happen, the polling time
+    # is just the interval between the summaries in the log
     polling_time = CONFIG.get('polling_time', args.polling)
     python_exec = CONFIG.get('python_exec', args.python_bin)
     keep_alive = CONFIG.get('keep_alive', args.keep_alive)
     max_respawn_retries = CONFIG.get(
         'respawn_retries',
         args.max_respawn_retries)
+    respawn_backoff = CONFIG.get('respawn_backoff', args.respawn_backoff)
+    respawn_backoff_max = CONFIG.get(
+        'respawn_backoff_max',
+        args.respawn_backoff_max)
+    use_zygote = CONFIG.get('zygote', args.zygote)
+    metrics_endpoint = CONFIG.get('metrics_endpoint')
+    resources_interval = CONFIG.get(
+        'resources_interval',
+        args.resources_interval)
+    ready_timeout = CONFIG.get('ready_timeout', DEFAULT_READY_TIMEOUT)
+    stop_timeout = CONFIG.get('stop_timeout', DEFAULT_STOP_TIMEOUT)
+    control_socket = CONFIG.get('control_socket', args.control_socket)
     alert_on_error = CONFIG.get('alert_on_error')
 
+    # Installed before starting the processes, to not miss any exit
+    wakeup_fd = install_sigchld_handler()
+    jobs_by_pid = {}
+    zygotes_by_pid = {}
+
+    # Groups to restart (None for all of them) and ongoing restarts
+    restart_requests = []
+    rolling_restarts = {}
+    install_sighup_handler(restart_requests)
+
+    sampler = resources.ResourceSampler()
+    metrics = resources.MetricsReader()
+
+    # Commands and status requests of watcherctl.py
+    control_server = None
+    if control_socket:
+        control_server = control.ControlServer(control_socket)
+        logger.info("Control socket at {0}".format(control_socket))
+
+    def dispatch(request):
+        return control_command(
+            request, processes, jobs_by_pid, restart_requests,
+            rolling_restarts)
+
+    # Cpus pinned by some group, left out of the "auto" affinity pools
+    reserved_cpus = placement.reserved_cpus(CONFIG['processes'].itervalues())
+
+    # Cpu affinity, nice and ionice of the processes of each group, all
+    # checked before starting anything
+    placements = dict(
+        (group_name, placement.Placement(group_definition, reserved_cpus))
+        for group_name, group_definition in CONFIG['processes'].iteritems())
+
     # Start the processes
     for group_id, (group_name, group_definition) in enumerate(
             CONFIG['processes'].iteritems(), start=1):
@@ -254,6 +1023,14 @@ def perform():
             'max_respawn_retries',
             max_respawn_retries)
 
+        # Backoff of the jobs of the group that die too soon
+        group_respawn_backoff = group_definition.get(
+            'respawn_backoff',
+            respawn_backoff)
+        group_respawn_backoff_max = group_definition.get(
+            'respawn_backoff_max',
+            respawn_backoff_max)
+
         # List of emails to alert when something goes wrong
         group_alert_on_error = group_definition.get(
             'alert_on_error',
@@ -271,6 +1048,52 @@ def perform():
         script_full_path = os.path.abspath(group_definition['script'])
         group_alias = group_definition.get('name', group_name)
 
+        # Metrics endpoint of the processes (METRICS_ENDPOINT), used for
+        # their throughput and backlog
+        group_metrics_endpoint = group_definition.get(
+            'metrics_endpoint',
+            metrics_endpoint)
+
+        if group_metrics_endpoint:
+            group_env = dict(os.environ, METRICS_ENDPOINT=group_metrics_endpoint)
+        else:
+            group_env = None
+
+        group_placement = placements[group_name]
+
+        if group_placement.enabled:
+            logger.info("{} [{}]: cpus {}{}, nice {}, ionice {}".format(
+                group_alias,
+                group_id,
+                group_placement.cpus or 'any',
+                ' (one per instance)' if group_placement.auto else '',
+                group_placement.nice,
+                group_placement.ionice))
+        else:
+            group_placement = None
+
+        # Autoscaling between min and max instances
+        group_autoscale = group_definition.get('autoscale')
+
+        if group_autoscale is not None:
+            group_autoscale = dict(DEFAULT_AUTOSCALE, **group_autoscale)
+            group_autoscale.setdefault('min', 1)
+            group_autoscale.setdefault('max', total_instances)
+            group_autoscale.setdefault('parameters', instances[0]
+                                       if instances else None)
+            group_autoscale['last_scaled_at'] = 0
+
+        # Processes forked from a pre-imported template process?
+        if group_definition.get('zygote', use_zygote):
+            group_zygote = zygote.Zygote(
+                script_full_path,
+                group_python_exec,
+                preload=group_definition.get('preload', DEFAULT_PRELOAD),
+                env=group_env)
+            group_zygote.start()
+        else:
+            group_zygote = None
+
         # And now, the group definition is stored
         processes[group_name] = process_group = dict(
             id=group_id,
@@ -280,99 +1103,145 @@ def perform():
             instances=instances,
             keep_alive=group_keep_alive,
             max_respawn_retries=group_max_respawn_retries,
+            respawn_backoff=group_respawn_backoff,
+            respawn_backoff_max=group_respawn_backoff_max,
             python_exec=group_python_exec,
+            zygote=group_zygote,
+            env=group_env,
+            placement=group_placement,
+            ready_timeout=group_definition.get('ready_timeout', ready_timeout),
+            stop_timeout=group_definition.get('stop_timeout', stop_timeout),
+            retired_zygotes=[],
+            stopped=False,
+            metrics_endpoint=group_metrics_endpoint,
+            autoscale=group_autoscale,
             alert_on_error=group_alert_on_error,
+            respawned_count=0,
+            failed_count=0,
+            last_instance_id=0,
+            stats=None,
             running_jobs=[],
             dead_jobs=[])
 
+        if group_zygote is not None:
+            zygotes_by_pid[group_zygote.process.pid] = process_group
+
         # The creation of the processes starts
         # For each group of parameters...
-        for instance_id, instance_parameters in enumerate(
-                process_group["instances"], start=1):
+        for instance_parameters in process_group["instances"]:
 
             # A new process is instatiated
-            timestamp = time.time()
-
-            job = dict(
-                id=((group_id * 100) + instance_id),
-                created_at=timestamp,
-                uptime=0,
-                respawn_retries=0,
-                last_start_at=timestamp,
-                last_updated_at=timestamp,
-                failed_permanently=False,
-                parameters=instance_parameters,
-                process=new_instance(
-                    process_group["script"],
-                    process_group["python_exec"],
-                    parameters=instance_parameters))
+            job = new_job(process_group, instance_parameters)
+            start_job(process_group, job, jobs_by_pid)
 
             # And adding that job to the running jobs of the group
             process_group["running_jobs"].append(job)
 
-    logger.info("Waiting 5 seconds for processes status consistency")
-    time.sleep(5)
-
-    # Before starting the polling loop, check if there's
-    # some processes to watch. Sometimes they die at
-    # startup time and we don't know yet
-    if not any_running(processes):
-        logger.critical("All jobs already finished. Terminating")
-        return
+    next_summary = time.time() + polling_time
+    next_resources = time.time() + resources_interval
+    next_respawn = None
 
-    # And the polling starts!
+    # And the supervision starts! It sleeps until a child finishes, a
+    # respawn is due or it's time for the summary
     while True:
-        logger.info('Polling')
-
         try:
-            pong = time.time()
+            # Jobs that die at startup, or permanently, are handled as
+            # any other exit. Once there's nothing left to watch, we're done
+            # (unless they can be started again from the control socket)
+            if control_server is None and not any_running(processes):
+                logger.critical("All jobs already finished. Terminating")
+                break
+
+            wake_at = min(next_summary, next_resources)
+            if next_respawn is not None:
+                wake_at = min(wake_at, next_respawn)
+            if rolling_restarts:
+                wake_at = min(wake_at, time.time() + ROLLING_RESTART_TICK)
+
+            zygotes = [group["zygote"] for group in processes.itervalues()
+                       if group["zygote"] is not None]
+            zygotes.extend(old_zygote for group in processes.itervalues()
+                           for old_zygote in group["retired_zygotes"])
+
+            watched = [wakeup_fd] + [group_zygote.event_fd
+                                     for group_zygote in zygotes]
+            if control_server is not None:
+                watched.extend(control_server.fds())
+
+            try:
+                readable, _, _ = select.select(
+                    watched, [], [], max(0, wake_at - time.time()))
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+
+            drain(wakeup_fd)
+
+            # Jobs forked by the zygotes are reported by them
+            exits = [exit for group_zygote in zygotes
+                     for exit in group_zygote.read_exits()]
+
+            for pid, job_exit_code in reap_children():
+                if pid in zygotes_by_pid:
+                    group = zygotes_by_pid.pop(pid)
+                    group["zygote"].process.returncode = job_exit_code
+                    restart_zygote(group, jobs_by_pid, zygotes_by_pid)
+                else:
+                    exits.append((pid, job_exit_code))
 
-            for group_name, group in processes.iteritems():
-                respawned_count = 0
-                failed_count = 0
+            for pid, job_exit_code in exits:
+                # The pid may be reused, don't take its cpu time as ours
+                sampler.forget(pid)
 
-                logger.debug("Polling group {} [{}]".format(
-                    group_name,
-                    group['id']))
-
-                if group['running_jobs']:
-                    respawned_count, failed_count = check_dead_processes(
-                        group_name,
-                        group)
-
-                    # Updates the list of running processes
-                    group["dead_jobs"] = [job for job
-                                          in group["running_jobs"]
-                                          if job["failed_permanently"]]
-
-                    group["running_jobs"] = [job for job
-                                             in group["running_jobs"]
-                                             if not job["failed_permanently"]]
-
-                # Here the notation is
-                # R: Running
-                # S: Spawned (Resurrected)
-                # F: Failed Permanently (this cycle)
-                # D: Total Dead Jobs
-                logger.info((
-                    "Summary for {} [{}]: R: {} | S: {} | F: {} | D: {}"
-                    .format(
-                        group_name,
-                        group['id'],
-                        len(group["running_jobs"]),
-                        respawned_count,
-                        failed_count,
-                        len(group["dead_jobs"]))))
-
-            ping = time.time()
-            diff = ping - pong
-
-            if diff < polling_time:
-                # Waits if necessary
-                sleep_time = polling_time - diff
-
-                logger.debug('Sleeping {0} seconds'.format(sleep_time))
-                time.sleep(sleep_time)
+                if pid not in jobs_by_pid:
+                    continue
+
+                group, job = jobs_by_pid.pop(pid)
+                handle_exit(group, job, job_exit_code)
+
+            if control_server is not None:
+                control_server.handle(readable, dispatch)
+
+            if time.time() >= next_resources:
+                account_resources(processes, sampler, metrics)
+
+                for group_name, group in processes.iteritems():
+                    if (group["autoscale"] is not None
+                            and not group["stopped"]
+                            and group_name not in rolling_restarts):
+                        autoscale_group(group, jobs_by_pid)
+
+                next_resources = time.time() + resources_interval
+
+            while restart_requests:
+                requested = restart_requests.pop(0)
+
+                for group_name, group in processes.iteritems():
+                    if requested not in (None, group_name):
+                        continue
+
+                    if group_name in rolling_restarts:
+                        logger.info("{} [{}]: Already restarting".format(
+                            group_name, group["id"]))
+                    else:
+                        rolling_restarts[group_name] = start_rolling_restart(
+                            group, zygotes_by_pid)
+
+            for group_name, state in rolling_restarts.items():
+                group = processes[group_name]
+
+                if step_rolling_restart(group, state, jobs_by_pid, metrics):
+                    del rolling_restarts[group_name]
+
+            for group in processes.itervalues():
+                close_retired_zygotes(group)
+
+            next_respawn = respawn_due_jobs(processes, jobs_by_pid)
+
+            if time.time() >= next_summary:
+                log_summaries(processes)
+                next_summary = time.time() + polling_time
 
         except KeyboardInterrupt:
             logger.info("Keyboard Interrupt... finishing")
@@ -381,8 +1250,21 @@ def perform():
             logger.exception('An uncaught exception has ocurred')
             break
 
+    if control_server is not None:
+        control_server.close()
+
 
-def new_instance(script, python_executable, parameters=None):
+def instance_parameters(parameters):
+    if parameters is None:
+        return []
+
+    if isinstance(parameters, basestring):
+        return parameters.split()
+
+    return list(parameters)
+
+
+def new_instance(script, python_executable, parameters=None, env=None, placement_settings=None):
 
     init_values = [python_executable, script]
 
@@ -392,8 +1274,13 @@ def new_instance(script, python_executable, parameters=None):
 
         init_values.extend(parameters)
 
+    if placement_settings is not None:
+        preexec_fn = lambda: placement.apply_in_child(placement_settings)
+    else:
+        preexec_fn = None
+
     try:
-        return subprocess.Popen(init_values)
+        return subprocess.Popen(init_values, env=env, preexec_fn=preexec_fn)
     except OSError:
         logger.exception("Error creating a new process")
         raise
@@ -0,0 +1,138 @@
+"""Command line client of the watcher control socket.
+
+    python watcherctl.py -s /tmp/watcher.sock status
+    python watcherctl.py -s /tmp/watcher.sock stop archivers
+    python watcherctl.py -s /tmp/watcher.sock start archivers
+    python watcherctl.py -s /tmp/watcher.sock scale archivers 4
+    python watcherctl.py -s /tmp/watcher.sock restart archivers
+
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import control
+
+COMMANDS = ('status', 'start', 'stop', 'scale', 'restart')
+
+
+def format_uptime(seconds):
+    minutes, seconds = divmod(int(seconds or 0), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{0}:{1:02d}:{2:02d}".format(hours, minutes, seconds)
+
+
+def format_parameters(parameters):
+    # As in the config, a string or a list (see watcher.instance_parameters)
+    if parameters is None:
+        return ''
+    if isinstance(parameters, basestring):
+        return ' '.join(parameters.split())
+    return ' '.join(str(parameter) for parameter in parameters)
+
+
+def format_group(group_name, group):
+    lines = []
+
+    flags = []
+    if group["stopped"]:
+        flags.append('stopped')
+    if group["restarting"]:
+        flags.append('restarting')
+    if group["zygote"]:
+        flags.append('zygote')
+    if group["autoscale"]:
+        flags.append('autoscale {0}-{1}'.format(
+            group["autoscale"]["min"], group["autoscale"]["max"]))
+
+    lines.append("{0} [{1}] {2} jobs, {3} dead{4}".format(
+        group_name,
+        group["id"],
+        len(group["running_jobs"]),
+        len(group["dead_jobs"]),
+        ' ({0})'.format(', '.join(flags)) if flags else ''))
+
+    for job in group["running_jobs"]:
+        stats = job["stats"] or {}
+
+        lines.append(
+            "  {id:>4} {pid:>7} {state:<9} {uptime:>9} {respawns:>3} "
+            "{cpu:>6} {rss:>8}  {parameters}".format(
+                id=job["id"],
+                pid=job["pid"] or '-',
+                state=job["state"],
+                uptime=format_uptime(job["uptime"]),
+                respawns=job["respawn_retries"],
+                cpu=('{0:.1f}%'.format(stats["cpu"])
+                     if 'cpu' in stats else '-'),
+                rss=('{0}M'.format(stats["rss"] // (1024 * 1024))
+                     if 'rss' in stats else '-'),
+                parameters=format_parameters(job["parameters"])))
+
+    return '\n'.join(lines)
+
+
+def format_status(response):
+    lines = ["Watcher {0}, {1}".format(
+        response["pid"], time.strftime('%Y-%m-%d %H:%M:%S'))]
+
+    for group_name, group in sorted(response["groups"].iteritems()):
+        lines.append(format_group(group_name, group))
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Send a command to a running watcher",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        '-s', '--socket',
+        required=True,
+        help='Control socket of the watcher (--control-socket)')
+    parser.add_argument(
+        '-j', '--json',
+        action='store_true',
+        help='Print the raw JSON response')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('group', nargs='?', help='Group of processes')
+    parser.add_argument(
+        'instances',
+        nargs='?',
+        type=int,
+        help='Instances of the group (scale)')
+
+    args = parser.parse_args()
+
+    if args.command != 'status' and args.group is None:
+        parser.error("{0} needs a group".format(args.command))
+
+    if args.command == 'scale' and args.instances is None:
+        parser.error("scale needs the amount of instances")
+
+    params = {}
+    if args.group is not None:
+        params['group'] = args.group
+    if args.instances is not None:
+        params['instances'] = args.instances
+
+    client = control.ControlClient(args.socket)
+
+    try:
+        response = client.request(args.command, **params)
+    finally:
+        client.close()
+
+    if args.json:
+        print json.dumps(response, indent=2, sort_keys=True)
+    elif not response.get("ok"):
+        print "Error: {0}".format(response.get("error"))
+    elif args.command == 'status':
+        print format_status(response)
+    else:
+        print format_group(args.group, response["group"])
+
+    sys.exit(0 if response.get("ok") else 1)
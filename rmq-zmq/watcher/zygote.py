@@ -0,0 +1,395 @@
+"""Zygote processes for the watcher.
+
+A zygote is a template process of a group: it imports once the modules
+used by the group script (the imports found at the top of the script,
+plus an optional list of modules) and then forks a worker for each
+spawn request of the watcher. The workers run the script with runpy as
+if it were started with "python script args...", but without paying
+the interpreter start and the imports again, so a respawned process is
+running in milliseconds.
+
+The watcher and the zygote talk over two pipes with JSON lines:
+
+    watcher -> zygote   {"args": [...], "placement": {...} or null}
+    zygote -> watcher   {"pid": 1234} or {"error": "..."}  (spawn reply)
+                        {"exit": 1234, "code": 1}          (worker exit)
+
+The placement of a worker (see placement.py) is applied by the worker
+itself, before running the script.
+
+The workers are children of the zygote, so the zygote reaps them and
+reports their exit codes. Workers get SIGTERM if their zygote dies
+(PR_SET_PDEATHSIG), and the zygote exits when the watcher goes away.
+
+Forking is only safe for modules without side effects at import time
+(threads, sockets, open files...), so 'preload' can be disabled.
+
+"""
+
+import ast
+import ctypes
+import errno
+import fcntl
+import json
+import os
+import random
+import runpy
+import select
+import signal
+import subprocess
+import sys
+import time
+import traceback
+
+import placement
+
+PR_SET_PDEATHSIG = 1
+
+READ_SIZE = 4096
+
+# Seconds a zygote has to answer a spawn request before it's taken as
+# hung (the watcher main loop waits meanwhile)
+SPAWN_TIMEOUT = 10.0
+
+# The source, not the .pyc this module may have been loaded from
+ZYGOTE_SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+
+def set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def exit_code(status):
+    # Same convention as Popen.returncode
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class LineReader(object):
+    """Reads JSON lines from a pipe, keeping partial lines buffered"""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = ''
+        self.closed = False
+
+    def read(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+
+        if not data:
+            self.closed = True
+            return []
+
+        self.buffer += data
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+
+        return [json.loads(line) for line in lines if line]
+
+
+def write_message(fd, message):
+    data = json.dumps(message) + '\n'
+
+    while data:
+        try:
+            data = data[os.write(fd, data):]
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+#
+# Watcher side
+#
+
+class ZygoteProcess(object):
+    """Popen-like handle of a worker forked by a zygote"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def send_signal(self, signum):
+        os.kill(self.pid, signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class Zygote(object):
+    """Zygote process of a group, as seen from the watcher"""
+
+    def __init__(self, script, python_executable, preload='auto', env=None):
+        self.script = script
+        self.python_executable = python_executable
+        self.preload = preload
+        self.env = env
+        self.process = None
+        self.workers = {}
+        self.exits = []
+
+    def start(self):
+        command_r, command_w = os.pipe()
+        event_r, event_w = os.pipe()
+
+        # Only the zygote ends are inherited
+        set_cloexec(command_w)
+        set_cloexec(event_r)
+
+        if self.preload == 'auto':
+            preload = ['--auto']
+        else:
+            preload = list(self.preload or ())
+
+        try:
+            self.process = subprocess.Popen([
+                self.python_executable,
+                ZYGOTE_SCRIPT,
+                str(command_r),
+                str(event_w),
+                self.script] + preload,
+                env=self.env)
+        finally:
+            os.close(command_r)
+            os.close(event_w)
+
+        set_nonblocking(event_r)
+
+        self.command_fd = command_w
+        self.event_fd = event_r
+        self.events = LineReader(event_r)
+
+    def close(self):
+        os.close(self.command_fd)
+        os.close(self.event_fd)
+
+    def spawn(self, parameters, placement_settings=None):
+        """Asks the zygote for a new worker, returning its handle"""
+
+        write_message(self.command_fd, {
+            "args": parameters, "placement": placement_settings})
+
+        deadline = time.time() + SPAWN_TIMEOUT
+        reply = None
+
+        # Exits reported meanwhile (before or after the reply, in the same
+        # read) are kept for read_exits()
+        while reply is None:
+            if self.events.closed:
+                raise OSError(errno.ECHILD, "The zygote is gone")
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise OSError(errno.ETIMEDOUT, "The zygote didn't answer in {0} seconds".format(
+                    SPAWN_TIMEOUT))
+
+            try:
+                select.select([self.event_fd], [], [], remaining)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+
+            for message in self.events.read():
+                if 'exit' in message:
+                    self.exits.append(message)
+                else:
+                    reply = message
+
+        if 'error' in reply:
+            raise OSError(reply['error'])
+
+        worker = ZygoteProcess(reply['pid'])
+        self.workers[worker.pid] = worker
+        return worker
+
+    def read_exits(self):
+        """Yields (pid, exit code) of the workers that finished"""
+
+        messages, self.exits = self.exits + self.events.read(), []
+
+        for message in messages:
+            if 'exit' in message:
+                worker = self.workers.pop(message['exit'], None)
+                if worker is not None:
+                    worker.returncode = message['code']
+                yield message['exit'], message['code']
+
+    def orphans(self):
+        """Workers left when the zygote died, they got SIGTERM"""
+
+        workers, self.workers = self.workers, {}
+
+        for pid in workers:
+            yield pid, -signal.SIGTERM
+
+
+#
+# Zygote side
+#
+
+def script_imports(script):
+    """Modules imported at the top level of a script"""
+
+    with open(script) as source:
+        tree = ast.parse(source.read(), script)
+
+    modules = []
+
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level:
+            if node.module != '__future__':
+                modules.append(node.module)
+
+    return modules
+
+
+def preload_modules(modules):
+    for module in modules:
+        try:
+            __import__(module)
+        except Exception:
+            # The worker will fail (or not) importing it itself
+            sys.stderr.write("Zygote: can't preload {0}\n".format(module))
+
+
+def run_worker(script, args, fds, placement_settings=None):
+    """Runs in the forked worker, never returns"""
+
+    code = 0
+
+    try:
+        for fd in fds:
+            os.close(fd)
+
+        if placement_settings is not None:
+            placement.apply_in_child(placement_settings)
+
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM, 0, 0, 0)
+        except (OSError, AttributeError):
+            pass
+
+        # Otherwise all the workers would share the same random sequence
+        random.seed()
+
+        sys.argv = [script] + list(args)
+        runpy.run_path(script, run_name='__main__')
+
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            sys.stderr.write("{0}\n".format(e.code))
+            code = 1
+
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def serve(command_fd, event_fd, script, preload):
+    # The workers see the same sys.path as "python script"
+    sys.path[0] = os.path.dirname(script)
+    preload_modules(preload)
+
+    wakeup_r, wakeup_w = os.pipe()
+    set_nonblocking(wakeup_r)
+    set_nonblocking(wakeup_w)
+
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    # The watcher decides when the zygote finishes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    commands = LineReader(command_fd)
+    fds = (command_fd, event_fd, wakeup_r, wakeup_w)
+
+    while not commands.closed:
+        try:
+            readable, _, _ = select.select([command_fd, wakeup_r], [], [])
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            continue
+
+        if wakeup_r in readable:
+            try:
+                while os.read(wakeup_r, READ_SIZE):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    break
+
+                if pid == 0:
+                    break
+
+                write_message(event_fd, {
+                    "exit": pid, "code": exit_code(status)})
+
+        if command_fd in readable:
+            for message in commands.read():
+                try:
+                    pid = os.fork()
+                except OSError as e:
+                    write_message(event_fd, {"error": str(e)})
+                    continue
+
+                if pid == 0:
+                    run_worker(script, message['args'], fds, message.get('placement'))
+
+                write_message(event_fd, {"pid": pid})
+
+
+if __name__ == '__main__':
+    command_fd, event_fd = int(sys.argv[1]), int(sys.argv[2])
+    script = sys.argv[3]
+    preload = sys.argv[4:]
+
+    if preload[:1] == ['--auto']:
+        preload = script_imports(script) + preload[1:]
+
+    serve(command_fd, event_fd, script, preload)
@@ -39,6 +39,7 @@ from matplotlib import pyplot
 
 import cep_tools
 from config import zmq_config as conf
+from message_profiler import MessageProfiler
 
 __author__ = "Nicolas Estrada"
 __version__ = "1.0.0"
@@ -73,29 +74,34 @@ def run():
     }
 
     try:
-        while True:
+        with MessageProfiler(name='cep') as mp:
+            while True:
 
-            rkey, message = rcv.recv_multipart()
-            # print("[cep] Received message [%s] RKEY: [%s]" % (message, rkey))
-            message = json.loads(message)
+                rkey, message = rcv.recv_multipart()
+                mp.msg_received(len(rkey) + len(message))
+                # print("[cep] Received message [%s] RKEY: [%s]" % (message, rkey))
+                message = json.loads(message)
 
-            message['profiler']['data_ts'] = time.time()
+                message['profiler']['data_ts'] = time.time()
+                mp.record_latency(
+                    message['profiler']['data_ts']
+                    - message['profiler']['created_ts'])
 
-            # cep processing: moving avg; min/max threshold speed
+                # cep processing: moving avg; min/max threshold speed
 
-            speeds.append(message['speed'])  # replace using Redis
-            cep_event = notification.check(message['speed'], speeds)
+                speeds.append(message['speed'])  # replace using Redis
+                cep_event = notification.check(message['speed'], speeds)
 
-            # event shift (semantic, granularity and sliding windows)
-            for action in cep_event['event']['actions']:
+                # event shift (semantic, granularity and sliding windows)
+                for action in cep_event['event']['actions']:
 
-                if cep_event['notify_id'] in conf.cep['events'][action]:
-                    functions[action](
-                        cep_event['event']['routing_key'],
-                        message)
+                    if cep_event['notify_id'] in conf.cep['events'][action]:
+                        functions[action](
+                            cep_event['event']['routing_key'],
+                            message)
 
-            # pub.send_multipart([rkey, json.dumps(message)])
-            # print("[cep] Sent message [%s] RKEY: [%s]" % (message, rkey))
+                # pub.send_multipart([rkey, json.dumps(message)])
+                # print("[cep] Sent message [%s] RKEY: [%s]" % (message, rkey))
 
     except KeyboardInterrupt:
         rcv.close()
@@ -45,6 +45,7 @@ import json
 import zmq
 
 from config import zmq_config as conf
+from message_profiler import MessageProfiler
 
 __author__ = "Nicolas Estrada"
 __version__ = "1.0.0"
@@ -77,19 +78,25 @@ def run():
 
     try:
 
-        while True:
+        with MessageProfiler(name='controller') as mp:
+            while True:
 
-            rkey, message = queue.recv_multipart()
-            # print("[controller] Received message [%s] RKEY: [%s]" % (message, rkey))
+                rkey, message = queue.recv_multipart()
+                mp.msg_received(len(rkey) + len(message))
+                # print("[controller] Received message [%s] RKEY: [%s]" % (message, rkey))
 
-            message = json.loads(message)
-            message['profiler']['controller_ts'] = time.time()
+                message = json.loads(message)
+                message['profiler']['controller_ts'] = time.time()
 
-            pub.send_multipart([rkey, json.dumps(message)])
-            # print("[controller - db] Sent message [%s] RKEY: [%s]" % (message, rkey))
+                body = json.dumps(message)
 
-            cep.send_multipart([rkey, json.dumps(message)])
-            # print("[controller - cep] Sent message [%s] RKEY: [%s]" % (message, rkey))
+                pub.send_multipart([rkey, body])
+                mp.msg_sent(len(rkey) + len(body))
+                # print("[controller - db] Sent message [%s] RKEY: [%s]" % (message, rkey))
+
+                cep.send_multipart([rkey, body])
+                mp.msg_sent(len(rkey) + len(body))
+                # print("[controller - cep] Sent message [%s] RKEY: [%s]" % (message, rkey))
 
     except KeyboardInterrupt:
         queue.close()
@@ -35,6 +35,7 @@ import json
 import zmq
 
 from config import zmq_config as conf
+from message_profiler import MessageProfiler
 
 __author__ = "Nicolas Estrada"
 __version__ = "1.0.0"
@@ -52,23 +53,28 @@ def run():
     rcv.bind("tcp://{host}:{port}".format(**conf.data['incoming']))
 
     try:
-        with open(conf.data['disk']['path'], 'w') as data:
-            # output header
-            data.write('sensor_id, speed, timestamp, type\n')
-
-            while True:
-
-                rkey, message = rcv.recv_multipart()
-                # print("[data] Received message [%s] RKEY: [%s]" % (message, rkey))
-                message = json.loads(message)
-
-                message['profiler']['data_ts'] = time.time()
-
-                data.write('{0},{1:.2f},{2},{3}'.format(
-                    message['sensor_id'],
-                    message['speed'],
-                    message['event_ts'],
-                    rkey) + '\n')
+        with MessageProfiler(name='data') as mp:
+            with open(conf.data['disk']['path'], 'w') as data:
+                # output header
+                data.write('sensor_id, speed, timestamp, type\n')
+
+                while True:
+
+                    rkey, message = rcv.recv_multipart()
+                    mp.msg_received(len(rkey) + len(message))
+                    # print("[data] Received message [%s] RKEY: [%s]" % (message, rkey))
+                    message = json.loads(message)
+
+                    message['profiler']['data_ts'] = time.time()
+                    mp.record_latency(
+                        message['profiler']['data_ts']
+                        - message['profiler']['created_ts'])
+
+                    data.write('{0},{1:.2f},{2},{3}'.format(
+                        message['sensor_id'],
+                        message['speed'],
+                        message['event_ts'],
+                        rkey) + '\n')
 
     except KeyboardInterrupt:
         rcv.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Histogram documentation.
+
+A small HDR (High Dynamic Range) style histogram for latencies.
+
+Values are integers (i.e. microseconds). Values under 2^bits are counted
+exactly; bigger values share logarithmic buckets split in 2^(bits - 1)
+linear sub-buckets, so the relative error is below 2^-(bits - 1)
+(0.8% for the default 8 bits) with a fixed and small memory footprint,
+no matter the range of the recorded values.
+
+"""
+
+from __future__ import division
+
+__author__ = "Nicolas Estrada"
+__version__ = "0.0.1"
+
+DEFAULT_BITS = 8
+DEFAULT_PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram(object):
+
+    def __init__(self, bits=DEFAULT_BITS):
+        self.bits = bits
+        self.sub_bucket_count = 1 << bits
+        self.sub_bucket_half = self.sub_bucket_count >> 1
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.total_count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+
+        bucket = value.bit_length() - self.bits
+        return bucket * self.sub_bucket_half + (value >> bucket)
+
+    def _highest_value(self, index):
+        """Highest value counted in the slot of index"""
+
+        if index < self.sub_bucket_count:
+            return index
+
+        bucket = index // self.sub_bucket_half - 1
+        sub_bucket = index - bucket * self.sub_bucket_half
+        return ((sub_bucket + 1) << bucket) - 1
+
+    def record(self, value, count=1):
+        value = max(0, int(value))
+        index = self._index(value)
+
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total_count += count
+        self.total += value * count
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+        self.total_count += other.total_count
+        self.total += other.total
+
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def mean(self):
+        if not self.total_count:
+            return 0
+        return self.total / self.total_count
+
+    def value_at_percentile(self, percentile):
+        if not self.total_count:
+            return 0
+
+        target = max(1, int(round(percentile / 100 * self.total_count)))
+        accumulated = 0
+
+        for index in sorted(self.counts):
+            accumulated += self.counts[index]
+
+            if accumulated >= target:
+                return min(self._highest_value(index), self.max)
+
+        return self.max
+
+    def percentiles(self, percentiles=DEFAULT_PERCENTILES):
+        """Returns {percentile: value} in a single pass"""
+
+        result = dict.fromkeys(percentiles, 0)
+
+        if not self.total_count:
+            return result
+
+        pending = sorted(percentiles)
+        accumulated = 0
+
+        for index in sorted(self.counts):
+            accumulated += self.counts[index]
+
+            while pending and accumulated >= max(
+                    1, int(round(pending[0] / 100 * self.total_count))):
+                result[pending.pop(0)] = min(self._highest_value(index), self.max)
+
+            if not pending:
+                break
+
+        return result
@@ -41,6 +41,7 @@ import json
 import zmq
 
 from config import zmq_config as conf
+from message_profiler import MessageProfiler
 
 __author__ = "Nicolas Estrada"
 __version__ = "1.0.0"
@@ -63,16 +64,22 @@ def run():
     pub.bind("tcp://{host}:{port}".format(**conf.receiver['outgoing']))
 
     try:
-        while True:
+        with MessageProfiler(name='receiver') as mp:
+            while True:
 
-            rkey, message = rcv.recv_multipart()
-            # print("[receiver] Received message [%s] RKEY: [%s]" % (message, rkey))
-            message = json.loads(message)
+                rkey, message = rcv.recv_multipart()
+                mp.msg_received(len(rkey) + len(message))
+                # print("[receiver] Received message [%s] RKEY: [%s]" % (message, rkey))
+                message = json.loads(message)
 
-            message['profiler']['receiver_ts'] = time.time()
+                message['profiler']['receiver_ts'] = time.time()
 
-            pub.send_multipart([rkey, json.dumps(message)])
-            # print("[receiver] Sent message [%s] RKEY: [%s]" % (message, rkey))
+                body = json.dumps(message)
+
+                pub.send_multipart([rkey, body])
+
+                mp.msg_sent(len(rkey) + len(body))
+                # print("[receiver] Sent message [%s] RKEY: [%s]" % (message, rkey))
 
     except KeyboardInterrupt:
         rcv.close()
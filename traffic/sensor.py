@@ -47,6 +47,7 @@ import argparse
 import zmq
 
 from config import zmq_config as conf
+from message_profiler import MessageProfiler
 
 __author__ = "Nicolas Estrada"
 __version__ = "1.0.0"
@@ -77,25 +78,29 @@ def run(sensor_id=0):
 
     try:
 
-        while True:
-            # Sensor receiving events
-
-            rkey, message = sensor_receive.recv_multipart()
-            message = json.loads(message)
-            # print(
-            #     "[SID %s] Received event [%s] RKEY: [%s]"
-            #         % (str(sensor_id), message, rkey)
-            # )
-
-            message['profiler']['sensor_received_ts'] = time.time()
-
-            # message['profiler']['sensor_received_id'] = sensor_id
-            rkey = 'event'
-            sensor_publish.send_multipart([rkey, json.dumps(message)])
-            # print(
-            #     "[SID %s] Sent event [%s] RKEY: [%s]"
-            #         % (str(sensor_id), message, rkey)
-            # )
+        with MessageProfiler(name='sensor') as mp:
+            while True:
+                # Sensor receiving events
+
+                rkey, message = sensor_receive.recv_multipart()
+                mp.msg_received(len(rkey) + len(message))
+                message = json.loads(message)
+                # print(
+                #     "[SID %s] Received event [%s] RKEY: [%s]"
+                #         % (str(sensor_id), message, rkey)
+                # )
+
+                message['profiler']['sensor_received_ts'] = time.time()
+
+                # message['profiler']['sensor_received_id'] = sensor_id
+                rkey = 'event'
+                body = json.dumps(message)
+                sensor_publish.send_multipart([rkey, body])
+                mp.msg_sent(len(rkey) + len(body))
+                # print(
+                #     "[SID %s] Sent event [%s] RKEY: [%s]"
+                #         % (str(sensor_id), message, rkey)
+                # )
 
     except KeyboardInterrupt:
         sensor_receive.close()
@@ -41,6 +41,7 @@ import zmq
 import arrow
 
 from config import zmq_config as conf
+from message_profiler import MessageProfiler
 
 SD = 7
 INTERVAL = 900.0
@@ -62,70 +63,71 @@ def run():
     )
     pub.bind("tcp://{host}:{port}".format(**conf.generator['outgoing']))
     try:
-        with open(data_file_path, 'rb') as data:
-
-            data_reader = csv.reader(data)
-            offset = 0
-
-            for i, row in enumerate(data_reader):
-                if i > 0:
-                    date = "{0}-{1:02d}-{2:02d} {3:02d}:{4:02d}:00".format(
-                        row[2],
-                        int(row[3]),
-                        int(row[4]),
-                        int(row[5]),
-                        int(row[6]))
-
-                    timestamp = arrow.get(date)
-                    scans = int(row[7].replace(",", ""))
-                    devices = int(row[11].replace(",", ""))
-                    avg_speed = float(row[8].replace(",", "."))
-
-                    log = "Datetime: {0}, Scans: {1}, Speed: {2}".format(
-                        timestamp,
-                        scans,
-                        avg_speed)
-
-                    occurrences = (1 if devices == 0
-                        else int(numpy.ceil(scans / float(devices)))
-                    )
-
-                    for n in xrange(occurrences):
-                        # one file per sensor
-
-                        sensor_id = row[0]
-                        event_id = offset + n + 1
-                        # speed = get_speed(avg_speed)
-                        speed = numpy.random.normal(avg_speed, SD)
-
-                        # print "[S{0}][{1}] Speed: {2} \n".format(
-                        #     sensor_id,
-                        #     event_id,
-                        #     speed)
-
-                        message = dict(
-                            sensor_id = str(sensor_id),
-                            event_id = event_id,
-                            speed = speed,
-                            event_ts = (
-                                (timestamp + arrow.util.timedelta(
-                                seconds=n * INTERVAL
-                                / float(occurrences))).timestamp),
-
-                            profiler = dict(
-                                created_ts = time.time())
-                            )
-                        rkey = str(sensor_id)
-
-                        pub.send_multipart([
-                            rkey,
-                            json.dumps(message)])
-
-                        # print("Message sent: [%s] RKEY: [%s]" % (message, rkey))
-
-                        # time.sleep(.005)
-
-                    offset += n + 1
+        with MessageProfiler(name='trace-driven') as mp:
+            with open(data_file_path, 'rb') as data:
+
+                data_reader = csv.reader(data)
+                offset = 0
+
+                for i, row in enumerate(data_reader):
+                    if i > 0:
+                        date = "{0}-{1:02d}-{2:02d} {3:02d}:{4:02d}:00".format(
+                            row[2],
+                            int(row[3]),
+                            int(row[4]),
+                            int(row[5]),
+                            int(row[6]))
+
+                        timestamp = arrow.get(date)
+                        scans = int(row[7].replace(",", ""))
+                        devices = int(row[11].replace(",", ""))
+                        avg_speed = float(row[8].replace(",", "."))
+
+                        log = "Datetime: {0}, Scans: {1}, Speed: {2}".format(
+                            timestamp,
+                            scans,
+                            avg_speed)
+
+                        occurrences = (1 if devices == 0
+                            else int(numpy.ceil(scans / float(devices)))
+                        )
+
+                        for n in xrange(occurrences):
+                            # one file per sensor
+
+                            sensor_id = row[0]
+                            event_id = offset + n + 1
+                            # speed = get_speed(avg_speed)
+                            speed = numpy.random.normal(avg_speed, SD)
+
+                            # print "[S{0}][{1}] Speed: {2} \n".format(
+                            #     sensor_id,
+                            #     event_id,
+                            #     speed)
+
+                            message = dict(
+                                sensor_id = str(sensor_id),
+                                event_id = event_id,
+                                speed = speed,
+                                event_ts = (
+                                    (timestamp + arrow.util.timedelta(
+                                    seconds=n * INTERVAL
+                                    / float(occurrences))).timestamp),
+
+                                profiler = dict(
+                                    created_ts = time.time())
+                                )
+                            rkey = str(sensor_id)
+
+                            body = json.dumps(message)
+                            pub.send_multipart([rkey, body])
+                            mp.msg_sent(len(rkey) + len(body))
+
+                            # print("Message sent: [%s] RKEY: [%s]" % (message, rkey))
+
+                            # time.sleep(.005)
+
+                        offset += n + 1
 
     except:
         pub.close()